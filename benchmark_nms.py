@@ -0,0 +1,83 @@
+# #### BEGIN LICENSE BLOCK #####
+# MIT License
+#    
+# Copyright (c) 2021 Bin.Li (ornot2008@yahoo.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# #### END LICENSE BLOCK #####
+# /
+
+import sys
+import os
+
+work_folder= os.path.dirname(os.path.realpath(__file__))
+sys.path.append(work_folder+'/src/tool')
+sys.path.append(work_folder+'/src/tool/metrics')
+
+import torch
+from torchvision import ops
+from benchmark_tool import measure_latency
+from nms import NMS_METHODS
+
+IOU_THRESHOLD = 0.3
+N_CLASSES = 20
+
+def random_detections(n_boxes, device):
+    # overlapping boxes in a 600x800 image, like the detections of the heads before the nms
+    top_left = torch.rand(n_boxes, 2, device=device) * torch.tensor([500., 700.], device=device)
+    boxes = torch.cat([top_left, top_left + 16 + torch.rand(n_boxes, 2, device=device) * 100], dim=1)
+    scores = torch.rand(n_boxes, device=device)
+    labels = torch.randint(1, N_CLASSES + 1, (n_boxes,), device=device)
+    return boxes, scores, labels
+
+def benchmark_nms(n_boxes, device):
+    boxes, scores, labels = random_detections(n_boxes, device)
+
+    # the references of the hard nms are the kernels of torchvision
+    references = {
+        'ops.nms': lambda: ops.nms(boxes, scores, IOU_THRESHOLD),
+        'ops.batched_nms': lambda: ops.batched_nms(boxes, scores, labels, IOU_THRESHOLD),
+    }
+    baseline = measure_latency(references['ops.nms'])
+    for name, fn in references.items():
+        latency = measure_latency(fn)
+        print("{:>16} n:{:>6} latency:{:.5f}s vs ops.nms:{:.2f}x kept:{}".format(
+            name, n_boxes, latency, latency/baseline, len(fn())))
+
+    for name, method in NMS_METHODS.items():
+        latency = measure_latency(method, boxes, scores, labels, IOU_THRESHOLD)
+        keep, _ = method(boxes, scores, labels, IOU_THRESHOLD)
+        print("{:>16} n:{:>6} latency:{:.5f}s vs ops.nms:{:.2f}x kept:{}".format(
+            name, n_boxes, latency, latency/baseline, len(keep)))
+
+    # the tensor hard nms keeps the same boxes as the kernels
+    hard_keep, _ = NMS_METHODS['hard'](boxes, scores, labels, IOU_THRESHOLD)
+    batched_keep, _ = NMS_METHODS['batched'](boxes, scores, labels, IOU_THRESHOLD)
+    print("hard == ops.nms: {}, batched == ops.batched_nms: {}".format(
+        torch.equal(hard_keep, references['ops.nms']()),
+        torch.equal(batched_keep, references['ops.batched_nms']())))
+
+
+if __name__=="__main__":
+    torch.manual_seed(0)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+    for n_boxes in [100, 1000, 4000]:
+        benchmark_nms(n_boxes, device)
@@ -0,0 +1,60 @@
+# #### BEGIN LICENSE BLOCK #####
+# MIT License
+#    
+# Copyright (c) 2021 Bin.Li (ornot2008@yahoo.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# #### END LICENSE BLOCK #####
+# /
+
+import sys
+import os
+
+work_folder= os.path.dirname(os.path.realpath(__file__))
+sys.path.append(work_folder+'/src/algorithm')
+sys.path.append(work_folder+'/src/config')
+sys.path.append(work_folder+'/src/data')
+sys.path.append(work_folder+'/src/tool')
+sys.path.append(work_folder+'/src/tool/metrics')
+
+from voc_dataset import VOCDataset
+from voc_image_cache import VOCImageCache
+from config import combine_configs
+
+def build_image_cache(config, split):
+    # the cache is built from the jpg files, so read them even if the config uses the cache
+    config = config.clone()
+    config.VOC_DATASET.USE_IMAGE_CACHE = False
+    voc_dataset = VOCDataset(config, split=split)
+
+    cache_dir = os.path.join(voc_dataset.cache_dir, 'image_cache', split)
+    VOCImageCache.build(voc_dataset,
+                        cache_dir,
+                        num_workers=config.FASTER_RCNN.NUM_WORKERS,
+                        shard_size_mb=config.VOC_DATASET.IMAGE_CACHE_SHARD_SIZE_MB)
+    print(' [*] Image cache of {} images written to {}'.format(len(voc_dataset), cache_dir))
+
+
+if __name__=="__main__":
+    train_config_path = work_folder+'/src/config/experiments/train/exp01_config.yaml'
+    build_image_cache(combine_configs(train_config_path), 'trainval')
+
+    eval_config_path = work_folder+'/src/config/experiments/eval/eval1.yaml'
+    build_image_cache(combine_configs(eval_config_path), 'test')
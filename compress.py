@@ -0,0 +1,110 @@
+# #### BEGIN LICENSE BLOCK #####
+# MIT License
+#    
+# Copyright (c) 2021 Bin.Li (ornot2008@yahoo.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# #### END LICENSE BLOCK #####
+# /
+
+import sys
+import os
+import copy
+
+work_folder= os.path.dirname(os.path.realpath(__file__))
+sys.path.append(work_folder+'/src/algorithm')
+sys.path.append(work_folder+'/src/config')
+sys.path.append(work_folder+'/src/data')
+sys.path.append(work_folder+'/src/tool')
+sys.path.append(work_folder+'/src/tool/metrics')
+
+import torch
+from faster_rcnn.faster_rcnn_evaluator import FasterRCNNEvaluator
+from faster_rcnn.faster_rcnn_network import FasterRCNN
+from voc_dataset import VOCDataset
+from config import combine_configs
+from checkpoint_tool import load_checkpoint, save_checkpoint
+from quantize import benchmark_head
+
+# (fc6 rank, fc7 rank) candidates, fc6 is 25088x4096 and fc7 is 4096x4096
+RANK_CANDIDATES = [(2048, 1024), (1024, 512), (768, 384), (512, 256)]
+
+# the max drop of map_50 accepted for the compressed model 
+MAX_MAP_50_DROP = 0.01
+
+# the min speedup of the head required for the compressed model
+MIN_HEAD_SPEEDUP = 2.0
+
+def compress(config, test_voc_dataset, ckpt, compressed_ckpt_path):
+    # the head latency is measured on cpu where the fc layers dominate
+    device = 'cpu'
+
+    faster_rcnn = FasterRCNN(config, device)
+    faster_rcnn.load_state_dict(ckpt['faster_rcnn_model'])
+    faster_rcnn.eval()
+    baseline_latency = benchmark_head(faster_rcnn, config)
+    baseline_map_50 = FasterRCNNEvaluator(config, test_voc_dataset, device).evaluate(ckpt['faster_rcnn_model'])['map_50'].item()
+    print("baseline head latency:{:.4f}s map_50:{:.4f}".format(baseline_latency, baseline_map_50))
+
+    best = None
+    for fc6_rank, fc7_rank in RANK_CANDIDATES:
+        compressed_faster_rcnn = copy.deepcopy(faster_rcnn)
+        compressed_faster_rcnn.fast_rcnn.compress(fc6_rank, fc7_rank)
+        latency = benchmark_head(compressed_faster_rcnn, config)
+
+        compressed_config = config.clone()
+        compressed_config.FAST_RCNN.FC6_RANK = fc6_rank
+        compressed_config.FAST_RCNN.FC7_RANK = fc7_rank
+        compressed_state = compressed_faster_rcnn.state_dict()
+        map_50 = FasterRCNNEvaluator(compressed_config, test_voc_dataset, device).evaluate(compressed_state)['map_50'].item()
+
+        speedup = baseline_latency / latency
+        print("fc6 rank:{} fc7 rank:{} head latency:{:.4f}s speedup:{:.2f}x map_50:{:.4f}".format(fc6_rank, fc7_rank, latency, speedup, map_50))
+
+        # the fastest candidate within the bounds
+        if baseline_map_50 - map_50 <= MAX_MAP_50_DROP and speedup >= MIN_HEAD_SPEEDUP:
+            if best is None or latency < best['latency']:
+                best = dict(fc6_rank=fc6_rank, fc7_rank=fc7_rank, latency=latency, map_50=map_50, state=compressed_state)
+
+    if best is None:
+        print(" [!] No candidate meets the bounds, the compressed model is not saved")
+        return
+
+    checkpoint = {
+        'faster_rcnn_model': best['state'],
+        'fc6_rank': best['fc6_rank'],
+        'fc7_rank': best['fc7_rank'],
+        'map_50': best['map_50'],
+        'baseline_map_50': baseline_map_50,
+        }
+    save_checkpoint(checkpoint, compressed_ckpt_path)
+    print(" [*] Compressed model with fc6 rank {} and fc7 rank {} saved to {}".format(best['fc6_rank'], best['fc7_rank'], compressed_ckpt_path))
+
+
+if __name__=="__main__":
+    torch.manual_seed(0)
+
+    test_config_path = work_folder+'/src/config/experiments/eval/eval1.yaml'
+    config = combine_configs(test_config_path)
+    test_voc_dataset = VOCDataset(config, split='test')
+
+    ckpt = load_checkpoint(config.PRETRAINED_MODEL.MODEL_PATH, map_location='cpu', load_best=True)
+    compressed_ckpt_path = os.path.join(config.PRETRAINED_MODEL.MODEL_PATH, 'compressed', 'compressed_model.ckpt')
+    compress(config, test_voc_dataset, ckpt, compressed_ckpt_path)
@@ -32,6 +32,7 @@ sys.path.append(work_folder+'/src/algorithm')
 sys.path.append(work_folder+'/src/config')
 sys.path.append(work_folder+'/src/data')
 sys.path.append(work_folder+'/src/tool')
+sys.path.append(work_folder+'/src/tool/metrics')
 
 import torch
 from faster_rcnn.faster_rcnn_evaluator import FasterRCNNEvaluator
@@ -41,6 +42,16 @@ from config import combine_configs
 from checkpoint_tool import load_checkpoint
 
 def evaluate_faster_rcnn(config, test_voc_dataset, device, ckpt):
+    if ckpt.get('quantized_head', False):
+        # the quantized checkpoint is loaded into a quantized model, which runs on cpu only
+        config = config.clone()
+        config.FASTER_RCNN.QUANTIZED_HEAD = True
+        device = 'cpu'
+    if ckpt.get('fc6_rank', 0) > 0 or ckpt.get('fc7_rank', 0) > 0:
+        # the compressed checkpoint is loaded into a model with the low-rank fc6 and fc7
+        config = config.clone()
+        config.FAST_RCNN.FC6_RANK = ckpt.get('fc6_rank', 0)
+        config.FAST_RCNN.FC7_RANK = ckpt.get('fc7_rank', 0)
     evaluator = FasterRCNNEvaluator(config,test_voc_dataset,device)
     map = evaluator.evaluate(ckpt['faster_rcnn_model'])
     return map
@@ -58,7 +69,10 @@ def test():
     test_voc_dataset = VOCDataset(config,split='test')
     device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
     
-    ckpt = load_checkpoint(config.PRETRAINED_MODEL.MODEL_PATH,load_best=True)
+    # only the model is needed, the optimizer and the scheduler states are not loaded
+    ckpt = load_checkpoint(config.PRETRAINED_MODEL.MODEL_PATH,
+                            load_best=True,
+                            keys=['faster_rcnn_model','quantized_head','fc6_rank','fc7_rank'])
     map = evaluate_faster_rcnn(config, test_voc_dataset, device, ckpt)
     return map
 
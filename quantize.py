@@ -0,0 +1,102 @@
+# #### BEGIN LICENSE BLOCK #####
+# MIT License
+#    
+# Copyright (c) 2021 Bin.Li (ornot2008@yahoo.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# #### END LICENSE BLOCK #####
+# /
+
+import sys
+import os
+
+work_folder= os.path.dirname(os.path.realpath(__file__))
+sys.path.append(work_folder+'/src/algorithm')
+sys.path.append(work_folder+'/src/config')
+sys.path.append(work_folder+'/src/data')
+sys.path.append(work_folder+'/src/tool')
+sys.path.append(work_folder+'/src/tool/metrics')
+
+import torch
+from faster_rcnn.faster_rcnn_evaluator import FasterRCNNEvaluator
+from faster_rcnn.faster_rcnn_network import FasterRCNN
+from voc_dataset import VOCDataset
+from config import combine_configs
+from checkpoint_tool import load_checkpoint, save_checkpoint
+from benchmark_tool import measure_latency
+
+# the max drop of map_50 accepted for the quantized model
+MAX_MAP_50_DROP = 0.01
+
+def benchmark_head(faster_rcnn, config):
+    # the feature of a 600x800 image and N_POST_NMS random proposals 
+    feature = torch.randn(1, config.FAST_RCNN.IN_CHANNELS, 38, 50)
+    n_rois = config.RPN.PROPOSAL_CREATOR.N_POST_NMS
+    top_left = torch.rand(n_rois, 2) * 400
+    rois = torch.cat([top_left, top_left + 32 + torch.rand(n_rois, 2) * 200], dim=1)
+    return measure_latency(faster_rcnn.fast_rcnn.predict, feature, rois)
+
+def quantize(config, test_voc_dataset, ckpt, quantized_ckpt_path):
+    # the quantized head runs on cpu only, so does the fp32 baseline
+    device = 'cpu'
+
+    faster_rcnn = FasterRCNN(config, device)
+    faster_rcnn.load_state_dict(ckpt['faster_rcnn_model'])
+    faster_rcnn.eval()
+    fp32_latency = benchmark_head(faster_rcnn, config)
+    fp32_map = FasterRCNNEvaluator(config, test_voc_dataset, device).evaluate(ckpt['faster_rcnn_model'])
+
+    faster_rcnn.quantize_head()
+    int8_latency = benchmark_head(faster_rcnn, config)
+    quantized_state = faster_rcnn.state_dict()
+
+    quantized_config = config.clone()
+    quantized_config.FASTER_RCNN.QUANTIZED_HEAD = True
+    int8_map = FasterRCNNEvaluator(quantized_config, test_voc_dataset, device).evaluate(quantized_state)
+
+    print("head latency fp32:{:.4f}s int8:{:.4f}s speedup:{:.2f}x".format(fp32_latency, int8_latency, fp32_latency/int8_latency))
+    print("map fp32:{:.4f} int8:{:.4f}".format(fp32_map['map'].item(), int8_map['map'].item()))
+    print("map_50 fp32:{:.4f} int8:{:.4f}".format(fp32_map['map_50'].item(), int8_map['map_50'].item()))
+
+    map_50_drop = fp32_map['map_50'].item() - int8_map['map_50'].item()
+    if map_50_drop > MAX_MAP_50_DROP:
+        print(" [!] map_50 drops by {:.4f}, the quantized model is not saved".format(map_50_drop))
+        return
+
+    checkpoint = {
+        'faster_rcnn_model': quantized_state,
+        'quantized_head': True,
+        'map_50': int8_map['map_50'].item(),
+        'fp32_map_50': fp32_map['map_50'].item(),
+        }
+    save_checkpoint(checkpoint, quantized_ckpt_path)
+    print(" [*] Quantized model saved to {}".format(quantized_ckpt_path))
+
+
+if __name__=="__main__":
+    torch.manual_seed(0)
+
+    test_config_path = work_folder+'/src/config/experiments/eval/eval1.yaml'
+    config = combine_configs(test_config_path)
+    test_voc_dataset = VOCDataset(config, split='test')
+
+    ckpt = load_checkpoint(config.PRETRAINED_MODEL.MODEL_PATH, map_location='cpu', load_best=True)
+    quantized_ckpt_path = os.path.join(config.PRETRAINED_MODEL.MODEL_PATH, 'quantized', 'quantized_model.ckpt')
+    quantize(config, test_voc_dataset, ckpt, quantized_ckpt_path)
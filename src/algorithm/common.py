@@ -24,8 +24,11 @@
 # #### END LICENSE BLOCK #####
 # /
 
+import contextlib
+
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 class CNNBlock(nn.Module):
     def __init__(self, 
@@ -55,10 +58,18 @@ class FCBlock(nn.Module):
     def __init__(self, 
                 in_features:int,
                 out_features:int, 
-                relu:bool=True):
+                relu:bool=True,
+                rank:int=0):
+        """
+            Args:
+                in_features (int): number of input features
+                out_features (int): number of output features
+                relu (bool): whether to use relu
+                rank (int): rank of the low-rank factored linear, 0 for a full linear
+        """
 
         super().__init__()
-        self.fc = nn.Linear(in_features, out_features)
+        self.fc = low_rank_linear(in_features, out_features, rank) if rank > 0 else nn.Linear(in_features, out_features)
         self.relu = nn.ReLU(inplace=True) if relu else None
 
     def forward(self, x:torch.Tensor):
@@ -67,6 +78,29 @@ class FCBlock(nn.Module):
             x = self.relu(x)
         return x
 
+    def compress(self, rank:int):
+        """Factor the linear into two low-rank linears by the truncated SVD of its weight.
+
+        Args:
+            rank (int): rank of the factorization
+        """
+        if not isinstance(self.fc, nn.Linear):
+            raise ValueError('The linear of the block is already factored')
+
+        weight = self.fc.weight.data
+        u, s, vh = torch.linalg.svd(weight, full_matrices=False)
+
+        low_rank_fc = low_rank_linear(self.fc.in_features, self.fc.out_features, rank).to(weight.device)
+        low_rank_fc[0].weight.data.copy_(s[:rank, None] * vh[:rank])
+        low_rank_fc[1].weight.data.copy_(u[:, :rank])
+        low_rank_fc[1].bias.data.copy_(self.fc.bias.data)
+        self.fc = low_rank_fc
+
+def low_rank_linear(in_features:int, out_features:int, rank:int)->nn.Sequential:
+    """A linear whose weight is factored as [out_features,rank] x [rank,in_features]."""
+    return nn.Sequential(nn.Linear(in_features, rank, bias=False),
+                        nn.Linear(rank, out_features))
+
 def weights_normal_init(model, dev=0.01):
     if isinstance(model, list):
         for m in model:
@@ -81,3 +115,70 @@ def weights_normal_init(model, dev=0.01):
             elif isinstance(m, nn.Linear):
                 m.weight.data.normal_(0.0, dev)
 
+
+def to_indices_and_rois(feature:torch.Tensor,rois):
+    """Convert the rois into the (batch_index,x1,y1,x2,y2) format of the torchvision roi ops, so that
+    the rois of all of the images in a batch are pooled at once.
+
+    Args:
+        feature (torch.Tensor): [C,H,W] for a single image or [B,C,H,W] for a batch
+        rois: one of 
+                [K,4] tensor, (y1,x1,y2,x2) rois of a single image,
+                list of [K_i,4] tensors, the rois of each image in the batch,
+                [K,5] tensor, (batch_index,y1,x1,y2,x2) rois
+
+    Returns:
+        feature (torch.Tensor): [B,C,H,W]
+        xy_indices_and_rois (torch.Tensor): [K,5]
+    """
+    if feature.dim() == 3:
+        feature = feature.unsqueeze(0)
+
+    if isinstance(rois,(list,tuple)):
+        roi_indices = torch.cat([torch.full((len(rois_of_img),),image_index,dtype=rois_of_img.dtype,device=rois_of_img.device) 
+                                    for image_index,rois_of_img in enumerate(rois)])
+        indices_and_rois = torch.cat([roi_indices[:, None], torch.cat(rois)], dim=1)
+    elif rois.shape[1] == 4:
+        roi_indices = torch.zeros(len(rois),dtype=rois.dtype,device=rois.device)
+        indices_and_rois = torch.cat([roi_indices[:, None], rois], dim=1)
+    else:
+        indices_and_rois = rois
+
+    xy_indices_and_rois = indices_and_rois[:, [0, 2, 1, 4, 3]]
+    xy_indices_and_rois = xy_indices_and_rois.contiguous()
+
+    return feature,xy_indices_and_rois
+
+def checkpoint_function(function, x:torch.Tensor):
+    """Run a function with activation checkpointing: only its input is kept for backward and its 
+    activations are recomputed during backward. Note the batch norm layers in the function update 
+    their running stats once more in the recomputation.
+
+    Args:
+        function: module or function to run
+        x (torch.Tensor): input of the function
+    """
+    # the non-reentrant checkpoint backpropagates into the parameters whether the input requires grad or not
+    return checkpoint(function, x, use_reentrant=False)
+
+def checkpoint_sequence(functions, x:torch.Tensor)->torch.Tensor:
+    """Run the functions one after another, each of them with activation checkpointing, so only
+    the inputs of the functions are kept for backward.
+    """
+    for function in functions:
+        x = checkpoint_function(function, x)
+    return x
+
+def mixed_precision(precision:str, device):
+    """Context the convs and linears of the model run in.
+
+    Args:
+        precision (str): 'fp32' to run everything in fp32, 'bf16' to run the convs and linears in 
+                         bfloat16 by autocast, which needs no loss scaling as bfloat16 has the range of fp32
+        device: device the model runs on
+    """
+    if precision == 'fp32':
+        return contextlib.nullcontext()
+    if precision == 'bf16':
+        return torch.autocast(device_type=torch.device(device).type,dtype=torch.bfloat16)
+    raise ValueError('Unknown precision {}'.format(precision))
@@ -31,7 +31,7 @@ import torch.nn as nn
 from torchvision.ops import RoIPool
 from torchvision.ops import RoIAlign
 
-from common import FCBlock, weights_normal_init
+from common import FCBlock, to_indices_and_rois, weights_normal_init
 
 class FastRCNN(nn.Module):
     def __init__(self, config,device='cpu'):
@@ -43,8 +43,8 @@ class FastRCNN(nn.Module):
         
         self.roi_pool = RoIAlign((config.FAST_RCNN.ROI_SIZE,config.FAST_RCNN.ROI_SIZE),config.FAST_RCNN.SPATIAL_SCALE,sampling_ratio=2)
         
-        self.fc6 = FCBlock(config.FAST_RCNN.IN_CHANNELS*config.FAST_RCNN.ROI_SIZE*config.FAST_RCNN.ROI_SIZE,config.FAST_RCNN.FC7_CHANNELS)
-        self.fc7 = FCBlock(config.FAST_RCNN.FC7_CHANNELS, config.FAST_RCNN.FC7_CHANNELS)
+        self.fc6 = FCBlock(config.FAST_RCNN.IN_CHANNELS*config.FAST_RCNN.ROI_SIZE*config.FAST_RCNN.ROI_SIZE,config.FAST_RCNN.FC7_CHANNELS,rank=config.FAST_RCNN.FC6_RANK)
+        self.fc7 = FCBlock(config.FAST_RCNN.FC7_CHANNELS, config.FAST_RCNN.FC7_CHANNELS,rank=config.FAST_RCNN.FC7_RANK)
         
         self.offset = nn.Linear(config.FAST_RCNN.FC7_CHANNELS,(self.n_classes+1) * 4)
         self.score = nn.Linear(config.FAST_RCNN.FC7_CHANNELS, self.n_classes+1)
@@ -55,12 +55,20 @@ class FastRCNN(nn.Module):
         weights_normal_init(self.score,0.01)
 
     def forward(self,feature,rois):
-        roi_indices = torch.zeros(len(rois),device=feature.device)
-        indices_and_rois = torch.cat([roi_indices[:, None], rois], dim=1)
-        xy_indices_and_rois = indices_and_rois[:, [0, 2, 1, 4, 3]]
-        xy_indices_and_rois = xy_indices_and_rois.contiguous()
+        """
+        Args:
+            feature (torch.Tensor): [C,H,W] or [B,C,H,W]
+            rois: [K,4] rois of a single image, list of the [K_i,4] rois of each image or [K,5] rois 
+                  with the batch indices, see common.to_indices_and_rois
 
-        pool = self.roi_pool(feature.unsqueeze(0) ,xy_indices_and_rois)
+        Returns:
+            roi_scores (torch.Tensor): [K,n_classes+1], in the same order as the rois
+            roi_offsets (torch.Tensor): [K,(n_classes+1)*4]
+        """
+        feature,xy_indices_and_rois = to_indices_and_rois(feature,rois)
+
+        # the rois are pooled in fp32 under the mixed precision
+        pool = self.roi_pool(feature.float(),xy_indices_and_rois)
         pool = pool.view(pool.size(0), -1)
         fc6 = self.fc6(pool)
         fc7 = self.fc7(fc6)
@@ -69,6 +77,19 @@ class FastRCNN(nn.Module):
 
         return roi_scores,roi_offsets 
     
+    def compress(self,fc6_rank,fc7_rank):
+        """Factor fc6 and fc7 into two low-rank linears each by the truncated SVD. The compressed 
+        model is loaded by setting FAST_RCNN.FC6_RANK and FAST_RCNN.FC7_RANK to the ranks.
+
+        Args:
+            fc6_rank (int): rank of fc6, 0 to keep it
+            fc7_rank (int): rank of fc7, 0 to keep it
+        """
+        if fc6_rank > 0:
+            self.fc6.compress(fc6_rank)
+        if fc7_rank > 0:
+            self.fc7.compress(fc7_rank)
+
     def predict(self,feature,rois):
         return  self.forward(feature,rois)
     
\ No newline at end of file
@@ -24,14 +24,21 @@
 # #### END LICENSE BLOCK #####
 # /
 
+from contextlib import contextmanager
+
 from tqdm import tqdm
 
 from torch.utils.data.dataset import Dataset
 import torch
 from torch.types import Device
 from torch.utils.data.dataloader import DataLoader
-from torchmetrics.detection.map import MAP
-from yacs.config import CfgNode 
+from torch.utils.data.sampler import SequentialSampler
+from yacs.config import CfgNode
+from distributed_tool import ShardSampler, all_gather_objects, is_distributed
+from map_accumulator import MAPAccumulator
+from prediction_cache_tool import PredictionCache, state_dict_hash
+from rpn.proposal_creator import ProposalCreator
+from grouped_batch_sampler import GroupedBatchSampler, create_shape_groups 
 
 from faster_rcnn.faster_rcnn_network import FasterRCNN
 
@@ -41,46 +48,138 @@ class FasterRCNNEvaluator(object):
     def __init__(self,
                 config:CfgNode,
                 dataset:Dataset,
-                device:Device='cpu') -> None:
+                device:Device='cpu',
+                model:FasterRCNN=None) -> None:
+        """
+        Args:
+            model (FasterRCNN): model to evaluate, e.g. the model being trained, which is run in eval 
+                                mode with the eval config and restored afterwards. None to create a 
+                                model of the evaluator, into which the states to evaluate are loaded
+        """
 
         self.config = config
         self.device = device
         
-        self.dataloader = DataLoader(dataset,batch_size=1,shuffle=False,num_workers=8)    
-        self.eval_faster_rcnn = FasterRCNN(config,device)
+        # every process of a distributed run evaluates its own part of the dataset
+        self.distributed = is_distributed()
+        sampler = ShardSampler(dataset) if self.distributed else SequentialSampler(dataset)
+        # the ids of the images this process evaluates, in the order of the dataloader
+        self.image_ids = [dataset.ids[index] for index in sampler]
+        batch_sampler = GroupedBatchSampler(sampler,
+                                            create_shape_groups(dataset,config.VOC_DATASET.BATCH_SHAPE_QUANTUM),
+                                            config.FASTER_RCNN.BATCH_SIZE,
+                                            fill_incomplete=False)
+        self.dataloader = DataLoader(dataset,
+                                    batch_sampler=batch_sampler,
+                                    num_workers=config.FASTER_RCNN.NUM_WORKERS,
+                                    collate_fn=dataset.collate)    
+        self.eval_faster_rcnn = model if model is not None else FasterRCNN(config,device)
+        # the weights of a model shared with the trainer change between the evaluations
+        self.shared_model = model is not None
+        # state_dict_hash of the loaded weights for the prediction cache, None for no cache
+        self.weights_hash = None
+        # the model shared with the trainer runs with the proposal creator of the eval config
+        self.proposal_creator = ProposalCreator(config)
+
+        self.metric = MAPAccumulator()
+
+    def evaluate(self,model_states=None):
+        """
+        Args:
+            model_states (dict): states loaded into the model before the evaluation, None to 
+                                 evaluate the model as it is. Only the predictions of the loaded 
+                                 states are cached in TEST.PREDICTION_CACHE_DIR
+
+        Returns:
+            the metrics over the dataset
+        """
+        if model_states is not None:
+            self.eval_faster_rcnn.load_state_dict(model_states)
+            # the weights are hashed once per loaded checkpoint rather than per evaluation
+            if self.config.TEST.PREDICTION_CACHE_DIR is not None:
+                self.weights_hash = state_dict_hash(self.eval_faster_rcnn.state_dict())
+        elif self.shared_model:
+            self.weights_hash = None
+
+        with self._evaluation_mode():
+            return self._evaluate()
 
-        self.metric = MAP()
+    @contextmanager
+    def _evaluation_mode(self):
+        """Runs the model in eval mode with the eval config, the modes of its modules (e.g. of the 
+        batch norms and the dropouts) and its config are restored afterwards.
+        """
+        model = self.eval_faster_rcnn
+        modes = [(module,module.training) for module in model.modules()]
+        config,precision,proposal_creator = model.config,model.precision,model.proposal_creator
 
-    def evaluate(self,model_states):    
+        model.eval()
+        model.config = self.config
+        model.precision = self.config.FASTER_RCNN.PRECISION
+        model.proposal_creator = self.proposal_creator
+        try:
+            yield
+        finally:
+            for module,training in modes:
+                module.training = training
+            model.config,model.precision,model.proposal_creator = config,precision,proposal_creator
+
+    def _evaluate(self):
         self.metric.reset()
-        
-        self.eval_faster_rcnn.load_state_dict(model_states)
 
-        for _,(images_batch,bboxes_batch,labels_batch,_,img_id,_) in tqdm(enumerate(self.dataloader)):
+        cache = None
+        if self.config.TEST.PREDICTION_CACHE_DIR is not None and self.weights_hash is not None:
+            cache = PredictionCache(self.config.TEST.PREDICTION_CACHE_DIR,self.weights_hash,self.config)
+
+        if cache is not None and cache.contains(self.image_ids):
+            # only the suppression is run again, with the thresholds of this config
+            for img_id in tqdm(self.image_ids):
+                entry = cache.load(img_id,map_location=self.device)
+                pred_bboxes,pred_labels,pred_scores = self.eval_faster_rcnn.suppress(entry)
+                self._update_metric(pred_bboxes,pred_labels,pred_scores,entry['gt_bboxes'],entry['gt_labels'])
+        else:
+            self._predict(cache)
+
+        # every process computes the metric over the accumulators of all of the parts
+        if self.distributed:
+            metric = MAPAccumulator()
+            for part_metric in all_gather_objects([self.metric]):
+                metric.merge(part_metric)
+            return metric.compute()
+
+        return self.metric.compute()
+
+    def _predict(self,cache:PredictionCache=None):
+        """Runs the model over the dataset and updates the metric, the raw predictions are saved into 
+        the cache if there is one.
+        """
+        for _,(images_batch,bboxes_batch,labels_batch,_,img_id,_,image_sizes,n_objects) in tqdm(enumerate(self.dataloader)):
             
             images_batch,bboxes_batch,labels_batch = images_batch.to(self.device),bboxes_batch.to(self.device),labels_batch.to(self.device)
             with torch.no_grad():
-                predicted_bboxes_batch,predicted_labels_batch, predicted_scores_batch= self.eval_faster_rcnn.predict(images_batch.float())
+                raw_batch = self.eval_faster_rcnn.predict_raw(images_batch,image_sizes)
                 
-            for img_idx in range(len(images_batch)):
-                pred_bboxes= predicted_bboxes_batch[img_idx]
-                pred_scores = predicted_scores_batch[img_idx]
-                pred_labels = predicted_labels_batch[img_idx]
-                gt_bboxes = bboxes_batch[img_idx]
-                gt_labels = labels_batch[img_idx]
-
-                single_image_predict = [dict(
-                                            # convert yxyx to xyxy
-                                            boxes = pred_bboxes[:,[1,0,3,2]].float(),
-                                            scores = pred_scores,
-                                            labels = pred_labels,
-                                            )]
-            
-                single_image_gt = [dict(boxes = gt_bboxes[:,[1,0,3,2]],
-                                        labels = gt_labels,
-                                        )]
+            for img_idx,raw in enumerate(raw_batch):
+                n_gt = n_objects[img_idx].item()
+                gt_bboxes = bboxes_batch[img_idx,:n_gt]
+                gt_labels = labels_batch[img_idx,:n_gt]
+                if cache is not None:
+                    cache.save(img_id[img_idx],dict(raw,gt_bboxes=gt_bboxes,gt_labels=gt_labels))
 
-                self.metric.update(single_image_predict,single_image_gt)
-                
-        return self.metric.compute()
+                pred_bboxes,pred_labels,pred_scores = self.eval_faster_rcnn.suppress(raw)
+                self._update_metric(pred_bboxes,pred_labels,pred_scores,gt_bboxes,gt_labels)
+
+    def _update_metric(self,pred_bboxes,pred_labels,pred_scores,gt_bboxes,gt_labels):
+        single_image_predict = [dict(
+                                    # convert yxyx to xyxy
+                                    boxes = pred_bboxes[:,[1,0,3,2]].float(),
+                                    scores = pred_scores,
+                                    labels = pred_labels,
+                                    )]
+    
+        single_image_gt = [dict(boxes = gt_bboxes[:,[1,0,3,2]],
+                                labels = gt_labels,
+                                )]
+
+        self.metric.update(single_image_predict,single_image_gt)
                         
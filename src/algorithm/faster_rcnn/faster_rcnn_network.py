@@ -31,7 +31,6 @@ from torch import nn
 from torch.nn import functional as F
 from torch.types import Device
 from torch.utils.tensorboard.writer import SummaryWriter
-from torchvision.ops import nms
 from yacs.config import CfgNode
 
 from fast_rcnn.fast_rcnn_network import FastRCNN
@@ -39,7 +38,9 @@ from feature_extractor import FeatureExtractorFactory
 from rpn.anchor_creator import AnchorCreator
 from rpn.proposal_creator import ProposalCreator
 from rpn.region_proposal_network import RPN
+from common import mixed_precision
 from location_utility import LocationUtility
+from nms import get_nms
 
 class FasterRCNN(nn.Module):
     #*******************************************************************************
@@ -63,8 +64,14 @@ class FasterRCNN(nn.Module):
         super().__init__()
         self.config = config
         self.device = device
+        self.precision = config.FASTER_RCNN.PRECISION
         self.feature_extractor = FeatureExtractorFactory.create_feature_extractor(config.FASTER_RCNN.FEATRUE_EXTRACTOR).to(device)
+        if config.FASTER_RCNN.FOLD_NORMALIZATION:
+            self.feature_extractor.fold_input_normalization()
         self.rpn = RPN(config).to(device)
+        if config.FASTER_RCNN.GRADIENT_CHECKPOINTING:
+            self.feature_extractor.gradient_checkpointing = True
+            self.rpn.gradient_checkpointing = True
         self.fast_rcnn = FastRCNN(config).to(device)
         self.n_class = self.fast_rcnn.n_classes
         self.anchor_creator = AnchorCreator(config,device=device)
@@ -72,23 +79,47 @@ class FasterRCNN(nn.Module):
         self.offset_norm_mean = torch.tensor(config.FASTER_RCNN.OFFSET_NORM_MEAN).to(device)
         self.offset_norm_std =  torch.tensor(config.FASTER_RCNN.OFFSET_NORM_STD).to(device)
 
-    def predict(self,image_batch:torch.Tensor):
+        self.head_quantized = False
+        if config.FASTER_RCNN.QUANTIZED_HEAD:
+            self.quantize_head()
+
+    def quantize_head(self):
+        """Swap the linears of the fast rcnn head (fc6, fc7, score and offset) for the dynamically 
+        quantized int8 ones. The weights are quantized once here and the activations are quantized on 
+        the fly, so no calibration data is needed. The quantized head runs on cpu only and is not trainable.
+
+        The state dict of the quantized model can only be loaded into a quantized model, so a quantized 
+        checkpoint is loaded by creating the model with FASTER_RCNN.QUANTIZED_HEAD set.
+        """
+        if self.head_quantized:
+            return
+
+        if torch.device(self.device).type != 'cpu':
+            raise ValueError('The quantized head runs on cpu only, but the device is {}'.format(self.device))
+
+        self.fast_rcnn = torch.quantization.quantize_dynamic(self.fast_rcnn,{nn.Linear},dtype=torch.qint8)
+        self.head_quantized = True
+
+    def predict(self,image_batch:torch.Tensor,image_sizes:torch.Tensor=None):
         """A explict interface for predict rahter than forward
 
         Args:
             image_batch (torch.Tensor): [batch_size,3,height,width]
+            image_sizes (torch.Tensor): [batch_size,2], see forward
 
         Returns:
             return forward result
         """
-        return self.forward(image_batch)
+        return self.forward(image_batch,image_sizes)
 
         
-    def forward(self,image_batch):
+    def forward(self,image_batch,image_sizes=None):
         """ A forward interface for faster rcnn
         
         Args:
             image_batch (torch.Tensor): [batch_size,3,height,width]
+            image_sizes (torch.Tensor): [batch_size,2], (height,width) of the images before 
+                                        they were padded into the batch, None if not padded
         
         returns:
             return a dict contains:
@@ -97,16 +128,93 @@ class FasterRCNN(nn.Module):
                 'scores': [batch_size,n_bboxes]
 
         """
+        bboxes_batch = list()
+        labels_batch = list()
+        scores_batch = list()
+        for raw in self.predict_raw(image_batch,image_sizes):
+            bboxes, labels, scores = self.suppress(raw)
+            bboxes_batch.append(bboxes)
+            labels_batch.append(labels)
+            scores_batch.append(scores)
 
-        feature_batch= self.feature_extractor.predict(image_batch)
-        rpn_predicted_score_batch ,rpn_predicted_offset_batch = self.rpn.predict(feature_batch)
-        
+        return bboxes_batch,labels_batch,scores_batch
+
+    def detect(self,
+                image_batch:torch.Tensor,
+                score_threshold:float,
+                nms_threshold:float,
+                max_detections:int=0,
+                image_sizes:torch.Tensor=None):
+        """Detects the objects in the images with the given thresholds rather than the ones of the config.
+
+        Args:
+            image_batch (torch.Tensor): [batch_size,3,height,width]
+            score_threshold (float): threshold for score
+            nms_threshold (float): threshold for nms
+            max_detections (int): max number of the bboxes to keep per image, 0 for all of them
+            image_sizes (torch.Tensor): [batch_size,2], see forward
+
+        Returns:
+            bboxes, labels and scores of each image
+        """
         bboxes_batch = list()
         labels_batch = list()
         scores_batch = list()
+        for raw in self.predict_raw(image_batch,image_sizes):
+            bboxes, labels, scores = self._suppress(raw['bboxes'],raw['probs'],score_threshold,nms_threshold,max_detections)
+            bboxes_batch.append(bboxes)
+            labels_batch.append(labels)
+            scores_batch.append(scores)
+
+        return bboxes_batch,labels_batch,scores_batch
+
+    def suppress(self,raw:dict):
+        """Suppresses the raw predictions of an image with the thresholds of the config.
+
+        Args:
+            raw (dict): the raw predictions of an image, see predict_raw
+
+        Returns:
+            bboxes (torch.Tensor): [n_bboxes,4]
+            labels (torch.Tensor): [n_bboxes,]
+            scores (torch.Tensor): [n_bboxes,]
+        """
+        return self._suppress(raw['bboxes'],
+                            raw['probs'],
+                            self.config.FASTER_RCNN.SCORE_THRESHOLD,
+                            self.config.FASTER_RCNN.NMS_THRESHOLD,
+                            self.config.FASTER_RCNN.MAX_DETECTIONS)
+
+    def predict_raw(self,image_batch,image_sizes=None):
+        """Runs the network up to the suppression, e.g. for the prediction cache of the evaluators, 
+        whose detections are suppressed again with other thresholds without running the network.
+
+        Args:
+            image_batch (torch.Tensor): [batch_size,3,height,width]
+            image_sizes (torch.Tensor): [batch_size,2], see forward
 
+        Returns:
+            list: a dict per image of
+                'rois': [n_rois,4], the proposed roi bboxes
+                'bboxes': [n_rois,(n_class+1)*4], the decoded bboxes of every class
+                'probs': [n_rois,n_class+1], the class probabilities
+        """
+
+        with mixed_precision(self.precision,image_batch.device):
+            feature_batch= self.feature_extractor.predict(image_batch)
+            rpn_predicted_score_batch ,rpn_predicted_offset_batch = self.rpn.predict(feature_batch)
+
+        # the proposals are decoded in fp32
+        rpn_predicted_score_batch = rpn_predicted_score_batch.float()
+        rpn_predicted_offset_batch = rpn_predicted_offset_batch.float()
+        
+        img_sizes = list()
+        proposed_roi_bboxes_batch = list()
         for image_index in range(len(image_batch)):
-            img_height, img_width = image_batch[image_index].shape[1:]
+            if image_sizes is None:
+                img_height, img_width = image_batch[image_index].shape[1:]
+            else:
+                img_height, img_width = image_sizes[image_index].tolist()
             feature = feature_batch[image_index]
             feature_height,feature_width = feature.shape[1:]
             rpn_predicted_scores = rpn_predicted_score_batch[image_index]
@@ -120,97 +228,99 @@ class FasterRCNN(nn.Module):
                                                                 img_width,
                                                                 feature_height,
                                                                 feature_width)
+            img_sizes.append((img_height,img_width))
+            proposed_roi_bboxes_batch.append(proposed_roi_bboxes)
 
-            bboxes ,labels, scores = self.detect(feature, 
-                                                proposed_roi_bboxes, 
-                                                img_height, 
-                                                img_width,
-                                                self.config.FASTER_RCNN.SCORE_THRESHOLD,
-                                                self.config.FASTER_RCNN.NMS_THRESHOLD)
-            
-            bboxes_batch.append(bboxes)
-            labels_batch.append(labels)
-            scores_batch.append(scores)
-            
-        return bboxes_batch,labels_batch,scores_batch
+        # the head runs once for the rois of all of the images
+        with mixed_precision(self.precision,image_batch.device):
+            predicted_roi_score_batch,predicted_roi_offset_batch = self.fast_rcnn.predict(feature_batch,proposed_roi_bboxes_batch)
+        n_rois = [len(proposed_roi_bboxes) for proposed_roi_bboxes in proposed_roi_bboxes_batch]
+        predicted_roi_score_batch = predicted_roi_score_batch.split(n_rois)
+        predicted_roi_offset_batch = predicted_roi_offset_batch.split(n_rois)
 
-    def detect(self, 
-                feature:torch.Tensor, 
+        raw_batch = list()
+        for image_index,(img_height,img_width) in enumerate(img_sizes):
+            predicted_roi_bboxes,prob = self._decode(proposed_roi_bboxes_batch[image_index],
+                                                    predicted_roi_score_batch[image_index],
+                                                    predicted_roi_offset_batch[image_index],
+                                                    img_height,
+                                                    img_width)
+            raw_batch.append(dict(rois=proposed_roi_bboxes_batch[image_index],bboxes=predicted_roi_bboxes,probs=prob))
+
+        return raw_batch
+
+    def _decode(self,
                 proposed_roi_bboxes:torch.Tensor,
+                predicted_roi_score:torch.Tensor,
+                predicted_roi_offset:torch.Tensor,
                 img_height:int,
-                img_width:int,
-                score_threshold:float,
-                nms_threshold:float):
-        """
+                img_width:int):
+        """Decode the predicted offsets of the rois of an image into the bboxes of every class.
+
         Args:
-            feature (torch.Tensor): [C,H,W]
-            proposed_roi_bboxes (torch.Tensor): [n_bboxes,4]
+            proposed_roi_bboxes (torch.Tensor): [n_rois,4]
+            predicted_roi_score (torch.Tensor): [n_rois,n_class+1]
+            predicted_roi_offset (torch.Tensor): [n_rois,(n_class+1)*4]
             img_height (int): height of image
             img_width (int): width of image
-            score_threshold (float): threshold for score
-            nms_threshold (float): threshold for nms
 
         Returns:
-            bboxes (torch.Tensor): [n_bboxes,4]
-            labels (torch.Tensor): [n_bboxes,]
-            scores (torch.Tensor): [n_bboxes,]
+            bboxes (torch.Tensor): [n_rois,(n_class+1)*4]
+            probs (torch.Tensor): [n_rois,n_class+1]
         """
-
-        predicted_roi_score,predicted_roi_loc= self.fast_rcnn.predict(feature,proposed_roi_bboxes)
+        # the bboxes are decoded and suppressed in fp32
+        predicted_roi_score = predicted_roi_score.float()
+        predicted_roi_offset = predicted_roi_offset.float()
 
         mean = self.offset_norm_mean.repeat(self.n_class+1)[None]
         std  = self.offset_norm_std.repeat(self.n_class+1)[None]
 
-        predicted_roi_loc = predicted_roi_loc * std + mean
+        predicted_roi_offset = predicted_roi_offset * std + mean
 
         
         
         # post processing 
-        predicted_roi_bboxes = LocationUtility.offset2bbox(proposed_roi_bboxes,predicted_roi_loc)
+        predicted_roi_bboxes = LocationUtility.offset2bbox(proposed_roi_bboxes,predicted_roi_offset)
             
         predicted_roi_bboxes[:,0::2] =(predicted_roi_bboxes[:,0::2]).clamp(min=0,max=img_height)
         predicted_roi_bboxes[:,1::2] =(predicted_roi_bboxes[:,1::2]).clamp(min=0,max=img_width)
 
         prob = F.softmax(predicted_roi_score,dim=1)
 
-        bboxes,labels, scores= self._suppress(predicted_roi_bboxes, 
-                                                    prob,
-                                                    score_threshold,
-                                                    nms_threshold)
-                                                
-        return bboxes,labels,scores
-
-    def _suppress(self, predicted_roi_bboxes, predicted_prob,score_threshold,nms_threshold):
-        bboxes = list()
-        labels = list()
-        scores = list()
-
-        for class_index in range(1, self.n_class+1):
-            cls_bbox = predicted_roi_bboxes.reshape((-1, self.n_class+1, 4))[:, class_index, :]
-            class_prob = predicted_prob[:, class_index]
-            
-            # for current class, keep the top-K bboxes with highest scores
-            mask = class_prob > score_threshold
-            cls_bbox = cls_bbox[mask]
-            class_prob = class_prob[mask]
-            
-            keep = nms(cls_bbox[:,[1,0,3,2]],class_prob,nms_threshold)
-            
-            # keep top-K bboxes only if there is at least one bbox left for current class
-            if keep.shape[0] > 0:
-                bboxes.append(cls_bbox[keep])
-                labels.append(((class_index) * torch.ones((len(keep),),dtype=torch.int32)).to(self.device))
-                scores.append(class_prob[keep])
-        
-        #  concatenate all bboxes and scores only if there is at least one bbox left for 
-        #  any class, elsewise return empty tensors
-        if len(bboxes) > 0:
-            bboxes = torch.cat(bboxes, dim=0).to(self.device)
-            labels = torch.cat(labels, dim=0).to(self.device)
-            scores = torch.cat(scores, dim=0).to(self.device)
-        else:
-            bboxes = torch.empty((0, 4),device=self.device)
-            labels = torch.empty((0,), device=self.device)
-            scores = torch.empty((0,), device=self.device)
-
-        return bboxes,labels, scores 
\ No newline at end of file
+        return predicted_roi_bboxes,prob
+
+    def _suppress(self, predicted_roi_bboxes, predicted_prob,score_threshold,nms_threshold,max_detections=0):
+        """Class-wise nms for all of the classes at once, by the nms method of FASTER_RCNN.NMS_METHOD.
+
+        Args:
+            predicted_roi_bboxes (torch.Tensor): [n_rois,(n_class+1)*4]
+            predicted_prob (torch.Tensor): [n_rois,n_class+1]
+            score_threshold (float): threshold for score
+            nms_threshold (float): threshold for nms
+            max_detections (int): max number of the bboxes to keep, 0 for all of them
+
+        Returns:
+            bboxes (torch.Tensor): [n_bboxes,4], sorted by score from highest to lowest
+            labels (torch.Tensor): [n_bboxes,]
+            scores (torch.Tensor): [n_bboxes,]
+        """
+        # skip the background class
+        cls_bboxes = predicted_roi_bboxes.reshape((-1, self.n_class+1, 4))[:, 1:, :]
+        cls_prob = predicted_prob[:, 1:]
+
+        roi_indices,class_indices = torch.where(cls_prob > score_threshold)
+        bboxes = cls_bboxes[roi_indices,class_indices]
+        scores = cls_prob[roi_indices,class_indices]
+        labels = (class_indices + 1).to(torch.int32)
+
+        if bboxes.shape[0] == 0:
+            return bboxes,labels,scores
+
+        suppress = get_nms(self.config.FASTER_RCNN.NMS_METHOD,class_aware=True)
+        keep,scores = suppress(bboxes,scores,labels,nms_threshold,score_threshold,self.config.FASTER_RCNN.NMS_SIGMA)
+
+        if max_detections > 0:
+            keep = keep[:max_detections]
+            scores = scores[:max_detections]
+
+        return bboxes[keep],labels[keep],scores 
\ No newline at end of file
@@ -27,13 +27,27 @@
 
 import torch
 import torch.nn as nn
+from torch.nn import functional as F
 from torchvision.models import vgg16, resnet
 from torchvision.ops import misc
 from torchvision import transforms as T
 
-from common import CNNBlock
+from common import CNNBlock, checkpoint_sequence
 
-class VGG16FeatureExtractor(nn.Module):
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+class FeatureExtractor(nn.Module):
+    """Base of the feature extractors."""
+
+    def fold_input_normalization(self):
+        """Fold the input normalization into the first conv, which only the extractors taking the 
+        normalized ImageNet inputs (i.e. the pretrained vgg16) support.
+        """
+        raise ValueError('{} does not support folding the input normalization, set FOLD_NORMALIZATION '
+                        'with the pretrained_vgg16 feature extractor only'.format(type(self).__name__))
+
+class VGG16FeatureExtractor(FeatureExtractor):
     def __init__(self, 
                 img_channels:int =3, 
                 feature_channels:int =512, 
@@ -70,6 +84,9 @@ class VGG16FeatureExtractor(nn.Module):
                                     CNNBlock(512, 512, 3, same_padding=True, bn=bn),
                                     CNNBlock(512, feature_channels, 3, same_padding=True, bn=bn))
 
+        # recompute the activations of the conv blocks in backward rather than keeping them
+        self.gradient_checkpointing = False
+
     def forward(self, im_data:torch.Tensor)->torch.Tensor:
         """extract feature maps
 
@@ -81,7 +98,11 @@ class VGG16FeatureExtractor(nn.Module):
         """
 
         assert im_data.size(1) == self.img_channels
-        x = self.conv1(im_data)
+        x = im_data.float()
+        if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+            return checkpoint_sequence([self.conv1,self.conv2,self.conv3,self.conv4,self.conv5],x)
+
+        x = self.conv1(x)
         x = self.conv2(x)
         x = self.conv3(x)
         x = self.conv4(x)
@@ -96,13 +117,46 @@ class VGG16FeatureExtractor(nn.Module):
         return self.forward(im_data)
 
 
-class PretrainedVGG16FeatureExtractor(nn.Module):
-    def __init__(self):
+class NormalizedInputConv2d(nn.Conv2d):
+    """A conv layer with the input normalization (x/255-mean)/std folded into it. The 1/(255*std)
+    is folded into the weights and the mean is subtracted from the raw input, which also casts an uint8
+    input to float in the same pass. The mean is not folded into the bias on purpose: the zero padding
+    of the normalized input corresponds to a padding with the mean of the raw input, so only this keeps
+    the output at the borders the same.
+
+    The parameters keep the names and the values of the original conv, so the checkpoints are 
+    interchangeable with the unfolded model.
+    """
+    def __init__(self,
+                conv:nn.Conv2d,
+                mean:list,
+                std:list):
+        super().__init__(conv.in_channels,
+                        conv.out_channels,
+                        conv.kernel_size,
+                        stride=conv.stride,
+                        padding=conv.padding,
+                        dilation=conv.dilation,
+                        groups=conv.groups,
+                        bias=conv.bias is not None,
+                        device=conv.weight.device,
+                        dtype=conv.weight.dtype)
+        self.weight = conv.weight
+        self.bias = conv.bias
+
+        self.register_buffer('pixel_mean',torch.tensor(mean,device=conv.weight.device).view(1,-1,1,1)*255.0,persistent=False)
+        self.register_buffer('pixel_scale',1.0/(torch.tensor(std,device=conv.weight.device).view(1,-1,1,1)*255.0),persistent=False)
+
+    def forward(self, im_data:torch.Tensor)->torch.Tensor:
+        return self._conv_forward(im_data-self.pixel_mean,self.weight*self.pixel_scale,self.bias)
+
+
+class PretrainedVGG16FeatureExtractor(FeatureExtractor):
+    def __init__(self,fold_normalization:bool=False):
         """
             Args:
-                img_channels (int): number of channels of input image
-                feature_channels (int): number of channels of feature maps
-                bn (bool): whether to use batch normalization
+                fold_normalization (bool): whether to fold the input normalization into the first conv, 
+                                           see fold_input_normalization
         
         """
 
@@ -119,11 +173,31 @@ class PretrainedVGG16FeatureExtractor(nn.Module):
         assert feature_layer[28].out_channels == 512
 
         # freeze top4 conv
-        for layer in feature_layer[:10]:
+        self.n_frozen_layers = 10
+        for layer in feature_layer[:self.n_frozen_layers]:
             for p in layer.parameters():
                 p.requires_grad = False 
                 
         self.model = nn.Sequential(*feature_layer)
+
+        # the trainable layers are split into the vgg stages at the max pools for the checkpointing
+        stage_ends = [index+1 for index,layer in enumerate(feature_layer) if isinstance(layer,nn.MaxPool2d) and index >= self.n_frozen_layers]
+        stage_starts = [self.n_frozen_layers] + stage_ends
+        stage_ends = stage_ends + [len(feature_layer)]
+        self.trainable_stages = [(start,end) for start,end in zip(stage_starts,stage_ends) if start < end]
+        self.gradient_checkpointing = False
+
+        self.normalization_folded = False
+        if fold_normalization:
+            self.fold_input_normalization()
+
+    def fold_input_normalization(self):
+        """Fold the /255 and the ImageNet normalization into the first conv, so that the raw (uint8 or 
+        float) images go straight into it. The features are the same as the ones of the unfolded model.
+        """
+        if not self.normalization_folded:
+            self.model[0] = NormalizedInputConv2d(self.model[0],IMAGENET_MEAN,IMAGENET_STD)
+            self.normalization_folded = True
     
     def predict(self,im_data:torch.Tensor)->torch.Tensor:
         """
@@ -136,18 +210,33 @@ class PretrainedVGG16FeatureExtractor(nn.Module):
         """extract feature maps
 
         Args:
-            im_data (torch.Tensor): shape = (batch_size, img_channel, img_size, img_size)
+            im_data (torch.Tensor): shape = (batch_size, img_channel, img_size, img_size), uint8 or float
+                                    pixel values in [0,255]
 
         Returns:
             torch.Tensor: shape = (batch_size, feature_channels, feature_height, feature_width)
         """         
-        transform=T.Compose([T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])    
-        im_data = transform(im_data/255.0)
-        x = self.model(im_data)
+        # the frozen layers run without autograd, so none of their activations is kept for backward 
+        # whatever the input is, and the trainable layers start a fresh graph at the boundary
+        with torch.no_grad():
+            if not self.normalization_folded:
+                transform=T.Compose([T.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD)])    
+                im_data = transform(im_data/255.0)
+
+            x = im_data
+            for layer in self.model[:self.n_frozen_layers]:
+                x = layer(x)
+        x = x.detach()
+
+        if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+            return checkpoint_sequence([self.model[start:end] for start,end in self.trainable_stages],x)
+
+        for layer in self.model[self.n_frozen_layers:]:
+            x = layer(x)
         return x
         
 
-class PretrainedResnet50FeatureExtractor(nn.Module):
+class PretrainedResnet50FeatureExtractor(FeatureExtractor):
     def __init__(self, backbone_name, pretrained):
         super().__init__()
         body = resnet.__dict__[backbone_name](
@@ -165,6 +254,9 @@ class PretrainedResnet50FeatureExtractor(nn.Module):
         
         self.inner_block_module = nn.Conv2d(in_channels, self.out_channels, 1)
         self.layer_block_module = nn.Conv2d(self.out_channels, self.out_channels, 3, 1, 1)
+
+        # recompute the activations of the body modules in backward rather than keeping them
+        self.gradient_checkpointing = False
         
         for m in self.children():
             if isinstance(m, nn.Conv2d):
@@ -172,8 +264,12 @@ class PretrainedResnet50FeatureExtractor(nn.Module):
                 nn.init.constant_(m.bias, 0)
         
     def forward(self, x):
-        for module in self.body.values():
-            x = module(x)
+        x = x.float()
+        if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+            x = checkpoint_sequence(self.body.values(),x)
+        else:
+            for module in self.body.values():
+                x = module(x)
         x = self.inner_block_module(x)
         x = self.layer_block_module(x)
         return x
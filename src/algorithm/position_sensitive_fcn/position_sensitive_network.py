@@ -31,7 +31,7 @@ from torch.types import Device
 from torchvision.ops import PSRoIPool
 
 from yacs.config import CfgNode
-from common import CNNBlock, weights_normal_init
+from common import CNNBlock, to_indices_and_rois, weights_normal_init
 
 class PositionSensitiveNetwork(nn.Module):
 
@@ -48,7 +48,9 @@ class PositionSensitiveNetwork(nn.Module):
         self.ps_roi_pool_class = PSRoIPool(output_size=config.R_FCN.POOL_SIZE,spatial_scale=1.0/config.R_FCN.FEATURE_STRIDE)
         self.class_avg_pool = nn.AvgPool2d(kernel_size=config.R_FCN.POOL_SIZE,stride=config.R_FCN.POOL_SIZE)
 
-        self.bbox_map_conv = CNNBlock(2*config.R_FCN.IN_CHANNELS,config.R_FCN.POOL_SIZE**2*(config.R_FCN.NUM_CLASSES+1)*4,1,relu=False,same_padding=True)
+        # class agnostic: one bbox for all of the classes, otherwise one bbox per class
+        n_bbox_classes = 1 if config.R_FCN.CLASS_AGNOSTIC_BBOX else config.R_FCN.NUM_CLASSES+1
+        self.bbox_map_conv = CNNBlock(2*config.R_FCN.IN_CHANNELS,config.R_FCN.POOL_SIZE**2*n_bbox_classes*4,1,relu=False,same_padding=True)
         self.ps_roi_pool_bbox = PSRoIPool(output_size=config.R_FCN.POOL_SIZE,spatial_scale=1.0/config.R_FCN.FEATURE_STRIDE)
         self.bbox_avg_pool = nn.AvgPool2d(kernel_size=config.R_FCN.POOL_SIZE,stride=config.R_FCN.POOL_SIZE)
 
@@ -58,20 +60,27 @@ class PositionSensitiveNetwork(nn.Module):
 
     def predict(self,
                 feature:torch.Tensor,
-                proposed_roi_bboxes:torch.Tensor):
+                proposed_roi_bboxes):
         return self.forward(feature=feature,rois=proposed_roi_bboxes)
 
     def forward(self, 
                 feature:torch.Tensor, 
-                rois:torch.Tensor,
+                rois,
                 ):
+        """
+        Args:
+            feature (torch.Tensor): [C,H,W] or [B,C,H,W]
+            rois: [K,4] rois of a single image, list of the [K_i,4] rois of each image or [K,5] rois 
+                  with the batch indices, see common.to_indices_and_rois
+
+        Returns:
+            predicted_roi_score (torch.Tensor): [K,num_classes+1], in the same order as the rois
+            predicted_roi_offset (torch.Tensor): [K,(num_classes+1)*4], or [K,4] if CLASS_AGNOSTIC_BBOX
+        """
+        feature,xy_indices_and_rois = to_indices_and_rois(feature,rois)
 
         #* in_channels -> 2*in_channels
-        double_channel_feature = self.double_channel_conv(feature.unsqueeze(dim=0))
-        roi_indices = torch.zeros(len(rois),device=feature.device)
-        indices_and_rois = torch.cat([roi_indices[:, None], rois], dim=1)
-        xy_indices_and_rois = indices_and_rois[:, [0, 2, 1, 4, 3]]
-        xy_indices_and_rois = xy_indices_and_rois.contiguous()
+        double_channel_feature = self.double_channel_conv(feature)
 
         # *------------------------------------------------ 
         #  1. compute the probability of the class scores
@@ -79,18 +88,19 @@ class PositionSensitiveNetwork(nn.Module):
 
         # 2*in_channels -> pool_size*pool_size*(num_class+1)
         position_sensitive_score_maps = self.score_map_conv(double_channel_feature)
-        class_vote_array = self.ps_roi_pool_class(position_sensitive_score_maps, xy_indices_and_rois)
+        # the rois are pooled in fp32 under the mixed precision
+        class_vote_array = self.ps_roi_pool_class(position_sensitive_score_maps.float(), xy_indices_and_rois)
         predicted_roi_score = self.class_avg_pool(class_vote_array)
-        predicted_roi_score = predicted_roi_score.squeeze()
+        predicted_roi_score = predicted_roi_score.flatten(start_dim=1)
     
         
         # *------------------------------------------------ 
         # 2. compute the bbox offsets
         # *------------------------------------------------
         position_sensitive_bbox_maps = self.bbox_map_conv(double_channel_feature)
-        bbox_vote_array = self.ps_roi_pool_bbox(position_sensitive_bbox_maps, xy_indices_and_rois)
+        bbox_vote_array = self.ps_roi_pool_bbox(position_sensitive_bbox_maps.float(), xy_indices_and_rois)
         predicted_roi_offset = self.bbox_avg_pool(bbox_vote_array)
-        predicted_roi_offset = predicted_roi_offset.squeeze()
+        predicted_roi_offset = predicted_roi_offset.flatten(start_dim=1)
 
         return predicted_roi_score,predicted_roi_offset, 
 
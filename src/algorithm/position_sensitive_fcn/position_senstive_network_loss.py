@@ -48,7 +48,7 @@ class PositionSensitiveNetworkLoss(nn.Module):
         """
         Args:
             predicted_scores: (B, N, C)
-            predicted_offsets: (B, N, 4)
+            predicted_offsets: (B, N, C*4), or (B, N, 4) for the class agnostic bbox 
             target_labels: (B, N)
             target_offsets: (B, N, 4)
 
@@ -63,8 +63,10 @@ class PositionSensitiveNetworkLoss(nn.Module):
         positive_wieight = torch.zeros(target_offsets.shape).to(self.device)
         positive_wieight[(target_labels > 0).view(-1,1).expand_as(positive_wieight)] = 1
 
-        predicted_offsets = predicted_offsets.contiguous().view(n_sample,-1,4)
-        predicted_offsets = predicted_offsets[torch.arange(0,n_sample).long(),target_labels.long()]
+        # the offsets of the target class, unless the bbox is class agnostic
+        if predicted_offsets.shape[-1] != 4:
+            predicted_offsets = predicted_offsets.contiguous().view(n_sample,-1,4)
+            predicted_offsets = predicted_offsets[torch.arange(0,n_sample).long(),target_labels.long()]
     
         predicted_offsets = positive_wieight * predicted_offsets
         target_offsets    = positive_wieight * target_offsets
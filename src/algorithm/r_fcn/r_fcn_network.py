@@ -28,16 +28,17 @@ import torch
 from torch import nn
 from torch.nn import functional as F
 from torch.types import Device
-from torchvision.ops import nms
 
 from yacs.config import CfgNode
 
 from feature_extractor import FeatureExtractorFactory
 from location_utility import LocationUtility
+from nms import get_nms
 from position_sensitive_fcn.position_sensitive_network import PositionSensitiveNetwork
 from rpn.anchor_creator import AnchorCreator
 from rpn.proposal_creator import ProposalCreator
 from rpn.region_proposal_network import RPN
+from common import mixed_precision
 
 class RFCN(nn.Module):
     """
@@ -62,8 +63,14 @@ class RFCN(nn.Module):
         super().__init__()
         self.config = config
         self.device = device
+        self.precision = config.R_FCN.PRECISION
         self.feature_extractor = FeatureExtractorFactory.create_feature_extractor(config.R_FCN.FEATRUE_EXTRACTOR).to(device)
+        if config.R_FCN.FOLD_NORMALIZATION:
+            self.feature_extractor.fold_input_normalization()
         self.rpn = RPN(config).to(device)
+        if config.R_FCN.GRADIENT_CHECKPOINTING:
+            self.feature_extractor.gradient_checkpointing = True
+            self.rpn.gradient_checkpointing = True
     
         self.anchor_creator = AnchorCreator(config,device=device)
         self.proposal_creator = ProposalCreator(config)
@@ -76,19 +83,107 @@ class RFCN(nn.Module):
         self.offset_norm_std =  torch.tensor(config.R_FCN.OFFSET_NORM_STD).to(device)
 
     
-    def forward(self,image_batch):
-        #* 1. feature extraction        
-        feature_batch= self.feature_extractor.predict(image_batch)
-
-        #* 2.  predicted offsets and class scores by rpn network
-        rpn_predicted_score_batch,rpn_predicted_offset_batch = self.rpn.predict(feature_batch)
+    def forward(self,image_batch,image_sizes=None):
+        """
+        Args:
+            image_batch (torch.Tensor): [batch_size,3,height,width]
+            image_sizes (torch.Tensor): [batch_size,2], (height,width) of the images before 
+                                        they were padded into the batch, None if not padded
         
+        Returns:
+            bboxes, labels and scores of each image
+        """
         bboxes_batch = list()
         labels_batch = list()
         scores_batch = list()
+        for raw in self.predict_raw(image_batch,image_sizes):
+            bboxes, labels, scores = self.suppress(raw)
+            bboxes_batch.append(bboxes)
+            labels_batch.append(labels)
+            scores_batch.append(scores)
+
+        return bboxes_batch,labels_batch,scores_batch
+
+    def detect(self,
+                image_batch:torch.Tensor,
+                score_threshold:float,
+                nms_threshold:float,
+                max_detections:int=0,
+                image_sizes:torch.Tensor=None):
+        """Detects the objects in the images with the given thresholds rather than the ones of the config. The class-specific and the class
+        agnostic bbox layouts of R_FCN.CLASS_AGNOSTIC_BBOX are both handled.
+
+        Args:
+            image_batch (torch.Tensor): [batch_size,3,height,width]
+            score_threshold (float): threshold for score
+            nms_threshold (float): threshold for nms
+            max_detections (int): max number of the bboxes to keep per image, 0 for all of them
+            image_sizes (torch.Tensor): [batch_size,2], see forward
+
+        Returns:
+            bboxes, labels and scores of each image
+        """
+        bboxes_batch = list()
+        labels_batch = list()
+        scores_batch = list()
+        for raw in self.predict_raw(image_batch,image_sizes):
+            bboxes, labels, scores = self._suppress(raw['bboxes'],raw['probs'],score_threshold,nms_threshold,max_detections)
+            bboxes_batch.append(bboxes)
+            labels_batch.append(labels)
+            scores_batch.append(scores)
+
+        return bboxes_batch,labels_batch,scores_batch
+
+    def suppress(self,raw:dict):
+        """Suppresses the raw predictions of an image with the thresholds of the config.
+
+        Args:
+            raw (dict): the raw predictions of an image, see predict_raw
+
+        Returns:
+            bboxes (torch.Tensor): [n_bboxes,4]
+            labels (torch.Tensor): [n_bboxes,]
+            scores (torch.Tensor): [n_bboxes,]
+        """
+        return self._suppress(raw['bboxes'],
+                            raw['probs'],
+                            self.config.R_FCN.SCORE_THRESHOLD,
+                            self.config.R_FCN.NMS_THRESHOLD,
+                            self.config.R_FCN.MAX_DETECTIONS)
+
+    def predict_raw(self,image_batch,image_sizes=None):
+        """Runs the network up to the suppression, e.g. for the prediction cache of the evaluators, 
+        whose detections are suppressed again with other thresholds without running the network.
+
+        Args:
+            image_batch (torch.Tensor): [batch_size,3,height,width]
+            image_sizes (torch.Tensor): [batch_size,2], see forward
+
+        Returns:
+            list: a dict per image of
+                'rois': [n_rois,4], the proposed roi bboxes
+                'bboxes': [n_rois,(n_class+1)*4], the decoded bboxes of every class, or [n_rois,4] 
+                          for the class agnostic bbox, which is shared by all of the classes
+                'probs': [n_rois,n_class+1], the class probabilities
+        """
+        #* 1. feature extraction        
+        with mixed_precision(self.precision,image_batch.device):
+            feature_batch= self.feature_extractor.predict(image_batch)
 
+            #* 2.  predicted offsets and class scores by rpn network
+            rpn_predicted_score_batch,rpn_predicted_offset_batch = self.rpn.predict(feature_batch)
+
+        # the proposals are decoded in fp32
+        rpn_predicted_score_batch = rpn_predicted_score_batch.float()
+        rpn_predicted_offset_batch = rpn_predicted_offset_batch.float()
+        
+        img_sizes = list()
+        proposed_roi_bboxes_batch = list()
         for image_index in range(len(image_batch)):
-            img_height, img_width = image_batch[image_index].shape[1:]
+            if image_sizes is None:
+                img_height, img_width = image_batch[image_index].shape[1:]
+            else:
+                img_height, img_width = image_sizes[image_index].tolist()
             feature = feature_batch[image_index]
             feature_height,feature_width = feature.shape[1:]
             rpn_predicted_scores = rpn_predicted_score_batch[image_index]
@@ -103,50 +198,58 @@ class RFCN(nn.Module):
                                                                 img_width,
                                                                 feature_height,
                                                                 feature_width)
-            #* 4. get the bboxes ,labels and scores based on the proposed roi bboxes
-            bboxes, labels, scores = self.detect(feature, 
-                                                proposed_roi_bboxes, 
-                                                img_height, 
-                                                img_width,
-                                                self.config.FASTER_RCNN.SCORE_THRESHOLD,
-                                                self.config.FASTER_RCNN.NMS_THRESHOLD)
-            
-            bboxes_batch.append(bboxes)
-            labels_batch.append(labels)
-            scores_batch.append(scores)
-            
-        return bboxes_batch,labels_batch,scores_batch
+            img_sizes.append((img_height,img_width))
+            proposed_roi_bboxes_batch.append(proposed_roi_bboxes)
 
-    def predict(self, x):
-        return self.forward(x)
+        #* 4. get the bboxes ,labels and scores based on the proposed roi bboxes, the head runs once for the batch
+        with mixed_precision(self.precision,image_batch.device):
+            predicted_roi_score_batch,predicted_roi_offset_batch = self.ps_net.predict(feature_batch,proposed_roi_bboxes_batch)
+        n_rois = [len(proposed_roi_bboxes) for proposed_roi_bboxes in proposed_roi_bboxes_batch]
+        predicted_roi_score_batch = predicted_roi_score_batch.split(n_rois)
+        predicted_roi_offset_batch = predicted_roi_offset_batch.split(n_rois)
 
-    def detect(self, 
-                feature:torch.Tensor, 
+        raw_batch = list()
+        for image_index,(img_height,img_width) in enumerate(img_sizes):
+            predicted_roi_bboxes,prob = self._decode(proposed_roi_bboxes_batch[image_index],
+                                                    predicted_roi_score_batch[image_index],
+                                                    predicted_roi_offset_batch[image_index],
+                                                    img_height,
+                                                    img_width)
+            raw_batch.append(dict(rois=proposed_roi_bboxes_batch[image_index],bboxes=predicted_roi_bboxes,probs=prob))
+
+        return raw_batch
+
+    def predict(self, x, image_sizes=None):
+        return self.forward(x, image_sizes)
+
+    def _decode(self,
                 proposed_roi_bboxes:torch.Tensor,
+                predicted_roi_score:torch.Tensor,
+                predicted_roi_offset:torch.Tensor,
                 img_height:int,
-                img_width:int,
-                score_threshold:float,
-                nms_threshold:float):
-        """
+                img_width:int):
+        """Decode the predicted offsets of the rois of an image into the bboxes of every class.
+
         Args:
-            feature (torch.Tensor): [C,H,W]
-            proposed_roi_bboxes (torch.Tensor): [n_bboxes,4]
+            proposed_roi_bboxes (torch.Tensor): [n_rois,4]
+            predicted_roi_score (torch.Tensor): [n_rois,n_class+1]
+            predicted_roi_offset (torch.Tensor): [n_rois,(n_class+1)*4], or [n_rois,4] for the class agnostic bbox
             img_height (int): height of image
             img_width (int): width of image
-            score_threshold (float): threshold for score
-            nms_threshold (float): threshold for nms
 
         Returns:
-            bboxes (torch.Tensor): [n_bboxes,4]
-            labels (torch.Tensor): [n_bboxes,]
-            scores (torch.Tensor): [n_bboxes,]
+            bboxes (torch.Tensor): [n_rois,(n_class+1)*4], or [n_rois,4] for the class agnostic bbox
+            probs (torch.Tensor): [n_rois,n_class+1]
         """
-
-        predicted_roi_score,predicted_roi_offset = self.ps_net.predict(feature, proposed_roi_bboxes)
+        # the bboxes are decoded and suppressed in fp32
+        predicted_roi_score = predicted_roi_score.float()
+        predicted_roi_offset = predicted_roi_offset.float()
 
 
-        mean = self.offset_norm_mean.repeat(self.n_class+1)[None]
-        std  = self.offset_norm_std.repeat(self.n_class+1)[None]
+        # 1 for the class agnostic bbox, otherwise n_class+1
+        n_bbox_classes = predicted_roi_offset.shape[1]//4
+        mean = self.offset_norm_mean.repeat(n_bbox_classes)[None]
+        std  = self.offset_norm_std.repeat(n_bbox_classes)[None]
 
         predicted_roi_offset = predicted_roi_offset * std + mean
         
@@ -158,44 +261,43 @@ class RFCN(nn.Module):
 
         prob = F.softmax(predicted_roi_score,dim=1)
 
-        bboxes, labels, scores = self._suppress(predicted_roi_bboxes, 
-                                                    prob,
-                                                    score_threshold,
-                                                    nms_threshold)
-                                                
-        return bboxes,labels,scores
-
-    def _suppress(self, predicted_roi_bboxes, predicted_prob,score_threshold,nms_threshold):
-        bboxes = list()
-        labels = list()
-        scores = list()
-
-        for class_index in range(1, self.n_class+1):
-            cls_bbox = predicted_roi_bboxes.reshape((-1, self.n_class+1, 4))[:, class_index, :]
-            class_prob = predicted_prob[:, class_index]
-            
-            # for current class, keep the top-K bboxes with highest scores
-            mask = class_prob > score_threshold
-            cls_bbox = cls_bbox[mask]
-            class_prob = class_prob[mask]
-            
-            keep = nms(cls_bbox[:,[1,0,3,2]],class_prob,nms_threshold)
-            
-            # keep top-K bboxes only if there is at least one bbox left for current class
-            if keep.shape[0] > 0:
-                bboxes.append(cls_bbox[keep])
-                labels.append(((class_index) * torch.ones((len(keep),),dtype=torch.int32)).to(self.device))
-                scores.append(class_prob[keep])
-        
-        #  concatenate all bboxes and scores only if there is at least one bbox left for 
-        #  any class, elsewise return empty tensors
-        if len(bboxes) > 0:
-            bboxes = torch.cat(bboxes, dim=0).to(self.device)
-            labels = torch.cat(labels, dim=0).to(self.device)
-            scores = torch.cat(scores, dim=0).to(self.device)
+        return predicted_roi_bboxes,prob
+
+    def _suppress(self, predicted_roi_bboxes, predicted_prob,score_threshold,nms_threshold,max_detections=0):
+        """Class-wise nms for all of the classes at once, by the nms method of R_FCN.NMS_METHOD.
+
+        Args:
+            predicted_roi_bboxes (torch.Tensor): [n_rois,(n_class+1)*4], or [n_rois,4] for the class agnostic bbox
+            predicted_prob (torch.Tensor): [n_rois,n_class+1]
+            score_threshold (float): threshold for score
+            nms_threshold (float): threshold for nms
+            max_detections (int): max number of the bboxes to keep, 0 for all of them
+
+        Returns:
+            bboxes (torch.Tensor): [n_bboxes,4], sorted by score from highest to lowest
+            labels (torch.Tensor): [n_bboxes,]
+            scores (torch.Tensor): [n_bboxes,]
+        """
+        # skip the background class, the class agnostic bbox is shared by all of the classes without a copy
+        if predicted_roi_bboxes.shape[1] == 4:
+            cls_bboxes = predicted_roi_bboxes[:, None, :].expand(-1, self.n_class, 4)
         else:
-            bboxes = torch.empty((0, 4),device=self.device)
-            labels = torch.empty((0,), device=self.device)
-            scores = torch.empty((0,), device=self.device)
+            cls_bboxes = predicted_roi_bboxes.reshape((-1, self.n_class+1, 4))[:, 1:, :]
+        cls_prob = predicted_prob[:, 1:]
+
+        roi_indices,class_indices = torch.where(cls_prob > score_threshold)
+        bboxes = cls_bboxes[roi_indices,class_indices]
+        scores = cls_prob[roi_indices,class_indices]
+        labels = (class_indices + 1).to(torch.int32)
+
+        if bboxes.shape[0] == 0:
+            return bboxes,labels,scores
+
+        suppress = get_nms(self.config.R_FCN.NMS_METHOD,class_aware=True)
+        keep,scores = suppress(bboxes,scores,labels,nms_threshold,score_threshold,self.config.R_FCN.NMS_SIGMA)
+
+        if max_detections > 0:
+            keep = keep[:max_detections]
+            scores = scores[:max_detections]
 
-        return bboxes,labels, scores 
\ No newline at end of file
+        return bboxes[keep],labels[keep],scores 
\ No newline at end of file
@@ -24,7 +24,8 @@
 # #### END LICENSE BLOCK #####
 # /
 
-import copy
+import os
+import time
 
 from albumentations.augmentations.geometric.functional import scale
 from tqdm import tqdm
@@ -37,6 +38,8 @@ from torch.types import Device
 import torch.optim as optim
 from torch.optim.lr_scheduler import StepLR
 from torch.utils.data.dataloader import DataLoader
+from torch.utils.data.distributed import DistributedSampler
+from torch.utils.data.sampler import RandomSampler
 from torchmetrics.detection.map import MAP
 
 from yacs.config import CfgNode
@@ -46,7 +49,11 @@ from r_fcn.r_fcn_network import RFCN
 from rpn.proposal_target_creator import ProposalTargetCreator
 from rpn.region_proposal_network_loss import RPNLoss
 from visual_tool import draw_img_bboxes_labels
-from checkpoint_tool import  load_checkpoint, save_checkpoint
+from checkpoint_tool import  CheckpointWriter, load_checkpoint, save_frozen_base, strip_frozen
+from common import mixed_precision
+from benchmark_tool import SavedActivationMeter, elapsed_seconds, peak_memory_mb, reset_peak_memory
+from distributed_tool import is_distributed, is_main_process, wrap_distributed
+from grouped_batch_sampler import GroupedBatchSampler, create_shape_groups
 
 class RFCNTrainer:
     def __init__(self,
@@ -61,20 +68,38 @@ class RFCNTrainer:
         self.eval_config = eval_config
         self.writer = writer
         self.device = device
+        # the activations saved for the backward of a step, measured per step on cpu as well as on cuda
+        self.activation_meter = SavedActivationMeter()
         self.epoches = train_config.R_FCN.EPOCHS
-        self.train_dataloader = DataLoader(train_dataset,batch_size=1,shuffle=True,num_workers=train_config.R_FCN.NUM_WORKERS)    
+        # every process of a distributed run trains on its own part of the dataset
+        self.distributed = is_distributed()
+        self.train_sampler = DistributedSampler(train_dataset,shuffle=True) if self.distributed else RandomSampler(train_dataset)
+        # batch the images of similar shapes together, they are padded to the same size by the collate function
+        batch_sampler = GroupedBatchSampler(self.train_sampler,
+                                            create_shape_groups(train_dataset,train_config.VOC_DATASET.BATCH_SHAPE_QUANTUM),
+                                            train_config.R_FCN.BATCH_SIZE)
+        self.train_dataloader = DataLoader(train_dataset,
+                                            batch_sampler=batch_sampler,
+                                            num_workers=train_config.R_FCN.NUM_WORKERS,
+                                            collate_fn=train_dataset.collate)    
     
         self.r_fcn = RFCN(train_config,device)
         self.feature_extractor = self.r_fcn.feature_extractor
         self.rpn = self.r_fcn.rpn
+        self.ps_net = self.r_fcn.ps_net
+        if self.distributed:
+            # the trainable parts are called separately, so each of them averages its own gradients
+            self.feature_extractor = wrap_distributed(self.feature_extractor,device)
+            self.rpn = wrap_distributed(self.rpn,device)
+            self.ps_net = wrap_distributed(self.ps_net,device)
         self.rpn_loss  = RPNLoss(train_config,device)   
+        self.batched_rpn_loss = train_config.RPN.ANCHOR_TARGET_CREATOR.BATCHED
 
     
         self.anchor_creator = self.r_fcn.anchor_creator
         self.proposal_creator = self.r_fcn.proposal_creator
         self.proposal_target_creator = ProposalTargetCreator(train_config)
 
-        self.ps_net = self.r_fcn.ps_net
         self.ps_net_loss = PositionSensitiveNetworkLoss(train_config,device)
         
         
@@ -90,9 +115,17 @@ class RFCNTrainer:
 
         self.resume = train_config.R_FCN.RESUME
         self.checkpoint_path = train_config.CHECKPOINT.CHECKPOINT_PATH
+        self.max_keep = train_config.CHECKPOINT.MAX_KEEP if train_config.CHECKPOINT.MAX_KEEP > 0 else None
+        # the checkpoints are written in the background while the training goes on
+        self.checkpoint_writer = CheckpointWriter()
+        # the frozen parameters are saved once into a base file rather than into every checkpoint
+        self.incremental_checkpoint = train_config.CHECKPOINT.INCREMENTAL
+        self.frozen_names = [name for name,parameter in self.r_fcn.named_parameters() if not parameter.requires_grad]
+        self.frozen_base = None
         
         if eval_config is not None:
-            self.evaluator = RFCNEvaluator(eval_config,eval_dataset,device)
+            # the evaluator runs the model being trained rather than a copy of it
+            self.evaluator = RFCNEvaluator(eval_config,eval_dataset,device,model=self.r_fcn)
             self.best_map_50 = 0
         else:
             self.evaluator = None
@@ -106,84 +139,126 @@ class RFCNTrainer:
 
         total_loss = torch.tensor(0.0,requires_grad=True,device=self.device)
         for epoch in tqdm(range(start_epoch,self.epoches)):
+            if self.distributed:
+                # reshuffle the parts of the processes
+                self.train_sampler.set_epoch(epoch)
+
             # train the model for current epoch
-            for _,(images_batch,bboxes_batch,labels_batch,_,ids,scales) in tqdm(enumerate(self.train_dataloader)):
+            for _,(images_batch,bboxes_batch,labels_batch,_,ids,scales,image_sizes,n_objects) in tqdm(enumerate(self.train_dataloader)):
 
-                images_batch,bboxes_batch,labels_batch = images_batch.to(self.device),bboxes_batch.to(self.device),labels_batch.to(self.device)
+                reset_peak_memory(self.device)
+                self.step_start_time = time.perf_counter()
+                # the activations of the forward of this step are counted, see SavedActivationMeter
+                with self.activation_meter:
+                    images_batch,bboxes_batch,labels_batch = images_batch.to(self.device),bboxes_batch.to(self.device),labels_batch.to(self.device)
                 
-                # extract the batch feature map from images
-                features_batch = self.feature_extractor.predict(images_batch.float())
+                    with mixed_precision(self.r_fcn.precision,self.device):
+                        # extract the batch feature map from images
+                        features_batch = self.feature_extractor.predict(images_batch)
 
-                # predict the rpn scores and offsets from features
-                rpn_predicted_scores_batch, rpn_predicted_offset_batch = self.rpn.predict(features_batch)
+                        # predict the rpn scores and offsets from features
+                        rpn_predicted_scores_batch, rpn_predicted_offset_batch = self.rpn.predict(features_batch)
 
-                total_rpn_cls_loss = torch.tensor(0.0,requires_grad=True,device=self.device)
-                total_rpn_reg_loss = torch.tensor(0.0,requires_grad=True,device=self.device)
-                total_roi_cls_loss = torch.tensor(0.0,requires_grad=True,device=self.device)
-                total_roi_reg_loss = torch.tensor(0.0,requires_grad=True,device=self.device)
-                
-                # image by image
-                for image_index in range(images_batch.shape[0]):
-                    feature = features_batch[image_index]
-                    image = images_batch[image_index]
-                    scale = scales[image_index]
-                    feature_height,feature_width = feature.shape[1:]
-                    
-                    img_height,img_width = image.shape[1:]
-                    gt_bboxes = bboxes_batch[image_index]
-                    gt_labels = labels_batch[image_index]
-                    
-                    rpn_predicted_scores = rpn_predicted_scores_batch[image_index]
-                    rpn_predicted_offsets = rpn_predicted_offset_batch[image_index]
+                    # the anchor targets, the proposals and the losses are computed in fp32
+                    rpn_predicted_scores_batch = rpn_predicted_scores_batch.float()
+                    rpn_predicted_offset_batch = rpn_predicted_offset_batch.float()
 
-                    
+                    # the images are padded to the same size, so they share the feature size and the anchors
+                    feature_height,feature_width = features_batch.shape[2:]
                     anchors_of_img = self.anchor_creator.create(feature_height,feature_width)
+
+                    total_rpn_cls_loss = torch.tensor(0.0,requires_grad=True,device=self.device)
+                    total_rpn_reg_loss = torch.tensor(0.0,requires_grad=True,device=self.device)
+                    total_roi_cls_loss = torch.tensor(0.0,requires_grad=True,device=self.device)
+                    total_roi_reg_loss = torch.tensor(0.0,requires_grad=True,device=self.device)
+                
+                    if self.batched_rpn_loss:
+                        # rpn loss for the whole batch at once
+                        gt_mask = torch.arange(bboxes_batch.shape[1],device=self.device)[None] < n_objects.to(self.device)[:,None]
+                        total_rpn_cls_loss,total_rpn_reg_loss = self.rpn_loss.compute_batch(anchors_of_img,
+                                                                                            rpn_predicted_scores_batch,
+                                                                                            rpn_predicted_offset_batch,
+                                                                                            bboxes_batch,
+                                                                                            gt_mask,
+                                                                                            image_sizes)
+
+                    sampled_roi_batch = list()
+                    gt_label_for_sampled_roi_batch = list()
+                    gt_offset_for_sampled_roi_batch = list()
+
+                    # image by image
+                    for image_index in range(images_batch.shape[0]):
+                        scale = scales[image_index].item()
                     
-                    # rpn loss
-                    rpn_cls_loss,rpn_reg_los=self.rpn_loss.compute(anchors_of_img,
-                                                            rpn_predicted_scores,
-                                                            rpn_predicted_offsets,
-                                                            gt_bboxes,
-                                                            img_height,
-                                                            img_width,
-                                                        )
+                        # the size of the image before padding, the padded area is outside of the image
+                        img_height,img_width = image_sizes[image_index].tolist()
+                        n_gt = n_objects[image_index].item()
+                        gt_bboxes = bboxes_batch[image_index,:n_gt]
+                        gt_labels = labels_batch[image_index,:n_gt]
                     
-                    total_rpn_cls_loss = total_rpn_cls_loss + rpn_cls_loss
-                    total_rpn_reg_loss = total_rpn_reg_loss + rpn_reg_los
+                        rpn_predicted_scores = rpn_predicted_scores_batch[image_index]
+                        rpn_predicted_offsets = rpn_predicted_offset_batch[image_index]
 
-
-                    proposed_roi_bboxes =self.proposal_creator.create(anchors_of_img,
-                                                                    rpn_predicted_scores.detach(),
-                                                                    rpn_predicted_offsets.detach(),
+                    
+                        if not self.batched_rpn_loss:
+                            # rpn loss
+                            rpn_cls_loss,rpn_reg_los=self.rpn_loss.compute(anchors_of_img,
+                                                                    rpn_predicted_scores,
+                                                                    rpn_predicted_offsets,
+                                                                    gt_bboxes,
                                                                     img_height,
                                                                     img_width,
-                                                                    feature_height,
-                                                                    feature_width,
-                                                                    scale)
-
-                    sampled_roi,gt_label_for_sampled_roi,gt_offset_for_sampled_roi = self.proposal_target_creator.create(proposed_roi_bboxes,
-                                                                                                gt_bboxes,
-                                                                                                gt_labels
-                                                                                            )
+                                                                    self.anchor_creator.get_inside_indices(feature_height,feature_width,img_height,img_width)
+                                                                )
                     
-                    predicted_sampled_roi_cls_score,predicted_sampled_roi_offset = self.ps_net.predict(feature,sampled_roi)
+                            total_rpn_cls_loss = total_rpn_cls_loss + rpn_cls_loss
+                            total_rpn_reg_loss = total_rpn_reg_loss + rpn_reg_los
+
+
+                        proposed_roi_bboxes =self.proposal_creator.create(anchors_of_img,
+                                                                        rpn_predicted_scores.detach(),
+                                                                        rpn_predicted_offsets.detach(),
+                                                                        img_height,
+                                                                        img_width,
+                                                                        feature_height,
+                                                                        feature_width,
+                                                                        scale)
+
+                        sampled_roi,gt_label_for_sampled_roi,gt_offset_for_sampled_roi = self.proposal_target_creator.create(proposed_roi_bboxes,
+                                                                                                    gt_bboxes,
+                                                                                                    gt_labels
+                                                                                                )
                     
-                    # roi loss
-                    roi_cls_loss,roi_reg_loss = self.ps_net_loss.compute(predicted_sampled_roi_cls_score,
-                                                                    predicted_sampled_roi_offset,
-                                                                    gt_label_for_sampled_roi,
-                                                                    gt_offset_for_sampled_roi)                                                                    
+                        sampled_roi_batch.append(sampled_roi)
+                        gt_label_for_sampled_roi_batch.append(gt_label_for_sampled_roi)
+                        gt_offset_for_sampled_roi_batch.append(gt_offset_for_sampled_roi)
+
+                    # the head runs once for the sampled rois of all of the images
+                    with mixed_precision(self.r_fcn.precision,self.device):
+                        predicted_sampled_roi_cls_score_batch,predicted_sampled_roi_offset_batch = self.ps_net.predict(features_batch,sampled_roi_batch)
+                    predicted_sampled_roi_cls_score_batch = predicted_sampled_roi_cls_score_batch.float()
+                    predicted_sampled_roi_offset_batch = predicted_sampled_roi_offset_batch.float()
+                    n_sampled_rois = [len(sampled_roi) for sampled_roi in sampled_roi_batch]
+                    predicted_sampled_roi_cls_score_batch = predicted_sampled_roi_cls_score_batch.split(n_sampled_rois)
+                    predicted_sampled_roi_offset_batch = predicted_sampled_roi_offset_batch.split(n_sampled_rois)
+
+                    for image_index in range(images_batch.shape[0]):
+                        # roi loss
+                        roi_cls_loss,roi_reg_loss = self.ps_net_loss.compute(predicted_sampled_roi_cls_score_batch[image_index],
+                                                                        predicted_sampled_roi_offset_batch[image_index],
+                                                                        gt_label_for_sampled_roi_batch[image_index],
+                                                                        gt_offset_for_sampled_roi_batch[image_index])                                                                    
                     
-                    total_roi_cls_loss = total_roi_cls_loss + roi_cls_loss
-                    total_roi_reg_loss = total_roi_reg_loss + roi_reg_loss
+                        total_roi_cls_loss = total_roi_cls_loss + roi_cls_loss
+                        total_roi_reg_loss = total_roi_reg_loss + roi_reg_loss
                 
-                total_loss = total_rpn_cls_loss + total_rpn_reg_loss+ total_roi_cls_loss+ total_roi_reg_loss
+                    total_loss = total_rpn_cls_loss + total_rpn_reg_loss+ total_roi_cls_loss+ total_roi_reg_loss
                                 
                 self.optimizer.zero_grad()
                 total_loss.backward()                    
                 self.optimizer.step()
 
-                if steps%self.train_config.R_FCN.CHECK_FREQUENCY==0:
+                if steps%self.train_config.R_FCN.CHECK_FREQUENCY==0 and is_main_process():
                     self._check_progress(steps,
                                         total_loss,
                                         total_rpn_cls_loss, 
@@ -193,20 +268,21 @@ class RFCNTrainer:
                                         images_batch, 
                                         bboxes_batch,
                                         labels_batch,
-                                        img_height, 
-                                        img_width)
+                                        image_sizes,
+                                        n_objects)
                 
                 steps += 1
             
             # adjust the learning rate if necessary
             self.scheduler.step()  
                         
-            # evaluate the model on test set for current epoch    
+            # evaluate the model on test set for current epoch, every process evaluates a part of it
             is_best = False
             if self.evaluator is not None:
-                eval_result =self.evaluator.evaluate(copy.deepcopy(self.r_fcn.state_dict()))
-                self.writer.add_scalar('eval/map',eval_result['map'].item(),steps)
-                self.writer.add_scalar('eval/map_50',eval_result['map_50'].item(),steps)
+                eval_result =self.evaluator.evaluate()
+                if is_main_process():
+                    self.writer.add_scalar('eval/map',eval_result['map'].item(),steps)
+                    self.writer.add_scalar('eval/map_50',eval_result['map_50'].item(),steps)
 
                 # is the best model so far?
                 if eval_result['map_50'].item() > self.best_map_50:
@@ -221,7 +297,22 @@ class RFCNTrainer:
                 'scheduler': self.scheduler.state_dict()
                 }
             
-            save_checkpoint(checkpoint,self.checkpoint_path, is_best=is_best)
+            if is_main_process():
+                if self.incremental_checkpoint:
+                    if self.frozen_base is None:
+                        self.frozen_base = save_frozen_base(checkpoint['r_fcn_model'],
+                                                            self.frozen_names,
+                                                            os.path.dirname(self.checkpoint_path),
+                                                            mmap_layout=self.train_config.CHECKPOINT.MMAP_LAYOUT)
+                    checkpoint = strip_frozen(checkpoint,'r_fcn_model',self.frozen_base,self.frozen_names)
+
+                self.checkpoint_writer.save(checkpoint,
+                                            self.checkpoint_path, 
+                                            is_best=is_best, 
+                                            max_keep=self.max_keep,
+                                            mmap_layout=self.train_config.CHECKPOINT.MMAP_LAYOUT)
+
+        self.checkpoint_writer.wait()
 
     def _check_progress(self, 
                         steps, 
@@ -233,8 +324,8 @@ class RFCNTrainer:
                         images_batch,
                         bboxes_batch,
                         labels_batch,
-                        img_height,
-                        img_width,
+                        image_sizes,
+                        n_objects,
                     ):
 
         self.writer.add_scalar('total_loss',total_loss.item(),steps)
@@ -245,8 +336,24 @@ class RFCNTrainer:
 
         self.writer.add_scalar('lr',self.optimizer.param_groups[0]['lr'],steps)
 
+        anchor_cache_info = self.anchor_creator.cache_info()
+        self.writer.add_scalar('anchor_cache/hits',anchor_cache_info['hits'],steps)
+        self.writer.add_scalar('anchor_cache/misses',anchor_cache_info['misses'],steps)
+
+        # the activations kept for the backward of this step, and its peak memory on cuda
+        self.writer.add_scalar('memory/saved_activation_mb',self.activation_meter.mb,steps)
+        if torch.device(self.device).type == 'cuda':
+            self.writer.add_scalar('memory/peak_mb',peak_memory_mb(self.device),steps)
+        # the time of the forward, backward and update of this step
+        self.writer.add_scalar('time/step_s',elapsed_seconds(self.step_start_time,self.device),steps)
+
+        # only the first image of the batch is shown, cropped to its size before padding
+        img_height,img_width = image_sizes[0].tolist()
+        n_gt = n_objects[0].item()
+        image = images_batch[0,:,:img_height,:img_width]
+
         with torch.no_grad():
-            predicted_bboxes_batch, predicted_labels_batch, _,= self.r_fcn.predict(images_batch.float())
+            predicted_bboxes_batch, predicted_labels_batch, _,= self.r_fcn.predict(images_batch[:1],image_sizes[:1])
                         
             predicted_labels_for_img_0 = predicted_labels_batch[0]
             predicted_label_names_for_img_0 = []
@@ -254,9 +361,9 @@ class RFCNTrainer:
                 predicted_label_names_for_img_0.append(self.train_dataloader.dataset.get_label_names()[label_index.long().item()])
 
             if len(predicted_label_names_for_img_0) >0:
-                label_names = [self.train_dataloader.dataset.get_label_names()[label_index] for label_index in labels_batch[0]] 
-                img_and_gt_bboxes = draw_img_bboxes_labels(images_batch[0],
-                                                                        bboxes_batch[0],
+                label_names = [self.train_dataloader.dataset.get_label_names()[label_index] for label_index in labels_batch[0,:n_gt]] 
+                img_and_gt_bboxes = draw_img_bboxes_labels(image,
+                                                                        bboxes_batch[0,:n_gt],
                                                                         label_names, 
                                                                         resize_shape=[img_height,img_width],
                                                                         colors='green')
@@ -265,7 +372,7 @@ class RFCNTrainer:
                             
                 predicted_bboxes_for_img_0 = predicted_bboxes_batch[0]
                             
-                img_and_predicted_bboxes = draw_img_bboxes_labels(images_batch[0],
+                img_and_predicted_bboxes = draw_img_bboxes_labels(image,
                                                                             predicted_bboxes_for_img_0,
                                                                             predicted_label_names_for_img_0,
                                                                             resize_shape=[img_height,img_width],
@@ -24,11 +24,14 @@
 # #### END LICENSE BLOCK #####
 # /
 
+from collections import OrderedDict
 
 import torch
 from torch.types import Device
 from yacs.config import CfgNode
 
+from rpn.anchor_target_creator import AnchorTargetCreator
+
 class AnchorCreator:
     def __init__(self,
                 config:CfgNode,
@@ -40,11 +43,21 @@ class AnchorCreator:
         self.device = device
         self.anchor_base = self._create_anchor_base()
 
+        # the images are resized to MIN_SIZE/MAX_SIZE, so only a few feature shapes ever occur.
+        # LRU cache: (feature_height,feature_width,device) -> anchors and their inside indices
+        self.cache_size = config.RPN.ANCHOR_CREATOR.CACHE_SIZE
+        self.cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
     def create(self,
                 feature_height:int,
                 feature_width: int):
 
         """Generate anchor windows by enumerating aspect ratio and scales.
+
+        The anchors are cached per feature shape, the same tensor is returned for the same shape, 
+        so the callers must not modify it in place.
         
         Args:
             feature_height (int): feature height
@@ -53,7 +66,69 @@ class AnchorCreator:
         Returns:
             return anchor windows [n_anchors,4]      
         """
+        return self._get_cache_entry(feature_height,feature_width)['anchors']
+
+    def get_inside_indices(self,
+                            feature_height:int,
+                            feature_width:int,
+                            img_height:int,
+                            img_width:int):
+        """Get the indices of the anchors which are completely inside of the image, see 
+        AnchorTargetCreator._get_inside_indices. They are cached next to the anchors.
+
+        Args:
+            feature_height (int): feature height
+            feature_width (int): feature width
+            img_height (int): height of the image
+            img_width (int): width of the image
+
+        Returns:
+            indices (torch.Tensor): [n_inside_anchors,]
+        """
+        entry = self._get_cache_entry(feature_height,feature_width)
+        inside_indices = entry['inside_indices']
+
+        key = (img_height,img_width)
+        indices = inside_indices.get(key)
+        if indices is None:
+            indices = AnchorTargetCreator._get_inside_indices(entry['anchors'],img_height,img_width)
+            if self.cache_size > 0:
+                inside_indices[key] = indices
+                if len(inside_indices) > self.cache_size:
+                    inside_indices.popitem(last=False)
+        else:
+            inside_indices.move_to_end(key)
+        return indices
+
+    def cache_info(self):
+        """Get the statistics of the anchor cache.
+
+        Returns:
+            dict: hits, misses, current size and max size of the cache
+        """
+        return dict(hits=self.cache_hits,misses=self.cache_misses,size=len(self.cache),max_size=self.cache_size)
+
+    def _get_cache_entry(self,
+                        feature_height:int,
+                        feature_width:int):
+        key = (feature_height,feature_width,torch.device(self.device))
+        entry = self.cache.get(key)
+        if entry is not None:
+            self.cache_hits += 1
+            self.cache.move_to_end(key)
+            return entry
+
+        self.cache_misses += 1
+        entry = dict(anchors=self._create_anchors(feature_height,feature_width),inside_indices=OrderedDict())
+        if self.cache_size > 0:
+            self.cache[key] = entry
+            if len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+        return entry
 
+    def _create_anchors(self,
+                        feature_height:int,
+                        feature_width:int):
 
         shift_y = torch.arange(0, feature_height * self.feature_stride,self.feature_stride,device=self.device)
         shift_x = torch.arange(0, feature_width * self.feature_stride, self.feature_stride,device=self.device)
@@ -45,7 +45,8 @@ class AnchorTargetCreator:
             anchors_of_image:torch.Tensor,
             gt_bboxs:torch.Tensor,
             img_H:int,
-            img_W:int)->torch.Tensor:
+            img_W:int,
+            inside_indices:torch.Tensor=None)->torch.Tensor:
         """Generate the target labels and regression values.
         
         Args:
@@ -53,6 +54,8 @@ class AnchorTargetCreator:
             gt_bboxs: (M,4) tensor, the ground truth bounding boxes.
             img_H: int the height of the image.
             img_W: int the width of the image.
+            inside_indices: (K,) tensor, the indices of the anchors inside the image if they are 
+                            already known (e.g. cached by the AnchorCreator), None to compute them.
 
         Returns:
             labels: (N,), the target labels of the anchors.
@@ -61,7 +64,10 @@ class AnchorTargetCreator:
         num_anchors_of_img = len(anchors_of_image)
 
         # get the index of anchors inside the image
-        valid_indices = self._get_inside_indices(anchors_of_image, img_H, img_W)
+        if inside_indices is None:
+            valid_indices = self._get_inside_indices(anchors_of_image, img_H, img_W)
+        else:
+            valid_indices = inside_indices
 
         if len(valid_indices) == 0:
             return None,None
@@ -128,6 +134,117 @@ class AnchorTargetCreator:
         
         return labels,offsets 
     
+    def create_batch(self,
+                    anchors:torch.Tensor,
+                    gt_bboxs:torch.Tensor,
+                    gt_mask:torch.Tensor,
+                    img_sizes:torch.Tensor):
+        """Generate the target labels and regression values for a batch of images at once. The 
+        labels are assigned by the same rules as in create, the positive and negative anchors are 
+        sampled uniformly by random ranks, so the numbers of them are the same as in create.
+
+        Args:
+            anchors: (A,4) tensor, the anchors shared by the images, or (B,A,4) tensor.
+            gt_bboxs: (B,M,4) tensor, the ground truth bounding boxes padded to the max number M.
+            gt_mask: (B,M) bool tensor, True for the real ground truth bounding boxes.
+            img_sizes: (B,2) tensor, the (height,width) of the images before padding.
+
+        Returns:
+            labels: (B,A) tensor, the target labels of the anchors, -1 for the anchors outside of the image.
+            offsets: (B,A,4) tensor, the target offsets of the anchors, 0 for the anchors outside of the image.
+        """
+        n_images = gt_bboxs.shape[0]
+        if anchors.dim() == 2:
+            anchors = anchors.unsqueeze(0).expand(n_images,-1,-1)
+        n_anchors = anchors.shape[1]
+
+        img_sizes = img_sizes.to(anchors.device)
+        gt_mask = gt_mask.to(anchors.device)
+
+        # (B,A), the anchors located completely inside of each image
+        inside_mask = (anchors[:,:,0] >= 0) & \
+                        (anchors[:,:,1] >= 0) & \
+                        (anchors[:,:,2] <= img_sizes[:,0:1]) & \
+                        (anchors[:,:,3] <= img_sizes[:,1:2])
+
+        # (B,A,M), -1 for the pairs with an anchor outside of the image or a padded ground truth
+        ious = self._calc_batch_ious(anchors,gt_bboxs)
+        ious = ious.masked_fill(~(inside_mask[:,:,None] & gt_mask[:,None,:]),-1)
+
+        # for each anchor, find the gt box with the highest iou
+        max_ious_for_anchor,argmax_ious_for_anchor = ious.max(dim=2)
+
+        # for each gt box, the anchors with the highest iou (there might be multiple of them)
+        max_ious_for_gt_box = ious.max(dim=1,keepdim=True)[0]
+        is_argmax_for_gt_box = ((ious == max_ious_for_gt_box) & gt_mask[:,None,:]).any(dim=2) & inside_mask
+
+        # label: 1 is positive, 0 is negative, -1 is dont care
+        labels = torch.full((n_images,n_anchors),-1,dtype=torch.int32,device=anchors.device)
+        labels[inside_mask & (max_ious_for_anchor < self.neg_iou_thresh)] = 0
+        labels[is_argmax_for_gt_box] = 1
+        labels[inside_mask & (max_ious_for_anchor >= self.pos_iou_thresh)] = 1
+
+        # 
+        # For tranning efficence, we only sample n_samples*pos_ratio positive anchors 
+        # and n_smaples*(1-pos_ratio) negative anchors.
+        #
+        n_positive = int(self.pos_ratio * self.n_samples)
+        positive_rank = self._random_rank(labels == 1)
+        labels[(labels == 1) & (positive_rank >= n_positive)] = -1
+
+        n_negative = self.n_samples - (labels == 1).sum(dim=1,keepdim=True)
+        negative_rank = self._random_rank(labels == 0)
+        labels[(labels == 0) & (negative_rank >= n_negative)] = -1
+
+        #
+        # compute bounding box regression targets for all of the anchors inside the images
+        #
+        target_bboxs = torch.gather(gt_bboxs,1,argmax_ious_for_anchor[:,:,None].expand(-1,-1,4))
+        offsets = LocationUtility.bbox2offset(anchors.reshape(-1,4),target_bboxs.reshape(-1,4)).view(n_images,n_anchors,4)
+
+        has_target = inside_mask & gt_mask.any(dim=1,keepdim=True)
+        offsets = torch.where(has_target[:,:,None],offsets,torch.zeros_like(offsets))
+
+        return labels,offsets
+
+    @staticmethod
+    def _calc_batch_ious(anchors:torch.Tensor,gt_bboxs:torch.Tensor)->torch.Tensor:
+        """Calculate the IoU of the anchors with the ground truth boxes image by image.
+
+        Args:
+            anchors: (B,A,4) tensor.
+            gt_bboxs: (B,M,4) tensor.
+
+        Returns:
+            ious: (B,A,M) tensor.
+        """
+        area_anchors = (anchors[:,:,2] - anchors[:,:,0]) * (anchors[:,:,3] - anchors[:,:,1])
+        area_gt_bboxs = (gt_bboxs[:,:,2] - gt_bboxs[:,:,0]) * (gt_bboxs[:,:,3] - gt_bboxs[:,:,1])
+
+        top_left = torch.max(anchors[:,:,None,:2],gt_bboxs[:,None,:,:2])
+        bottom_right = torch.min(anchors[:,:,None,2:],gt_bboxs[:,None,:,2:])
+        wh = (bottom_right - top_left).clamp(min=0)
+        inter = wh[:,:,:,0] * wh[:,:,:,1]
+
+        return inter / (area_anchors[:,:,None] + area_gt_bboxs[:,None,:] - inter)
+
+    @staticmethod
+    def _random_rank(mask:torch.Tensor)->torch.Tensor:
+        """Rank the True elements of each row in a random order.
+
+        Args:
+            mask: (B,N) bool tensor.
+
+        Returns:
+            rank: (B,N) tensor, the random rank of the True elements in their row, the False elements
+                  are ranked after all of the True elements.
+        """
+        random_keys = torch.rand(mask.shape,device=mask.device).masked_fill(~mask,2.0)
+        order = random_keys.argsort(dim=1)
+        rank = torch.empty_like(order)
+        rank.scatter_(1,order,torch.arange(mask.shape[1],device=mask.device).expand_as(order).contiguous())
+        return rank
+
     def _calc_ious(self, 
                 anchors:torch.Tensor,
                 gt_bboxs:torch.Tensor)->torch.Tensor:
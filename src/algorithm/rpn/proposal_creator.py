@@ -37,6 +37,7 @@ class ProposalCreator:
                 
         self.nms_thresh = config.RPN.PROPOSAL_CREATOR.NMS_THRESHOLD
         self.min_size =   config.RPN.PROPOSAL_CREATOR.MIN_SIZE
+        self.lazy_decode = config.RPN.PROPOSAL_CREATOR.LAZY_DECODE
 
     def create(self, 
                 anchors_of_image: torch.Tensor,  
@@ -63,38 +64,12 @@ class ProposalCreator:
             Returns:
                 proposals: (n_proposals, 4) tensor.
         """
-        #
-        #  1. get all of the bboxes based on the anchors and predicted offsets
-        #
-
         # [feature_height,feature_width, num_base_anchors * 4]
         predicted_offsets = predicted_offsets.permute(1,2,0).contiguous()
         
         # [Num_anchors,4]
         predicted_offsets = predicted_offsets.view(-1,4) 
 
-        # Convert anchors into proposals via bbox transformations.
-        predicted_roi_bboxs = LocationUtility.offset2bbox(anchors_of_image, predicted_offsets)
-
-        #
-        # 2. Clip predicted boxes to image.
-        #
-        predicted_roi_bboxs[:, slice(0, 4, 2)] = torch.clip(predicted_roi_bboxs[:, slice(0, 4, 2)], 0, img_height)
-        predicted_roi_bboxs[:, slice(1, 4, 2)] = torch.clip(predicted_roi_bboxs[:, slice(1, 4, 2)], 0, img_width)
-
-        # 
-        # 3. Remove those predicted boxes with either height or width > threshold.
-        #
-        min_size = self.min_size * scale
-        hs = predicted_roi_bboxs[:, 2] - predicted_roi_bboxs[:, 0]
-        ws = predicted_roi_bboxs[:, 3] - predicted_roi_bboxs[:, 1]
-        index_to_keep_with_specified_size = torch.where((hs >= min_size) & (ws >= min_size))[0]
-        predicted_roi_bboxs = predicted_roi_bboxs[index_to_keep_with_specified_size, :]
-
-        #
-        #  4. Take n_pre_nms top objectness score  proposals before NMS.
-        #
-
         # [feature_height,feature_width, num_base_anchors * 2]
         predicted_scores = predicted_scores.permute(1, 2, 0).contiguous() 
         
@@ -105,16 +80,22 @@ class ProposalCreator:
 
         #[Num_anchors]
         predicted_objectness_scores= predicted_softmax_scores[:,:,:,1].contiguous().view(-1)
-        proposed_objectness_scores = predicted_objectness_scores[index_to_keep_with_specified_size]
-
-        # Sort all proposed_objectness_scores by score from highest to lowest.
-        proposed_objectness_scores,order = proposed_objectness_scores.sort(descending=True)
 
-        # Take top pre_nms_topN (e.g. 6000) boxes before NMS.
-        if self.n_pre_nms > 0:
-            index_top_pre_nms = order[:self.n_pre_nms]
-        predicted_roi_bboxs = predicted_roi_bboxs[index_top_pre_nms,:]
-        proposed_objectness_scores = proposed_objectness_scores[index_top_pre_nms]
+        min_size = self.min_size * scale
+        if self.lazy_decode:
+            predicted_roi_bboxs,proposed_objectness_scores = self._lazy_decode(anchors_of_image,
+                                                                                predicted_objectness_scores,
+                                                                                predicted_offsets,
+                                                                                img_height,
+                                                                                img_width,
+                                                                                min_size)
+        else:
+            predicted_roi_bboxs,proposed_objectness_scores = self._full_decode(anchors_of_image,
+                                                                                predicted_objectness_scores,
+                                                                                predicted_offsets,
+                                                                                img_height,
+                                                                                img_width,
+                                                                                min_size)
 
         #
         #  5. Run NMS on the top proposals.
@@ -128,7 +109,129 @@ class ProposalCreator:
         # 6. Take post_nms_topN (e.g. 300) bboxes after NMS.
         #      
         if self.n_post_nms > 0:
-            index_top_after_nms = keep[:self.n_post_nms]
+            keep = keep[:self.n_post_nms]
+
+        return predicted_roi_bboxs[keep]
+
+    def _full_decode(self,
+                    anchors_of_image: torch.Tensor,
+                    predicted_objectness_scores: torch.Tensor,
+                    predicted_offsets: torch.Tensor,
+                    img_height: int,
+                    img_width: int,
+                    min_size: float):
+        """
+            Decode all of the anchors, then take the n_pre_nms top score proposals.
+
+            Returns:
+                bboxes: (n_pre_nms, 4) tensor, sorted by score from highest to lowest.
+                scores: (n_pre_nms,) tensor.
+        """
+        #
+        #  1-3. get all of the bboxes, clip them to the image and remove the small ones.
+        #
+        predicted_roi_bboxs,index_to_keep_with_specified_size = self._decode(anchors_of_image,
+                                                                            predicted_offsets,
+                                                                            img_height,
+                                                                            img_width,
+                                                                            min_size)
+        predicted_roi_bboxs = predicted_roi_bboxs[index_to_keep_with_specified_size, :]
+        proposed_objectness_scores = predicted_objectness_scores[index_to_keep_with_specified_size]
+
+        #
+        #  4. Take n_pre_nms top objectness score  proposals before NMS.
+        #
 
-        return predicted_roi_bboxs[index_top_after_nms]
+        # Sort all proposed_objectness_scores by score from highest to lowest.
+        proposed_objectness_scores,order = proposed_objectness_scores.sort(descending=True)
+        predicted_roi_bboxs = predicted_roi_bboxs[order,:]
+
+        # Take top pre_nms_topN (e.g. 6000) boxes before NMS.
+        if self.n_pre_nms > 0:
+            predicted_roi_bboxs = predicted_roi_bboxs[:self.n_pre_nms]
+            proposed_objectness_scores = proposed_objectness_scores[:self.n_pre_nms]
+
+        return predicted_roi_bboxs,proposed_objectness_scores
+
+    def _lazy_decode(self,
+                    anchors_of_image: torch.Tensor,
+                    predicted_objectness_scores: torch.Tensor,
+                    predicted_offsets: torch.Tensor,
+                    img_height: int,
+                    img_width: int,
+                    min_size: float):
+        """
+            Decode the n_pre_nms top score anchors first, found by topk rather than by sorting all of 
+            the anchors. The small boxes are removed after decoding, so if too few are left, only the 
+            next anchors in the order of the scores are ranked among the rest and decoded, as many as 
+            the keep rate so far says are needed, until there are n_pre_nms boxes left or all of the 
+            anchors are decoded. No anchor is decoded twice, so it never does more work than 
+            _full_decode. The output is the same as the one of _full_decode.
+
+            Returns:
+                bboxes: (n_pre_nms, 4) tensor, sorted by score from highest to lowest.
+                scores: (n_pre_nms,) tensor.
+        """
+        num_anchors = predicted_objectness_scores.shape[0]
+        n_pre_nms = self.n_pre_nms if self.n_pre_nms > 0 else num_anchors
+
+        # only the top anchors are ranked rather than all of them sorted
+        chunk_scores,chunk = predicted_objectness_scores.topk(min(n_pre_nms,num_anchors))
+        decoded = torch.zeros(num_anchors,dtype=torch.bool,device=predicted_objectness_scores.device)
+
+        bboxes_chunks = list()
+        scores_chunks = list()
+        n_kept = 0
+        n_decoded = 0
+        while True:
+            predicted_roi_bboxs,index_to_keep_with_specified_size = self._decode(anchors_of_image[chunk],
+                                                                                predicted_offsets[chunk],
+                                                                                img_height,
+                                                                                img_width,
+                                                                                min_size)
+            bboxes_chunks.append(predicted_roi_bboxs[index_to_keep_with_specified_size])
+            scores_chunks.append(chunk_scores[index_to_keep_with_specified_size])
+            n_kept += index_to_keep_with_specified_size.shape[0]
+            decoded[chunk] = True
+            n_decoded += chunk.shape[0]
+            if n_decoded == num_anchors or n_kept >= n_pre_nms:
+                break
+
+            # decode the missing boxes over the keep rate so far, with a margin, the next anchors
+            # are ranked among the ones not decoded yet
+            keep_rate = max(n_kept/n_decoded,0.01)
+            n_next = min(int((n_pre_nms - n_kept)/keep_rate*1.25) + 1,num_anchors - n_decoded)
+            remaining = (~decoded).nonzero().squeeze(1)
+            chunk_scores,top = predicted_objectness_scores[remaining].topk(n_next)
+            chunk = remaining[top]
+
+        predicted_roi_bboxs = torch.cat(bboxes_chunks)[:n_pre_nms]
+        proposed_objectness_scores = torch.cat(scores_chunks)[:n_pre_nms]
+        return predicted_roi_bboxs,proposed_objectness_scores
+
+    def _decode(self,
+                anchors: torch.Tensor,
+                predicted_offsets: torch.Tensor,
+                img_height: int,
+                img_width: int,
+                min_size: float):
+        """
+            Decode the anchors into bboxes, clip them to the image and find the ones which are big enough.
+
+            Returns:
+                bboxes: (N, 4) tensor.
+                index_to_keep_with_specified_size: (K,) tensor.
+        """
+        # Convert anchors into proposals via bbox transformations.
+        predicted_roi_bboxs = LocationUtility.offset2bbox(anchors, predicted_offsets)
+
+        # Clip predicted boxes to image.
+        predicted_roi_bboxs[:, slice(0, 4, 2)] = torch.clip(predicted_roi_bboxs[:, slice(0, 4, 2)], 0, img_height)
+        predicted_roi_bboxs[:, slice(1, 4, 2)] = torch.clip(predicted_roi_bboxs[:, slice(1, 4, 2)], 0, img_width)
+
+        # Remove those predicted boxes with either height or width < threshold.
+        hs = predicted_roi_bboxs[:, 2] - predicted_roi_bboxs[:, 0]
+        ws = predicted_roi_bboxs[:, 3] - predicted_roi_bboxs[:, 1]
+        index_to_keep_with_specified_size = torch.where((hs >= min_size) & (ws >= min_size))[0]
 
+        return predicted_roi_bboxs,index_to_keep_with_specified_size
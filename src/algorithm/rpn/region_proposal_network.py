@@ -27,7 +27,7 @@
 import torch
 import torch.nn as nn
 from yacs.config import CfgNode
-from common import CNNBlock, weights_normal_init
+from common import CNNBlock, checkpoint_function, weights_normal_init
 
 
 class RPN(nn.Module):
@@ -44,6 +44,9 @@ class RPN(nn.Module):
         weights_normal_init(self.score_conv, dev=0.01)
         weights_normal_init(self.bbox_conv, dev=0.001)
 
+        # recompute the hidden activations in backward rather than keeping them
+        self.gradient_checkpointing = False
+
     def forward(self,features:torch.Tensor):
         """
         Args:
@@ -53,6 +56,11 @@ class RPN(nn.Module):
             scores: (N, num_base_anchors*2, H, W)
             bboxs: (N, num_base_anchors*4, H, W)
         """
+        if self.gradient_checkpointing and self.training and torch.is_grad_enabled():
+            return checkpoint_function(self._forward,features)
+        return self._forward(features)
+
+    def _forward(self,features:torch.Tensor):
         # [batch_size, middle_channels, feature_height, feature_width]
         hidden = self.conv1(features)  
 
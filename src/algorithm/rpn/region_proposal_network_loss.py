@@ -49,7 +49,8 @@ class RPNLoss(nn.Module):
                 predicted_offsets: torch.Tensor,
                 target_bboxs: torch.Tensor,
                 img_height: int,
-                img_width: int):
+                img_width: int,
+                inside_indices: torch.Tensor=None):
         """
                 Compute the loss for a single image.
 
@@ -60,6 +61,7 @@ class RPNLoss(nn.Module):
                     target_bboxs: (M, 4) tensor.
                     img_height: int.
                     img_width: int.
+                    inside_indices: (K,) tensor, the indices of the anchors inside the image, None to compute them.
                 
                 Returns:
                     classification_loss: float.
@@ -68,7 +70,7 @@ class RPNLoss(nn.Module):
         """
 
         # assgin the target_bboxs to the corresponding anchors
-        target_labels,target_offsets = self.anchor_target_creator.create(anchors_of_img,target_bboxs,img_height,img_width)
+        target_labels,target_offsets = self.anchor_target_creator.create(anchors_of_img,target_bboxs,img_height,img_width,inside_indices)
 
         if target_labels is None:
             return torch.tensor(0.0,device=self.device),torch.tensor(0.0,device=self.device)
@@ -96,13 +98,60 @@ class RPNLoss(nn.Module):
 
         return classification_loss,regression_loss
 
-    def compute(self,anchors_of_img,predicted_scores,predicted_offsets,target_bboxs,img_height,img_width):
+    def compute(self,anchors_of_img,predicted_scores,predicted_offsets,target_bboxs,img_height,img_width,inside_indices=None):
         """
             A explict interface for computing the loss by calling the forward function.
         """
-        return self.forward(anchors_of_img,predicted_scores,predicted_offsets,target_bboxs,img_height,img_width)
+        return self.forward(anchors_of_img,predicted_scores,predicted_offsets,target_bboxs,img_height,img_width,inside_indices)
     
-    def _soomth_l1_loss(self, predicted_offsets, target_offsets,sigma):
+    def compute_batch(self,
+                    anchors: torch.Tensor,
+                    predicted_scores_batch: torch.Tensor,
+                    predicted_offsets_batch: torch.Tensor,
+                    target_bboxs_batch: torch.Tensor,
+                    target_mask_batch: torch.Tensor,
+                    img_sizes: torch.Tensor):
+        """
+                Compute the loss for a batch of images at once. The losses are normalized image by image
+                as in forward and summed over the images.
+
+                Args:
+                    anchors: (N, 4) tensor, the anchors shared by the images.
+                    predicted_scores_batch: (B, n_base_anchors*2, H, W) tensor.
+                    predicted_offsets_batch: (B, n_base_anchors*4, H, W) tensor.
+                    target_bboxs_batch: (B, M, 4) tensor, padded to the max number of ground truths M.
+                    target_mask_batch: (B, M) bool tensor, True for the real ground truths.
+                    img_sizes: (B, 2) tensor, the (height,width) of the images before padding.
+
+                Returns:
+                    classification_loss: float, the sum over the images.
+                    regression_loss: float, the sum over the images.
+        """
+        n_images = predicted_scores_batch.shape[0]
+        target_labels,target_offsets = self.anchor_target_creator.create_batch(anchors,target_bboxs_batch,target_mask_batch,img_sizes)
+        target_labels = target_labels.long()
+
+        # the images without any anchor inside have no loss, as in forward 
+        n_labeled = (target_labels >= 0).sum(dim=1).float()
+        normalizer = n_labeled.clamp(min=1)
+
+        #----------------------- classfication loss -----------------------#
+        predicted_scores_batch = predicted_scores_batch.permute(0,2,3,1).contiguous().view(-1,2)
+        classification_loss = F.cross_entropy(predicted_scores_batch,target_labels.view(-1),ignore_index=-1,reduction='none')
+        classification_loss = (classification_loss.view(n_images,-1).sum(dim=1) / normalizer).sum()
+
+        #----------------------- regression loss --------------------------#
+        inside_weight = (target_labels > 0).unsqueeze(2).float()
+        predicted_offsets_batch = predicted_offsets_batch.permute(0,2,3,1).contiguous().view(n_images,-1,4)
+
+        loc_loss = self._soomth_l1_loss(inside_weight*predicted_offsets_batch,inside_weight*target_offsets,self.sigma,reduce_dims=(1,2))
+
+        # Normalize by the number of the labeled anchors of each image
+        regression_loss = (loc_loss / normalizer).sum()
+
+        return classification_loss,regression_loss
+
+    def _soomth_l1_loss(self, predicted_offsets, target_offsets,sigma,reduce_dims=None):
         """
         calculate smooth L1 loss 
 
@@ -110,6 +159,7 @@ class RPNLoss(nn.Module):
             predicted_offsets: (B, N, 4)
             target_offsets: (B, N, 4)
             sigma: float
+            reduce_dims: the dims to sum over, None for all of them
         
         Returns:
             loss: (B,)
@@ -120,5 +170,7 @@ class RPNLoss(nn.Module):
         abs_diff = diff.abs()
         flag = (abs_diff.data < (1.0 / sigma2)).float()
         loss = flag * (sigma2 / 2.) * (diff ** 2) +(1 - flag) * (abs_diff - 0.5 / sigma2)
-        return loss.sum() 
+        if reduce_dims is None:
+            return loss.sum()
+        return loss.sum(dim=reduce_dims) 
 
@@ -36,6 +36,11 @@ _C = ConfigNode()
 
 # ----------------------- TEST ----------------------------------------------------#
 _C.TEST = ConfigNode()
+# directory of the raw predictions cached by the evaluators, keyed by the hash of the model and the
+# config, an evaluation with other suppression thresholds (SCORE_THRESHOLD, NMS_THRESHOLD, NMS_METHOD,
+# NMS_SIGMA, MAX_DETECTIONS) reads them back without running the network. Only the states passed to
+# evaluate are cached, the model shared with the trainer is not. None for no cache
+_C.TEST.PREDICTION_CACHE_DIR = None
 
 # ----------------------- LOG ----------------------------------------------------- #
 _C.LOG = ConfigNode()
@@ -44,6 +49,17 @@ _C.LOG.LOG_DIR = '/media/yan/D/ornot/workspace/object_detection/log'
 # ----------------------- CHECKPOINT-----------------------------------------------#
 _C.CHECKPOINT = ConfigNode()
 _C.CHECKPOINT.CHECKPOINT_PATH = '/media/yan/D/ornot/workspace/object_detection/checkpoint/model_checkpoint.ckpt'
+# max number of the checkpoints to keep, 0 to keep all of them
+_C.CHECKPOINT.MAX_KEEP = 0
+# save the checkpoints in the layout whose tensors are memory-mapped on loading, see checkpoint_tool
+_C.CHECKPOINT.MMAP_LAYOUT = False
+# save the frozen parameters once into a base file next to the checkpoints, which hold the trainable ones only
+_C.CHECKPOINT.INCREMENTAL = False
+
+# ----------------------- DISTRIBUTED --------------------------------------------#
+# used when train.py is launched by torchrun with more than one process
+_C.DISTRIBUTED = ConfigNode()
+_C.DISTRIBUTED.BACKEND = 'gloo'
 
 # ————————————————————————PRETRAINED MODEL——————————————————————————————————————— #
 _C.PRETRAINED_MODEL = ConfigNode()
@@ -56,6 +72,14 @@ _C.VOC_DATASET.USE_DIFFICULT_LABEL = False
 _C.VOC_DATASET.AUGMENTED = False
 _C.VOC_DATASET.MIN_SIZE = 600
 _C.VOC_DATASET.MAX_SIZE = 1000
+# directory of the derived data (annotation index, ...), None means <DATA_DIR>/cache
+_C.VOC_DATASET.CACHE_DIR = None
+_C.VOC_DATASET.USE_ANNOTATION_INDEX = True
+# read pre-resized images built by build_cache.py instead of decoding the jpg files
+_C.VOC_DATASET.USE_IMAGE_CACHE = False
+_C.VOC_DATASET.IMAGE_CACHE_SHARD_SIZE_MB = 1024
+# images whose resized sizes fall into the same multiples of this quantum are batched together
+_C.VOC_DATASET.BATCH_SHAPE_QUANTUM = 32
 
 # -------------------------- RPN ---------------------------------------------------#
 _C.RPN = ConfigNode()
@@ -68,6 +92,8 @@ _C.RPN.ANCHOR_CREATOR = ConfigNode()
 _C.RPN.ANCHOR_CREATOR.ANCHOR_RATIOS = [0.5, 1, 2]
 _C.RPN.ANCHOR_CREATOR.ANCHOR_SCALES = [8, 16, 32]
 _C.RPN.ANCHOR_CREATOR.FEATURE_STRIDE = 16
+# max number of feature shapes whose anchors are cached, 0 disables the cache
+_C.RPN.ANCHOR_CREATOR.CACHE_SIZE = 16
 
 #-----------------------------RPN.ANCHOR_TARGET_CREATOR-----------------------------#
 _C.RPN.ANCHOR_TARGET_CREATOR = ConfigNode()
@@ -75,6 +101,8 @@ _C.RPN.ANCHOR_TARGET_CREATOR.N_SAMPLES = 256
 _C.RPN.ANCHOR_TARGET_CREATOR.POSITIVE_RATIO = 0.5
 _C.RPN.ANCHOR_TARGET_CREATOR.NEGATIVE_IOU_THRESHOLD = 0.3
 _C.RPN.ANCHOR_TARGET_CREATOR.POSITIVE_IOU_THRESHOLD = 0.7
+# assign the anchor targets and compute the rpn loss for the whole batch at once in the trainers
+_C.RPN.ANCHOR_TARGET_CREATOR.BATCHED = True
 
 # -----------------------------RPN.PROPOAL_CREATOR--------------------#
 _C.RPN.PROPOSAL_CREATOR = ConfigNode()
@@ -82,6 +110,8 @@ _C.RPN.PROPOSAL_CREATOR.NMS_THRESHOLD = 0.7
 _C.RPN.PROPOSAL_CREATOR.N_PRE_NMS = 12000
 _C.RPN.PROPOSAL_CREATOR.N_POST_NMS = 2000
 _C.RPN.PROPOSAL_CREATOR.MIN_SIZE = 16
+# take the top N_PRE_NMS scores before decoding the anchors instead of decoding all of them
+_C.RPN.PROPOSAL_CREATOR.LAZY_DECODE = True
 
 # -----------------------RPN.PROPOAL_TARGET_CREATOR---------------#
 _C.RPN.PROPOSAL_TARGET_CREATOR = ConfigNode()
@@ -102,12 +132,30 @@ _C.FAST_RCNN.NUM_CLASSES = 20
 _C.FAST_RCNN.ROI_SIZE = 7
 _C.FAST_RCNN.SPATIAL_SCALE = 1.0 / _C.RPN.ANCHOR_CREATOR.FEATURE_STRIDE
 _C.FAST_RCNN.ROI_SIGMMA = 1.0
+# ranks of the low-rank factored fc6 and fc7 of a compressed model, 0 for the full linears
+_C.FAST_RCNN.FC6_RANK = 0
+_C.FAST_RCNN.FC7_RANK = 0
 
 # ----------------------- FASTER_RCNN------------------------------------------------------#
 _C.FASTER_RCNN = ConfigNode()
 _C.FASTER_RCNN.FEATRUE_EXTRACTOR = 'pretrained_vgg16'
+# fold the input normalization into the first conv of the pretrained vgg16
+_C.FASTER_RCNN.FOLD_NORMALIZATION = False
+# recompute the activations of the backbone and the rpn in backward to save the memory in training
+_C.FASTER_RCNN.GRADIENT_CHECKPOINTING = False
+# 'fp32', or 'bf16' to run the backbone, the rpn and the head under the bfloat16 autocast
+_C.FASTER_RCNN.PRECISION = 'fp32'
+# int8 dynamically quantized fast rcnn head for the cpu inference
+_C.FASTER_RCNN.QUANTIZED_HEAD = False
 _C.FASTER_RCNN.NMS_THRESHOLD = 0.3
+# the class-wise nms of the detections: 'torchvision', 'batched', 'soft_linear', 'soft_gaussian',
+# 'matrix_linear' or 'matrix_gaussian', see tool/metrics/nms.py. The class-agnostic 'hard' is rejected
+_C.FASTER_RCNN.NMS_METHOD = 'torchvision'
+# sigma of the gaussian decay of the soft and the matrix nms
+_C.FASTER_RCNN.NMS_SIGMA = 0.5
 _C.FASTER_RCNN.SCORE_THRESHOLD = 0.7
+# max number of detections per image, 0 for no limit
+_C.FASTER_RCNN.MAX_DETECTIONS = 0
 _C.FASTER_RCNN.OFFSET_NORM_MEAN = [0.0, 0.0, 0.0, 0.0]
 _C.FASTER_RCNN.OFFSET_NORM_STD = [0.1, 0.1, 0.2, 0.2]
 _C.FASTER_RCNN.NUM_WORKERS = 2
@@ -131,10 +179,25 @@ _C.R_FCN.NUM_CLASSES = 20
 _C.R_FCN.FEATURE_STRIDE = 16
 _C.R_FCN.IN_CHANNELS = _C.RPN.FEATURE_CHANNELS
 _C.R_FCN.ROI_SIGMMA = 1.0
+# one bbox regression for all of the classes, the bbox score map has 4*POOL_SIZE^2 channels
+_C.R_FCN.CLASS_AGNOSTIC_BBOX = False
 
 _C.R_FCN.FEATRUE_EXTRACTOR = 'pretrained_vgg16'
+# fold the input normalization into the first conv of the pretrained vgg16
+_C.R_FCN.FOLD_NORMALIZATION = False
+# recompute the activations of the backbone and the rpn in backward to save the memory in training
+_C.R_FCN.GRADIENT_CHECKPOINTING = False
+# 'fp32', or 'bf16' to run the backbone, the rpn and the head under the bfloat16 autocast
+_C.R_FCN.PRECISION = 'fp32'
 _C.R_FCN.NMS_THRESHOLD = 0.3
+# the class-wise nms of the detections: 'torchvision', 'batched', 'soft_linear', 'soft_gaussian',
+# 'matrix_linear' or 'matrix_gaussian', see tool/metrics/nms.py. The class-agnostic 'hard' is rejected
+_C.R_FCN.NMS_METHOD = 'torchvision'
+# sigma of the gaussian decay of the soft and the matrix nms
+_C.R_FCN.NMS_SIGMA = 0.5
 _C.R_FCN.SCORE_THRESHOLD = 0.7
+# max number of detections per image, 0 for no limit
+_C.R_FCN.MAX_DETECTIONS = 0
 _C.R_FCN.OFFSET_NORM_MEAN = [0.0, 0.0, 0.0, 0.0]
 _C.R_FCN.OFFSET_NORM_STD = [0.1, 0.1, 0.2, 0.2]
 _C.R_FCN.NUM_WORKERS = 2
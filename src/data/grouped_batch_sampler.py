@@ -0,0 +1,106 @@
+# #### BEGIN LICENSE BLOCK #####
+# MIT License
+#    
+# Copyright (c) 2021 Bin.Li (ornot2008@yahoo.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# #### END LICENSE BLOCK #####
+# /
+
+from collections import Counter, defaultdict
+
+from torch.utils.data.sampler import BatchSampler, Sampler
+
+
+def create_shape_groups(dataset, quantum: int = 32):
+    """Groups the images of a dataset by their resized shape.
+
+    Images whose resized height and width fall into the same multiples of quantum share a
+    group, so the portrait and landscape images are never mixed and the images of a batch
+    need at most quantum pixels of padding in each direction.
+
+    Args:
+        dataset (VOCDataset): dataset providing get_image_shape(index)
+        quantum (int): bucket size in pixels
+
+    Returns:
+        list: group id of each image
+    """
+    group_keys = dict()
+    group_ids = list()
+    for index in range(len(dataset)):
+        height, width = dataset.get_image_shape(index)
+        key = (height // quantum, width // quantum)
+        group_ids.append(group_keys.setdefault(key, len(group_keys)))
+    return group_ids
+
+
+class GroupedBatchSampler(BatchSampler):
+    """Yields batches of indices whose images belong to the same group.
+
+    The indices come from another sampler (e.g. a RandomSampler or a DistributedSampler) and are
+    buffered per group until a batch is full. By default the incomplete batches left at the end are
+    filled up with images of their own group, so every epoch has exactly ceil(n/batch_size) batches,
+    which keeps the number of steps identical on every process of a distributed run. Evaluation,
+    which must see every image exactly once, turns the filling off.
+    """
+    def __init__(self, sampler: Sampler, group_ids, batch_size: int, fill_incomplete: bool = True):
+        if not isinstance(sampler, Sampler):
+            raise ValueError('sampler should be an instance of torch.utils.data.Sampler, but got {}'.format(sampler))
+        self.sampler = sampler
+        self.group_ids = group_ids
+        self.batch_size = batch_size
+        self.fill_incomplete = fill_incomplete
+
+    def __iter__(self):
+        buffer_per_group = defaultdict(list)
+        samples_per_group = defaultdict(list)
+
+        n_batches = 0
+        for index in self.sampler:
+            group_id = self.group_ids[index]
+            buffer_per_group[group_id].append(index)
+            samples_per_group[group_id].append(index)
+            if len(buffer_per_group[group_id]) == self.batch_size:
+                yield buffer_per_group[group_id]
+                n_batches += 1
+                del buffer_per_group[group_id]
+
+        if not self.fill_incomplete:
+            for buffer in buffer_per_group.values():
+                yield buffer
+            return
+
+        # fill up the incomplete batches, the largest first, until the expected number of batches
+        n_remaining = len(self) - n_batches
+        for group_id, buffer in sorted(buffer_per_group.items(), key=lambda item: len(item[1]), reverse=True):
+            if n_remaining <= 0:
+                break
+            samples = samples_per_group[group_id]
+            while len(buffer) < self.batch_size:
+                buffer.extend(samples[:self.batch_size - len(buffer)])
+            yield buffer
+            n_remaining -= 1
+
+    def __len__(self):
+        if not self.fill_incomplete:
+            group_sizes = Counter(self.group_ids[index] for index in self.sampler)
+            return sum((size + self.batch_size - 1) // self.batch_size for size in group_sizes.values())
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
@@ -0,0 +1,209 @@
+# #### BEGIN LICENSE BLOCK #####
+# MIT License
+#    
+# Copyright (c) 2021 Bin.Li (ornot2008@yahoo.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# #### END LICENSE BLOCK #####
+# /
+
+import json
+import os
+import shutil
+import xml.etree.ElementTree as ET
+
+import cv2
+import torch
+
+from mmap_tool import load_tensor, save_tensor
+
+
+def parse_voc_annotation(xml_path: str, label_names):
+    """Parses a VOC annotation file.
+
+    Args:
+        xml_path (str): path of the annotation file
+        label_names (tuple): label names, the index of a name is its category id
+
+    Returns:
+        bboxes (list): [n_objects,4], 0-based xyxy pixel indexes
+        category_ids (list): [n_objects,]
+        difficult (list): [n_objects,]
+        image_size (tuple): (height,width), (0,0) if the file has no size tag
+    """
+    annotation = ET.parse(xml_path)
+    bboxes = list()
+    category_ids = list()
+    difficult = list()
+    for obj in annotation.findall('object'):
+        difficult.append(int(obj.find('difficult').text))
+        boundingbox_annotation = obj.find('bndbox')
+        # subtract 1 to make pixel indexes 0-based and with format xyxy
+        bboxes.append([int(boundingbox_annotation.find(tag).text) - 1 for tag in ('xmin', 'ymin', 'xmax', 'ymax')])
+        name = obj.find('name').text.lower().strip()
+        category_ids.append(label_names.index(name))
+
+    size = annotation.find('size')
+    if size is not None:
+        image_size = (int(size.find('height').text), int(size.find('width').text))
+    else:
+        image_size = (0, 0)
+
+    return bboxes, category_ids, difficult, image_size
+
+
+class VOCAnnotationIndex:
+    """A memory-mapped index of all the annotations of a VOC split.
+
+    The xml files are parsed only once. The objects of all the images are concatenated
+    into contiguous arrays on disk and the objects of the i-th image are the rows
+    offsets[i]:offsets[i+1] of those arrays, so a lookup is a slice instead of a parse.
+
+    Layout of the index directory:
+        meta.json          version, ids of the split and the number of objects
+        bboxes.bin         int32 [n_objects,4], 0-based xyxy
+        category_ids.bin   int16 [n_objects,]
+        difficult.bin      uint8 [n_objects,]
+        offsets.bin        int64 [n_images+1,]
+        image_sizes.bin    int32 [n_images,2], (height,width) of the original images
+    """
+
+    VERSION = 1
+
+    def __init__(self, index_dir: str):
+        with open(os.path.join(index_dir, 'meta.json')) as f:
+            meta = json.load(f)
+
+        self.index_dir = index_dir
+        self.ids = meta['ids']
+        n_images = len(self.ids)
+        n_objects = meta['n_objects']
+
+        self.bboxes = load_tensor(os.path.join(index_dir, 'bboxes.bin'), torch.int32, (n_objects, 4))
+        self.category_ids = load_tensor(os.path.join(index_dir, 'category_ids.bin'), torch.int16, (n_objects,))
+        self.difficult = load_tensor(os.path.join(index_dir, 'difficult.bin'), torch.uint8, (n_objects,))
+        self.image_sizes = load_tensor(os.path.join(index_dir, 'image_sizes.bin'), torch.int32, (n_images, 2))
+
+        # the offsets are read on every lookup, keep them as python ints
+        self.offsets = load_tensor(os.path.join(index_dir, 'offsets.bin'), torch.int64, (n_images + 1,)).tolist()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, index: int):
+        """Gets the annotations of an image.
+
+        Args:
+            index (int): index of the image in the split
+
+        Returns:
+            bboxes (torch.Tensor): [n_objects,4] int32, 0-based xyxy
+            category_ids (torch.Tensor): [n_objects,] int16
+            difficult (torch.Tensor): [n_objects,] uint8
+        """
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return self.bboxes[start:end], self.category_ids[start:end], self.difficult[start:end]
+
+    def get_image_size(self, index: int):
+        """Gets the (height,width) of the original image."""
+        height, width = self.image_sizes[index].tolist()
+        return height, width
+
+    @staticmethod
+    def is_valid(index_dir: str, ids) -> bool:
+        meta_path = os.path.join(index_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return False
+        with open(meta_path) as f:
+            meta = json.load(f)
+        return meta.get('version') == VOCAnnotationIndex.VERSION and meta.get('ids') == list(ids)
+
+    @staticmethod
+    def build(data_dir: str, ids, index_dir: str, label_names):
+        """Parses all the annotations of the split and writes the index.
+
+        The index is written into a temporary directory which is renamed at the end,
+        so concurrent builders (e.g. several trainer processes) never see a partial index.
+        A valid index published by another builder in the meantime is kept, and a stale one is
+        renamed aside before it is deleted.
+        """
+        bboxes = list()
+        category_ids = list()
+        difficult = list()
+        offsets = [0]
+        image_sizes = list()
+
+        for id_ in ids:
+            image_bboxes, image_category_ids, image_difficult, image_size = parse_voc_annotation(
+                                                    os.path.join(data_dir, 'Annotations', id_ + '.xml'),
+                                                    label_names)
+            if image_size[0] <= 0 or image_size[1] <= 0:
+                image = cv2.imread(os.path.join(data_dir, 'JPEGImages', id_ + '.jpg'))
+                image_size = image.shape[:2]
+
+            bboxes.extend(image_bboxes)
+            category_ids.extend(image_category_ids)
+            difficult.extend(image_difficult)
+            offsets.append(len(bboxes))
+            image_sizes.append(list(image_size))
+
+        parent_dir = os.path.dirname(index_dir.rstrip('/'))
+        os.makedirs(parent_dir, exist_ok=True)
+        tmp_dir = index_dir.rstrip('/') + '.tmp{}'.format(os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        save_tensor(torch.tensor(bboxes, dtype=torch.int32).view(-1, 4), os.path.join(tmp_dir, 'bboxes.bin'))
+        save_tensor(torch.tensor(category_ids, dtype=torch.int16), os.path.join(tmp_dir, 'category_ids.bin'))
+        save_tensor(torch.tensor(difficult, dtype=torch.uint8), os.path.join(tmp_dir, 'difficult.bin'))
+        save_tensor(torch.tensor(offsets, dtype=torch.int64), os.path.join(tmp_dir, 'offsets.bin'))
+        save_tensor(torch.tensor(image_sizes, dtype=torch.int32).view(-1, 2), os.path.join(tmp_dir, 'image_sizes.bin'))
+
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(dict(version=VOCAnnotationIndex.VERSION, ids=list(ids), n_objects=len(bboxes)), f)
+
+        # another process may have published the index while this one was building it, which 
+        # the readers may already be mapping, so it is kept
+        if VOCAnnotationIndex.is_valid(index_dir, ids):
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+
+        # a stale index is renamed aside rather than deleted in place, so the index dir is 
+        # either the stale index or a complete one, and the files a reader has opened stay readable
+        if os.path.exists(index_dir):
+            stale_dir = index_dir.rstrip('/') + '.stale{}'.format(os.getpid())
+            try:
+                os.rename(index_dir, stale_dir)
+            except OSError:
+                # another process has just renamed it aside
+                stale_dir = None
+            if stale_dir is not None:
+                shutil.rmtree(stale_dir, ignore_errors=True)
+        try:
+            os.rename(tmp_dir, index_dir)
+        except OSError:
+            # another process has just published the same index
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    @staticmethod
+    def load_or_build(data_dir: str, ids, index_dir: str, label_names):
+        """Loads the index of the split, building it first if it is missing or stale."""
+        if not VOCAnnotationIndex.is_valid(index_dir, ids):
+            VOCAnnotationIndex.build(data_dir, ids, index_dir, label_names)
+        return VOCAnnotationIndex(index_dir)
@@ -25,7 +25,6 @@
 # /
 
 import os
-import xml.etree.ElementTree as ET
 
 import albumentations as A
 import cv2
@@ -34,6 +33,9 @@ import torch.utils.data as data
 from albumentations.augmentations.geometric.resize import (LongestMaxSize,SmallestMaxSize)
 from albumentations.pytorch import ToTensorV2
 
+from voc_annotation_index import VOCAnnotationIndex, parse_voc_annotation
+from voc_image_cache import VOCImageCache
+
 
 class VOCDataset(data.Dataset):
 
@@ -74,6 +76,25 @@ class VOCDataset(data.Dataset):
 
         self.label_names = VOCDataset.VOC_BBOX_LABEL_NAMES
 
+        self.cache_dir = config.VOC_DATASET.CACHE_DIR
+        if self.cache_dir is None:
+            self.cache_dir = os.path.join(self.data_dir, 'cache')
+
+        # parse the xml files once and memory-map the annotations instead of parsing them on every access
+        self.annotation_index = None
+        if config.VOC_DATASET.USE_ANNOTATION_INDEX:
+            self.annotation_index = VOCAnnotationIndex.load_or_build(self.data_dir,
+                                                                    self.ids,
+                                                                    os.path.join(self.cache_dir, 'annotation_index', split),
+                                                                    self.label_names)
+
+        # read pre-resized images from the cache written by build_cache.py
+        self.image_cache = None
+        if config.VOC_DATASET.USE_IMAGE_CACHE:
+            self.image_cache = VOCImageCache(os.path.join(self.cache_dir, 'image_cache', split))
+            if not self.image_cache.matches(config, self.ids):
+                raise ValueError('The image cache {} is stale, rebuild it with build_cache.py'.format(self.image_cache.cache_dir))
+
         self.augmented = config.VOC_DATASET.AUGMENTED
 
         self.transforms = A.Compose([
@@ -104,27 +125,122 @@ class VOCDataset(data.Dataset):
     def get_label_names(self):
         return self.label_names
 
+    def get_image_shape(self, index):
+        """Gets the (height,width) of the resized image without decoding it.
+
+        The shape is exact when the image cache is used, otherwise it is computed from the
+        original size recorded in the annotation index and may be off by a rounding pixel.
+        """
+        if self.image_cache is not None:
+            return self.image_cache.get_image_shape(index)
+
+        if self.annotation_index is not None:
+            height, width = self.annotation_index.get_image_size(index)
+        else:
+            height, width = cv2.imread(os.path.join(self.data_dir, 'JPEGImages', self.ids[index] + '.jpg')).shape[:2]
+
+        scale = self.config.VOC_DATASET.MIN_SIZE / min(height, width)
+        height, width = int(round(height * scale)), int(round(width * scale))
+        if max(height, width) > self.config.VOC_DATASET.MAX_SIZE:
+            scale = self.config.VOC_DATASET.MAX_SIZE / max(height, width)
+            height, width = int(round(height * scale)), int(round(width * scale))
+        return height, width
+
+    @staticmethod
+    def collate(batch):
+        """Collates items of different sizes into a batch.
+
+        The images are padded at the bottom and the right to the largest image of the batch
+        and the objects are padded to the image with the most objects.
+
+        Returns:
+            images (torch.Tensor): [B,3,H_max,W_max] uint8
+            bboxes (torch.Tensor): [B,M_max,4] yxyx, padded with 0
+            labels (torch.Tensor): [B,M_max] long, padded with -1
+            difficult (torch.Tensor): [B,M_max] uint8, padded with 0
+            ids (list): [B,]
+            scales (torch.Tensor): [B,] float64
+            image_sizes (torch.Tensor): [B,2] long, (height,width) before padding
+            n_objects (torch.Tensor): [B,] long, number of objects of each image
+        """
+        images, bboxes, category_ids, difficult, ids, scales = zip(*batch)
+
+        image_sizes = torch.tensor([list(image.shape[1:]) for image in images], dtype=torch.long)
+        max_height, max_width = image_sizes.max(dim=0)[0].tolist()
+        images_batch = images[0].new_zeros((len(images), images[0].shape[0], max_height, max_width))
+        for index, image in enumerate(images):
+            images_batch[index, :, :image.shape[1], :image.shape[2]] = image
+
+        n_objects = torch.tensor([len(category_id) for category_id in category_ids], dtype=torch.long)
+        max_objects = int(n_objects.max().item())
+        bboxes_batch = torch.zeros((len(images), max_objects, 4), dtype=torch.float32)
+        labels_batch = torch.full((len(images), max_objects), -1, dtype=torch.long)
+        difficult_batch = torch.zeros((len(images), max_objects), dtype=torch.uint8)
+        for index in range(len(images)):
+            n = n_objects[index].item()
+            bboxes_batch[index, :n] = bboxes[index].view(-1, 4)
+            labels_batch[index, :n] = category_ids[index]
+            n_difficult = min(len(difficult[index]), max_objects)
+            difficult_batch[index, :n_difficult] = difficult[index][:n_difficult]
+
+        scales = torch.tensor(scales, dtype=torch.float64)
+        return images_batch, bboxes_batch, labels_batch, difficult_batch, list(ids), scales, image_sizes, n_objects
+
     def __len__(self):
         return len(self.ids)
     
     def __getitem__(self, index):
         id_ = self.ids[index]
+
+        if self.image_cache is not None:
+            # already decoded and resized, only the random flip is left to do
+            image, bboxes, category_id, difficult, scale = self.image_cache.get(index)
+            if self.augmented and torch.rand(1).item() < 0.5:
+                image, bboxes = self._horizontal_flip(image, bboxes)
+
+            # xyxy -> yxyx
+            bboxes = bboxes[:,[1,0,3,2]]
+            return image, bboxes, category_id.long(), difficult, id_, scale
+
+        image, bboxes, category_id, difficult, scale = self._load_resized(index)
+
+        if self.augmented:
+            augmented = self.transforms(image=image, bboxes=bboxes, category_id=category_id)
+            image = augmented['image']
+            bboxes = augmented['bboxes']
+            category_id = augmented['category_id']    
         
-        annotation = ET.parse(os.path.join(self.data_dir, 'Annotations', id_ + '.xml'))
-        bboxes =     list()
-        category_id =    list()
-        difficult = list()
-        for obj in annotation.findall('object'):
-            # when in not using difficult split, and the object is difficult, skipt it.
-            if not self.use_difficult and int(obj.find('difficult').text) == 1:
-                continue
-            difficult.append(int(obj.find('difficult').text))
-            boundingbox_annotation = obj.find('bndbox')
-            # subtract 1 to make pixel indexes 0-based and with format xyxy
-            bboxes.append([int(boundingbox_annotation.find(tag).text) - 1 for tag in ('xmin', 'ymin', 'xmax', 'ymax')])
-            name = obj.find('name').text.lower().strip()
-            category_id.append(VOCDataset.VOC_BBOX_LABEL_NAMES.index(name))
+        # HWC->CHW  
+        image = self.toTensor(image=image)['image']
+        bboxes = torch.tensor(bboxes,dtype=torch.float32)[:,[1,0,3,2]]
+        
+        category_id = torch.tensor(category_id,dtype=torch.long)
+        difficult = torch.tensor(difficult, dtype=torch.uint8)
         
+        return image, bboxes,category_id, difficult,id_,scale
+
+    def load_resized(self, index):
+        """Loads an image resized to MIN_SIZE/MAX_SIZE, without any random augmentation.
+
+        Returns:
+            image (torch.Tensor): [3,H,W] uint8
+            bboxes (torch.Tensor): [n_objects,4] float32, xyxy
+            category_id (torch.Tensor): [n_objects,] long
+            difficult (torch.Tensor): [n_objects,] uint8
+            scale (float): resized height / original height
+        """
+        image, bboxes, category_id, difficult, scale = self._load_resized(index)
+        image = self.toTensor(image=image)['image']
+        bboxes = torch.tensor(bboxes,dtype=torch.float32).view(-1,4)
+        category_id = torch.tensor(category_id,dtype=torch.long)
+        difficult = torch.tensor(difficult, dtype=torch.uint8)
+        return image, bboxes, category_id, difficult, scale
+
+    def _load_resized(self, index):
+        id_ = self.ids[index]
+        
+        bboxes, category_id, difficult = self._load_annotation(index)
+
         image_file = os.path.join(self.data_dir, 'JPEGImages', id_ + '.jpg')
         # HWC
         image = cv2.imread(image_file)
@@ -146,19 +262,34 @@ class VOCDataset(data.Dataset):
             bboxes = scale_longest_max_size['bboxes']
             category_id = scale_longest_max_size['category_id']
 
+        scale = image.shape[0]/original_height
 
-        if self.augmented:
-            augmented = self.transforms(image=image, bboxes=bboxes, category_id=category_id)
-            image = augmented['image']
-            bboxes = augmented['bboxes']
-            category_id = augmented['category_id']    
-        
-        # HWC->CHW  
-        image = self.toTensor(image=image)['image']
-        bboxes = torch.tensor(bboxes,dtype=torch.float32)[:,[1,0,3,2]]
-        
-        category_id = torch.tensor(category_id,dtype=torch.long)
-        difficult = torch.tensor(difficult, dtype=torch.uint8)
-        scale = image.shape[1]/original_height
-        
-        return image, bboxes,category_id, difficult,id_,scale
+        return image, bboxes, category_id, difficult, scale
+
+    @staticmethod
+    def _horizontal_flip(image, bboxes):
+        """Flips a [C,H,W] image and its xyxy bboxes horizontally, as A.HorizontalFlip does.
+        """
+        width = image.shape[2]
+        image = image.flip(2)
+        bboxes = torch.stack((width - bboxes[:,2], bboxes[:,1], width - bboxes[:,0], bboxes[:,3]), dim=1)
+        return image, bboxes
+
+    def _load_annotation(self, index):
+        """Loads the bboxes (0-based xyxy), category ids and difficult flags of an image.
+        """
+        if self.annotation_index is not None:
+            bboxes, category_id, difficult = self.annotation_index.get(index)
+        else:
+            bboxes, category_id, difficult, _ = parse_voc_annotation(os.path.join(self.data_dir, 'Annotations', self.ids[index] + '.xml'),
+                                                                    self.label_names)
+            bboxes = torch.tensor(bboxes, dtype=torch.int32).view(-1, 4)
+            category_id = torch.tensor(category_id, dtype=torch.int16)
+            difficult = torch.tensor(difficult, dtype=torch.uint8)
+
+        # when in not using difficult split, and the object is difficult, skipt it.
+        if not self.use_difficult:
+            keep = difficult == 0
+            bboxes, category_id, difficult = bboxes[keep], category_id[keep], difficult[keep]
+
+        return bboxes.tolist(), category_id.tolist(), difficult.tolist()
@@ -0,0 +1,212 @@
+# #### BEGIN LICENSE BLOCK #####
+# MIT License
+#    
+# Copyright (c) 2021 Bin.Li (ornot2008@yahoo.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# #### END LICENSE BLOCK #####
+# /
+
+import json
+import os
+import shutil
+
+import torch
+from torch.utils.data import DataLoader, Dataset
+
+from mmap_tool import load_tensor, save_tensor
+
+
+class VOCImageCache:
+    """A sharded, memory-mapped store of the resized images of a VOC split.
+
+    The images are stored as uint8 CHW arrays, already resized to MIN_SIZE/MAX_SIZE, together
+    with their rescaled bboxes and scales. Reading an item is a slice of a memory-mapped shard,
+    so there is no decode or resize work left in the dataloader workers.
+
+    Layout of the cache directory:
+        meta.json          version, ids, resize settings, number of objects and shards
+        shard_<k>.bin      uint8, the concatenated images of shard k
+        image_shards.bin   int32 [n_images,], shard of each image
+        image_offsets.bin  int64 [n_images,], offset of each image in its shard
+        image_shapes.bin   int32 [n_images,3], (C,H,W) of each image
+        scales.bin         float64 [n_images,], resized height / original height
+        bboxes.bin         float32 [n_objects,4], xyxy in the resized image
+        category_ids.bin   int16 [n_objects,]
+        difficult.bin      uint8 [n_objects,]
+        offsets.bin        int64 [n_images+1,], objects of image i are offsets[i]:offsets[i+1]
+    """
+
+    VERSION = 1
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        meta_path = os.path.join(cache_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            raise FileNotFoundError('No image cache in {}, build it with build_cache.py'.format(cache_dir))
+
+        with open(meta_path) as f:
+            self.meta = json.load(f)
+
+        n_images = len(self.meta['ids'])
+        n_objects = self.meta['n_objects']
+
+        self.shards = [load_tensor(os.path.join(cache_dir, 'shard_{}.bin'.format(k)), torch.uint8, (shard_size,))
+                        for k, shard_size in enumerate(self.meta['shard_sizes'])]
+
+        # the per-image records are small, keep them as python lists for cheap lookups
+        self.image_shards = load_tensor(os.path.join(cache_dir, 'image_shards.bin'), torch.int32, (n_images,)).tolist()
+        self.image_offsets = load_tensor(os.path.join(cache_dir, 'image_offsets.bin'), torch.int64, (n_images,)).tolist()
+        self.image_shapes = load_tensor(os.path.join(cache_dir, 'image_shapes.bin'), torch.int32, (n_images, 3)).tolist()
+        self.scales = load_tensor(os.path.join(cache_dir, 'scales.bin'), torch.float64, (n_images,)).tolist()
+        self.offsets = load_tensor(os.path.join(cache_dir, 'offsets.bin'), torch.int64, (n_images + 1,)).tolist()
+
+        self.bboxes = load_tensor(os.path.join(cache_dir, 'bboxes.bin'), torch.float32, (n_objects, 4))
+        self.category_ids = load_tensor(os.path.join(cache_dir, 'category_ids.bin'), torch.int16, (n_objects,))
+        self.difficult = load_tensor(os.path.join(cache_dir, 'difficult.bin'), torch.uint8, (n_objects,))
+
+    def __len__(self):
+        return len(self.image_offsets)
+
+    def matches(self, config, ids) -> bool:
+        """Whether the cache was built for the given ids and resize settings."""
+        return (self.meta['version'] == VOCImageCache.VERSION and
+                self.meta['ids'] == list(ids) and
+                self.meta['min_size'] == config.VOC_DATASET.MIN_SIZE and
+                self.meta['max_size'] == config.VOC_DATASET.MAX_SIZE and
+                self.meta['use_difficult'] == config.VOC_DATASET.USE_DIFFICULT_LABEL)
+
+    def get(self, index: int):
+        """Gets a cached item.
+
+        Returns:
+            image (torch.Tensor): [C,H,W] uint8
+            bboxes (torch.Tensor): [n_objects,4] float32, xyxy
+            category_ids (torch.Tensor): [n_objects,] int16
+            difficult (torch.Tensor): [n_objects,] uint8
+            scale (float): resized height / original height
+        """
+        channels, height, width = self.image_shapes[index]
+        offset = self.image_offsets[index]
+        image = self.shards[self.image_shards[index]][offset:offset + channels * height * width].view(channels, height, width)
+
+        start, end = self.offsets[index], self.offsets[index + 1]
+        return image, self.bboxes[start:end], self.category_ids[start:end], self.difficult[start:end], self.scales[index]
+
+    def get_image_shape(self, index: int):
+        """Gets the (height,width) of the cached image."""
+        _, height, width = self.image_shapes[index]
+        return height, width
+
+    @staticmethod
+    def build(dataset, cache_dir: str, num_workers: int = 0, shard_size_mb: int = 1024):
+        """Decodes and resizes all the images of a dataset and writes them into the cache.
+
+        Args:
+            dataset (VOCDataset): dataset to cache, its load_resized gives the cached items
+            cache_dir (str): destination directory
+            num_workers (int): number of processes decoding the images
+            shard_size_mb (int): a new shard is started when the current one exceeds this size
+        """
+        tmp_dir = cache_dir.rstrip('/') + '.tmp{}'.format(os.getpid())
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        shard_limit = shard_size_mb * 1024 * 1024
+        shard_sizes = list()
+        shard_images = list()
+        shard_size = 0
+
+        image_shards = list()
+        image_offsets = list()
+        image_shapes = list()
+        scales = list()
+        bboxes = list()
+        category_ids = list()
+        difficult = list()
+        offsets = [0]
+
+        def flush_shard():
+            save_tensor(torch.cat(shard_images) if len(shard_images) > 0 else torch.empty((0,), dtype=torch.uint8),
+                        os.path.join(tmp_dir, 'shard_{}.bin'.format(len(shard_sizes))))
+            shard_sizes.append(shard_size)
+
+        # batch_size=None keeps the items as they are, the workers only parallelize the decoding
+        loader = DataLoader(_ResizedItems(dataset), batch_size=None, shuffle=False, num_workers=num_workers)
+        for image, image_bboxes, image_category_ids, image_difficult, scale in loader:
+            assert len(image_bboxes) == len(image_difficult), 'bboxes were dropped by the resize'
+
+            n_bytes = image.numel()
+            if shard_size > 0 and shard_size + n_bytes > shard_limit:
+                flush_shard()
+                shard_images = list()
+                shard_size = 0
+
+            image_shards.append(len(shard_sizes))
+            image_offsets.append(shard_size)
+            image_shapes.append(list(image.shape))
+            scales.append(scale)
+            shard_images.append(image.contiguous().view(-1))
+            shard_size += n_bytes
+
+            bboxes.append(image_bboxes)
+            category_ids.append(image_category_ids.to(torch.int16))
+            difficult.append(image_difficult)
+            offsets.append(offsets[-1] + len(image_bboxes))
+
+        flush_shard()
+
+        save_tensor(torch.tensor(image_shards, dtype=torch.int32), os.path.join(tmp_dir, 'image_shards.bin'))
+        save_tensor(torch.tensor(image_offsets, dtype=torch.int64), os.path.join(tmp_dir, 'image_offsets.bin'))
+        save_tensor(torch.tensor(image_shapes, dtype=torch.int32).view(-1, 3), os.path.join(tmp_dir, 'image_shapes.bin'))
+        save_tensor(torch.tensor(scales, dtype=torch.float64), os.path.join(tmp_dir, 'scales.bin'))
+        save_tensor(torch.tensor(offsets, dtype=torch.int64), os.path.join(tmp_dir, 'offsets.bin'))
+        save_tensor(torch.cat(bboxes) if len(bboxes) > 0 else torch.empty((0, 4)), os.path.join(tmp_dir, 'bboxes.bin'))
+        save_tensor(torch.cat(category_ids) if len(category_ids) > 0 else torch.empty((0,), dtype=torch.int16),
+                    os.path.join(tmp_dir, 'category_ids.bin'))
+        save_tensor(torch.cat(difficult) if len(difficult) > 0 else torch.empty((0,), dtype=torch.uint8),
+                    os.path.join(tmp_dir, 'difficult.bin'))
+
+        config = dataset.config
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump(dict(version=VOCImageCache.VERSION,
+                            ids=list(dataset.ids),
+                            min_size=config.VOC_DATASET.MIN_SIZE,
+                            max_size=config.VOC_DATASET.MAX_SIZE,
+                            use_difficult=config.VOC_DATASET.USE_DIFFICULT_LABEL,
+                            n_objects=offsets[-1],
+                            shard_sizes=shard_sizes), f)
+
+        # publish the new cache in place of the old one
+        if os.path.exists(cache_dir):
+            shutil.rmtree(cache_dir)
+        os.makedirs(os.path.dirname(cache_dir.rstrip('/')), exist_ok=True)
+        os.rename(tmp_dir, cache_dir)
+
+
+class _ResizedItems(Dataset):
+    """The un-augmented, resized items of a VOCDataset."""
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, index):
+        return self.dataset.load_resized(index)
@@ -0,0 +1,141 @@
+# #### BEGIN LICENSE BLOCK #####
+# MIT License
+#    
+# Copyright (c) 2021 Bin.Li (ornot2008@yahoo.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# #### END LICENSE BLOCK #####
+# /
+
+
+import time
+
+import torch
+import torch.nn as nn
+
+def measure_latency(fn, *args, warmup: int = 2, repeats: int = 10):
+    """Measures the mean wall time of a function call.
+
+    Args:
+        fn: function to measure
+        args: arguments of the function
+        warmup (int): number of calls before the measurement
+        repeats (int): number of the measured calls
+
+    Returns:
+        float: mean latency in seconds
+    """
+    with torch.no_grad():
+        for _ in range(warmup):
+            fn(*args)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+        start = time.perf_counter()
+        for _ in range(repeats):
+            fn(*args)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    return (time.perf_counter() - start) / repeats
+
+def elapsed_seconds(start: float, device) -> float:
+    """Gets the wall time since start, a time.perf_counter value, after the kernels queued on a 
+    cuda device have finished.
+    """
+    if torch.device(device).type == 'cuda':
+        torch.cuda.synchronize(device)
+    return time.perf_counter() - start
+
+def reset_peak_memory(device):
+    """Resets the peak memory statistics of a cuda device, see peak_memory_mb.
+    """
+    if torch.device(device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def peak_memory_mb(device) -> float:
+    """Gets the peak allocated memory of a cuda device in MB since the last reset_peak_memory. 
+    
+    There is no resettable counterpart on cpu, use SavedActivationMeter to measure a step there.
+
+    Args:
+        device: the cuda device the model runs on
+    """
+    assert torch.device(device).type == 'cuda', 'the peak memory is only tracked on cuda'
+    return torch.cuda.max_memory_allocated(device) / 2**20
+
+
+class SavedActivationMeter(object):
+    """Counts the size of the activations autograd saves for the backward within the context, 
+    which is the activation memory of a step held until its backward. Unlike the peak memory it 
+    is measured per step on cpu as well as on cuda.
+
+    The parameters and their views saved e.g. by the linears are not activations and are left out, 
+    and the tensors sharing a storage are counted once, by the size of the storage they keep alive.
+    """
+
+    def __init__(self):
+        self.n_bytes = 0
+        self.storages = set()
+        self.hooks = None
+
+    def _pack(self, tensor):
+        if isinstance(tensor, nn.Parameter) or isinstance(tensor._base, nn.Parameter):
+            return tensor
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in self.storages:
+            self.storages.add(storage.data_ptr())
+            self.n_bytes += storage.nbytes()
+        return tensor
+
+    @property
+    def mb(self) -> float:
+        return self.n_bytes / 2**20
+
+    def __enter__(self):
+        self.n_bytes = 0
+        self.storages = set()
+        self.hooks = torch.autograd.graph.saved_tensors_hooks(self._pack, lambda tensor: tensor)
+        self.hooks.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        # the tensors saved within the context are still unpacked in their backward
+        self.hooks.__exit__(*exc_info)
+        self.hooks = None
+        self.storages = set()
+
+
+def saved_activation_mb(fn, *args) -> float:
+    """Measures the size of the tensors autograd saves for the backward while running a function, 
+    which is the activation memory held until backward. It works on cpu as well as on cuda.
+
+    Args:
+        fn: function to measure
+        args: arguments of the function
+
+    Returns:
+        float: size of the saved tensors in MB
+    """
+    with SavedActivationMeter() as meter:
+        fn(*args)
+
+    return meter.mb
@@ -24,38 +24,58 @@
 # #### END LICENSE BLOCK #####
 # /
 
+import hashlib
 import os
+import pickle
+from collections import OrderedDict
 import shutil
+import threading
+import traceback
 
 import torch
 
-def save_checkpoint(state, save_path: str, is_best: bool = False, max_keep: int = None):
+# the first bytes of a checkpoint in the memory-mapped layout, see save_mmap_checkpoint
+MMAP_MAGIC = b'LTMMAP01'
+# the tensor data are aligned, so the bytes can be viewed as any dtype
+MMAP_ALIGNMENT = 64
+
+def save_checkpoint(state, save_path: str, is_best: bool = False, max_keep: int = None, mmap_layout: bool = False):
     """Saves torch model to checkpoint file.
 
+    The checkpoint is written to a temporary file which is then renamed, so a crash during the
+    write never leaves a truncated checkpoint behind.
+
     Args:
         state (torch model state): State of a torch Neural Network
         save_path (str): Destination path for saving checkpoint
-        is_best (bool): If ``True`` creates additional copy
+        is_best (bool): If ``True`` creates additional link
             ``best_model.ckpt``
         max_keep (int): Specifies the max amount of checkpoints to keep
+        mmap_layout (bool): If ``True`` saves in the layout of save_mmap_checkpoint, whose
+            tensors are memory-mapped by load_checkpoint
     """
 
-    save_dir = save_path[:save_path.rindex('/')]
+    save_dir = os.path.dirname(save_path)
 
     ensure_dir(save_dir)
 
     # save checkpoint
-    torch.save(state, save_path)
+    tmp_path = save_path + '.tmp'
+    if mmap_layout:
+        save_mmap_checkpoint(state, tmp_path)
+    else:
+        torch.save(state, tmp_path)
+    os.replace(tmp_path, save_path)
 
     # deal with max_keep
-    save_dir = os.path.dirname(save_path)
     list_path = os.path.join(save_dir, 'latest_checkpoint.txt')
 
     save_path_ = os.path.basename(save_path)
     if os.path.exists(list_path):
         with open(list_path) as f:
             ckpt_list = f.readlines()
-            ckpt_list = [save_path_ + '\n'] + ckpt_list
+            # a checkpoint saved again under the same name is the latest one, not an old one to remove
+            ckpt_list = [save_path_ + '\n'] + [ckpt for ckpt in ckpt_list if ckpt != save_path_ + '\n']
     else:
         ckpt_list = [save_path_ + '\n']
 
@@ -66,23 +86,272 @@ def save_checkpoint(state, save_path: str, is_best: bool = False, max_keep: int
                 os.remove(ckpt)
         ckpt_list[max_keep:] = []
 
-    with open(list_path, 'w') as f:
+    with open(list_path + '.tmp', 'w') as f:
         f.writelines(ckpt_list)
+    os.replace(list_path + '.tmp', list_path)
 
-    # copy best
+    # link best, the checkpoint is replaced by a new file next time, so the link keeps this one
     if is_best:
         dst_path = os.path.join(save_dir, 'best_model.ckpt')
-        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
-        shutil.copyfile(save_path, dst_path)
+        tmp_dst_path = dst_path + '.tmp'
+        if os.path.exists(tmp_dst_path):
+            os.remove(tmp_dst_path)
+        try:
+            os.link(save_path, tmp_dst_path)
+        except OSError:
+            # the file system doesn't support hard links
+            shutil.copyfile(save_path, tmp_dst_path)
+        os.replace(tmp_dst_path, dst_path)
+
+
+def map_tensors(state, fn, types=torch.Tensor):
+    """Applies a function to the tensors of a (nested) state, keeping its structure.
+
+    Args:
+        state: tensor, or dict, list or tuple holding them, e.g. a checkpoint
+        fn: function applied to each tensor
+        types: types the function is applied to
+    """
+    if isinstance(state, types):
+        return fn(state)
+    if isinstance(state, dict):
+        mapped = type(state)((key, map_tensors(value, fn, types)) for key, value in state.items())
+        # the state dicts of the modules carry the versions of the modules
+        if hasattr(state, '_metadata'):
+            mapped._metadata = state._metadata
+        return mapped
+    if isinstance(state, (list, tuple)):
+        return type(state)(map_tensors(value, fn, types) for value in state)
+    return state
+
+
+def snapshot_to_cpu(state):
+    """Copies the tensors of a (nested) state to cpu, so the training can go on updating the
+    parameters while the snapshot is being saved.
+    """
+    return map_tensors(state, lambda tensor: tensor.detach().to('cpu', copy=True))
+
+
+class CheckpointWriter(object):
+    """Saves the checkpoints by save_checkpoint in a background thread.
+
+    The state is snapshotted to cpu on the calling thread and serialized in the background, so
+    the training only waits for the snapshot, or for the previous save if it is still in flight.
+    """
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def save(self, state, save_path: str, is_best: bool = False, max_keep: int = None, mmap_layout: bool = False):
+        """Saves a checkpoint in the background, see save_checkpoint for the arguments."""
+        self.wait()
+
+        snapshot = snapshot_to_cpu(state)
+        self.thread = threading.Thread(target=self._save, args=(snapshot, save_path, is_best, max_keep, mmap_layout), daemon=True)
+        self.thread.start()
+
+    def wait(self):
+        """Blocks until the save in flight is done, raises the error of the save if it failed."""
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _save(self, state, save_path, is_best, max_keep, mmap_layout):
+        try:
+            save_checkpoint(state, save_path, is_best=is_best, max_keep=max_keep, mmap_layout=mmap_layout)
+        except Exception as error:
+            # reported at once as well, the process may be killed before the next save or wait raises it
+            print('saving the checkpoint {} failed:'.format(save_path))
+            traceback.print_exc()
+            self.error = error
+
+
+class _TensorRef(object):
+    """Placeholder of a tensor stored in the data section of a memory-mapped checkpoint."""
+    def __init__(self, offset: int, dtype: torch.dtype, shape):
+        self.offset = offset
+        self.dtype = dtype
+        self.shape = tuple(shape)
+
+
+def _align(n_bytes: int) -> int:
+    return (n_bytes + MMAP_ALIGNMENT - 1) // MMAP_ALIGNMENT * MMAP_ALIGNMENT
+
+
+def save_mmap_checkpoint(state: dict, save_path: str):
+    """Saves a checkpoint in the memory-mapped layout:
+
+        MMAP_MAGIC | header size (8 bytes) | header | aligned raw bytes of the tensors
+
+    The header is a pickled dict holding a separately pickled skeleton of each top level entry of 
+    the state, in which the dense tensors are replaced by their offsets in the data section. So an 
+    entry is loaded without unpickling the others and its tensors are mapped rather than read.
+
+    Args:
+        state (dict): checkpoint to save, e.g. the model, the optimizer and the scheduler states
+        save_path (str): Destination path for saving checkpoint
+    """
+    tensors = list()
+    data_size = 0
+
+    def strip(tensor):
+        nonlocal data_size
+        # the quantized and the sparse tensors stay pickled in the skeleton
+        if tensor.layout != torch.strided or tensor.is_quantized:
+            return tensor
+        offset = data_size
+        tensors.append((offset, tensor))
+        data_size = _align(offset + tensor.numel() * tensor.element_size())
+        return _TensorRef(offset, tensor.dtype, tensor.shape)
+
+    skeletons = {key: pickle.dumps(map_tensors(value, strip)) for key, value in state.items()}
+    header = pickle.dumps(skeletons)
+    data_start = _align(len(MMAP_MAGIC) + 8 + len(header))
+
+    with open(save_path, 'wb') as f:
+        f.write(MMAP_MAGIC)
+        f.write(len(header).to_bytes(8, 'little'))
+        f.write(header)
+        f.truncate(data_start + data_size)
 
+    if data_size > 0:
+        # write through a shared mapping of the file, like mmap_tool.save_tensor
+        buffer = torch.from_file(save_path, shared=True, size=data_start + data_size, dtype=torch.uint8)
+        for offset, tensor in tensors:
+            if tensor.dtype == torch.bool:
+                tensor = tensor.to(torch.uint8)
+            tensor = tensor.detach().cpu().contiguous().view(-1)
+            n_bytes = tensor.numel() * tensor.element_size()
+            if n_bytes > 0:
+                buffer[data_start + offset:data_start + offset + n_bytes].copy_(tensor.view(torch.uint8))
+        del buffer
 
-def load_checkpoint(ckpt_dir_or_file: str, map_location=None, load_best=False):
+
+def is_mmap_checkpoint(ckpt_path: str) -> bool:
+    with open(ckpt_path, 'rb') as f:
+        return f.read(len(MMAP_MAGIC)) == MMAP_MAGIC
+
+
+def load_mmap_checkpoint(ckpt_path: str, keys=None, map_location=None) -> dict:
+    """Loads a checkpoint saved by save_mmap_checkpoint.
+
+    The tensors are private memory maps of the file, their pages are only read when they are 
+    accessed (e.g. copied into a model by load_state_dict) and writes to them never reach the file.
+
+    Args:
+        ckpt_path (str): checkpoint file
+        keys (list): top level entries to load, None for all of them
+        map_location: device to move the tensors to, None to keep them mapped on cpu
+    """
+    with open(ckpt_path, 'rb') as f:
+        f.read(len(MMAP_MAGIC))
+        header_size = int.from_bytes(f.read(8), 'little')
+        skeletons = pickle.loads(f.read(header_size))
+    data_start = _align(len(MMAP_MAGIC) + 8 + header_size)
+
+    file_size = os.path.getsize(ckpt_path)
+    buffer = torch.from_file(ckpt_path, shared=False, size=file_size, dtype=torch.uint8) if file_size > data_start else None
+    device = torch.device(map_location) if map_location is not None else None
+
+    def restore(value):
+        if isinstance(value, _TensorRef):
+            dtype = torch.uint8 if value.dtype == torch.bool else value.dtype
+            numel = 1
+            for dim in value.shape:
+                numel *= dim
+            if numel == 0:
+                tensor = torch.empty(value.shape, dtype=dtype)
+            else:
+                start = data_start + value.offset
+                n_bytes = numel * torch.empty(0, dtype=dtype).element_size()
+                tensor = buffer[start:start + n_bytes].view(dtype).view(value.shape)
+            if value.dtype == torch.bool:
+                tensor = tensor.to(torch.bool)
+        else:
+            tensor = value
+        return tensor if device is None else tensor.to(device)
+
+    if keys is None:
+        keys = skeletons.keys()
+    return {key: map_tensors(pickle.loads(skeletons[key]), restore, (_TensorRef, torch.Tensor)) for key in keys if key in skeletons}
+
+
+def save_frozen_base(model_state: dict, frozen_names, save_dir: str, mmap_layout: bool = False) -> str:
+    """Saves the frozen parameters of a model once into a base file named by the hash of its content, 
+    which the incremental checkpoints made by strip_frozen refer to.
+
+    Args:
+        model_state (dict): state dict of the model
+        frozen_names (list): names of the parameters which are never updated
+        save_dir (str): directory of the checkpoints
+        mmap_layout (bool): If ``True`` saves in the layout of save_mmap_checkpoint
+
+    Returns:
+        str: file name of the base file in save_dir
+    """
+    ensure_dir(save_dir)
+
+    base_state = {'model': OrderedDict((name, model_state[name]) for name in frozen_names)}
+    tmp_path = os.path.join(save_dir, 'frozen_base.ckpt.tmp')
+    if mmap_layout:
+        save_mmap_checkpoint(base_state, tmp_path)
+    else:
+        torch.save(base_state, tmp_path)
+
+    digest = hashlib.sha1()
+    with open(tmp_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            digest.update(chunk)
+    base_name = 'frozen_{}.ckpt'.format(digest.hexdigest()[:16])
+
+    base_path = os.path.join(save_dir, base_name)
+    if os.path.exists(base_path):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, base_path)
+    return base_name
+
+
+def strip_frozen(state: dict, model_key: str, base_name: str, frozen_names) -> dict:
+    """Makes an incremental checkpoint, whose model state holds the trainable parameters and the 
+    buffers only. The frozen parameters are put back from the base file by load_checkpoint, so the
+    base file must stay in the directory of the checkpoint.
+
+    Args:
+        state (dict): checkpoint
+        model_key (str): entry of the model state in the checkpoint
+        base_name (str): base file returned by save_frozen_base
+        frozen_names (list): names of the parameters saved in the base file
+    """
+    frozen_names = set(frozen_names)
+    model_state = state[model_key]
+    stripped_model_state = OrderedDict((name, value) for name, value in model_state.items() if name not in frozen_names)
+    if hasattr(model_state, '_metadata'):
+        stripped_model_state._metadata = model_state._metadata
+
+    stripped_state = dict(state)
+    stripped_state[model_key] = stripped_model_state
+    stripped_state['frozen_base'] = {'file': base_name, 'key': model_key}
+    return stripped_state
+
+
+def load_checkpoint(ckpt_dir_or_file: str, map_location=None, load_best=False, keys=None):
     """Loads torch model from checkpoint file.
 
     Args:
         ckpt_dir_or_file (str): Path to checkpoint directory or filename
         map_location: Can be used to directly load to specific device
         load_best (bool): If True loads ``best_model.ckpt`` if exists.
+        keys (list): If given only loads these top level entries, e.g. the model state without 
+            the optimizer state. The checkpoints in the memory-mapped layout load nothing else, 
+            the others are loaded fully and filtered.
+
+    The frozen parameters of an incremental checkpoint (see strip_frozen) are loaded from its base 
+    file into its model state.
     """
     if os.path.isdir(ckpt_dir_or_file):
         if load_best:
@@ -92,7 +361,25 @@ def load_checkpoint(ckpt_dir_or_file: str, map_location=None, load_best=False):
                 ckpt_path = os.path.join(ckpt_dir_or_file, f.readline()[:-1])
     else:
         ckpt_path = ckpt_dir_or_file
-    ckpt = torch.load(ckpt_path, map_location=map_location)
+
+    load_keys = None if keys is None else list(keys) + ['frozen_base']
+    if is_mmap_checkpoint(ckpt_path):
+        ckpt = load_mmap_checkpoint(ckpt_path, keys=load_keys, map_location=map_location)
+    else:
+        ckpt = torch.load(ckpt_path, map_location=map_location)
+        if keys is not None:
+            ckpt = {key: ckpt[key] for key in load_keys if key in ckpt}
+
+    frozen_base = ckpt.pop('frozen_base', None)
+    if frozen_base is not None and frozen_base['key'] in ckpt:
+        base_path = os.path.join(os.path.dirname(ckpt_path), frozen_base['file'])
+        model_state = load_checkpoint(base_path, map_location=map_location)['model']
+        stripped_model_state = ckpt[frozen_base['key']]
+        model_state.update(stripped_model_state)
+        if hasattr(stripped_model_state, '_metadata'):
+            model_state._metadata = stripped_model_state._metadata
+        ckpt[frozen_base['key']] = model_state
+
     print(' [*] Loading checkpoint from %s succeed!' % ckpt_path)
     return ckpt
 
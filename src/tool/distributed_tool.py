@@ -0,0 +1,129 @@
+# #### BEGIN LICENSE BLOCK #####
+# MIT License
+#    
+# Copyright (c) 2021 Bin.Li (ornot2008@yahoo.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# #### END LICENSE BLOCK #####
+# /
+
+"""
+Helpers of the multi-process data parallel training, launched by torchrun, e.g.
+
+    torchrun --nnodes=2 --nproc_per_node=4 --rdzv_backend=c10d --rdzv_endpoint=<host>:29500 train.py
+
+torchrun sets OMP_NUM_THREADS to 1 for every process, so set it to the number of cores per process.
+"""
+
+import math
+import os
+
+import torch
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.sampler import Sampler
+
+
+def init_distributed(backend: str = 'gloo') -> bool:
+    """Joins the process group if the process was launched by torchrun with more than one process.
+
+    Returns:
+        bool: whether the run is distributed
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return False
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend, init_method='env://')
+    return True
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def is_distributed() -> bool:
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank() -> int:
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size() -> int:
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def get_local_rank() -> int:
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_main_process() -> bool:
+    """Only the main process writes the logs and the checkpoints."""
+    return get_rank() == 0
+
+
+def all_gather_objects(objects: list) -> list:
+    """Gathers the picklable objects of all of the processes.
+
+    Args:
+        objects (list): objects of this process, the tensors in them should be on cpu
+
+    Returns:
+        list: the objects of all of the processes in the order of the ranks
+    """
+    if not is_distributed():
+        return objects
+    objects_per_rank = [None] * get_world_size()
+    dist.all_gather_object(objects_per_rank, objects)
+    return [obj for rank_objects in objects_per_rank for obj in rank_objects]
+
+
+class DistributedModule(DistributedDataParallel):
+    """DistributedDataParallel with the explicit predict interface of the modules of the repo.
+    The gradients are averaged across the processes in backward only if the module is called
+    through the wrapper.
+    """
+    def predict(self, *args, **kwargs):
+        return self.forward(*args, **kwargs)
+
+
+def wrap_distributed(module: torch.nn.Module, device) -> DistributedModule:
+    """Wraps a module for the data parallel training, the module should be on the device."""
+    device = torch.device(device)
+    if device.type == 'cuda':
+        return DistributedModule(module, device_ids=[device])
+    return DistributedModule(module)
+
+
+class ShardSampler(Sampler):
+    """Samples the indices rank, rank+world_size, ... in order, so the shards of the processes cover
+    the dataset exactly once. Unlike the DistributedSampler nothing is padded, which evaluation needs.
+    """
+    def __init__(self, dataset, rank: int = None, world_size: int = None):
+        self.n_samples = len(dataset)
+        self.rank = get_rank() if rank is None else rank
+        self.world_size = get_world_size() if world_size is None else world_size
+
+    def __iter__(self):
+        return iter(range(self.rank, self.n_samples, self.world_size))
+
+    def __len__(self):
+        return max(0, math.ceil((self.n_samples - self.rank) / self.world_size))
@@ -47,4 +47,67 @@ def intersection_over_union(boxes_preds, boxes_labels, box_format="midpoint"):
     box1_area = abs((box1_x2 - box1_x1) * (box1_y2 - box1_y1))
     box2_area = abs((box2_x2 - box2_x1) * (box2_y2 - box2_y1))
 
-    return intersection / (box1_area + box2_area - intersection + 1e-6)
\ No newline at end of file
+    return intersection / (box1_area + box2_area - intersection + 1e-6)
+
+
+def pairwise_iou(boxes1, boxes2, box_format="midpoint"):
+    """
+    Calculates intersection over union of every pair of boxes. Swapping the x and the y of both
+    boxes swaps the factors of the areas only, so the (y1,x1,y2,x2) boxes of the detectors are
+    passed as they are
+
+    Parameters:
+        boxes1 (tensor): Bounding Boxes (N, 4)
+        boxes2 (tensor): Bounding Boxes (M, 4)
+        box_format (str): midpoint/corners, if boxes (x,y,w,h) or (x1,y1,x2,y2)
+
+    Returns:
+        tensor: (N, M) intersection over union of boxes1[i] and boxes2[j]
+    """
+
+    return intersection_over_union(boxes1[:, None, :], boxes2[None, :, :], box_format=box_format)[..., 0]
+
+
+def batched_pairwise_iou(boxes1, boxes2, box_format="midpoint"):
+    """
+    Calculates intersection over union of every pair of boxes of each batch, e.g. of the
+    detections and the ground truths of each image
+
+    Parameters:
+        boxes1 (tensor): Bounding Boxes (B, N, 4)
+        boxes2 (tensor): Bounding Boxes (B, M, 4)
+        box_format (str): midpoint/corners, if boxes (x,y,w,h) or (x1,y1,x2,y2)
+
+    Returns:
+        tensor: (B, N, M) intersection over union of boxes1[b, i] and boxes2[b, j]
+    """
+
+    return intersection_over_union(boxes1[:, :, None, :], boxes2[:, None, :, :], box_format=box_format)[..., 0]
+
+
+def chunked_pairwise_iou(boxes1, boxes2, box_format="midpoint", chunk_size=1024, threshold=None):
+    """
+    Calculates the same as pairwise_iou, chunk_size rows at a time, so the intermediate
+    tensors take chunk_size*M rather than N*M elements. The output is still a dense (N, M)
+    tensor; with threshold it is the (N, M) bool tensor of the IoUs above it, which takes a
+    byte per pair rather than the 4 of the IoU, for the callers which only compare the IoUs
+    with a threshold such as the hard nms
+
+    Parameters:
+        boxes1 (tensor): Bounding Boxes (N, 4)
+        boxes2 (tensor): Bounding Boxes (M, 4)
+        box_format (str): midpoint/corners, if boxes (x,y,w,h) or (x1,y1,x2,y2)
+        chunk_size (int): number of the rows computed at a time
+        threshold (float): None for the IoUs, otherwise whether they are above it
+
+    Returns:
+        tensor: (N, M) intersection over union of boxes1[i] and boxes2[j], or whether it is
+        above threshold
+    """
+
+    dtype = torch.bool if threshold is not None else torch.promote_types(boxes1.dtype, torch.float32)
+    ious = torch.empty((len(boxes1), len(boxes2)), dtype=dtype, device=boxes1.device)
+    for start in range(0, len(boxes1), chunk_size):
+        chunk_ious = pairwise_iou(boxes1[start:start + chunk_size], boxes2, box_format=box_format)
+        ious[start:start + chunk_size] = chunk_ious if threshold is None else chunk_ious > threshold
+    return ious
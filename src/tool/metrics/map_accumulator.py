@@ -0,0 +1,176 @@
+# #### BEGIN LICENSE BLOCK #####
+# MIT License
+#    
+# Copyright (c) 2021 Bin.Li (ornot2008@yahoo.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# #### END LICENSE BLOCK #####
+# /
+
+import torch
+from torchvision.ops import box_iou
+
+
+class MAPAccumulator(object):
+    """
+    Streaming COCO-style mean average precision, computed the same way as the MAP of torchmetrics
+    (area range all, at most max_detections per image and class) without keeping the boxes
+
+    Every update matches the detections of its images with their ground truths at once, only the
+    score and the true positive flag per IoU threshold of each detection and the number of the
+    ground truths are kept per class, so the memory is a few bytes per detection. The
+    accumulators of the parts of a dataset, e.g. of the processes of a distributed evaluation,
+    are merged into the accumulator of the whole dataset.
+    """
+
+    def __init__(self, iou_thresholds=None, rec_thresholds=None, max_detections=100):
+        """
+        Args:
+            iou_thresholds (list): IoU thresholds, 0.5:0.05:0.95 if None
+            rec_thresholds (list): recall thresholds the precision is sampled at, 0:0.01:1 if None
+            max_detections (int): max number of the detections of a class in an image
+        """
+
+        self.iou_thresholds = torch.tensor(iou_thresholds) if iou_thresholds is not None else torch.linspace(0.5, 0.95, 10)
+        self.rec_thresholds = torch.tensor(rec_thresholds) if rec_thresholds is not None else torch.linspace(0.0, 1.00, 101)
+        self.max_detections = max_detections
+        self.reset()
+
+    def reset(self):
+        # class -> list of the (n_detections,) scores and the (n_detections, n_iou_thresholds) true positive flags
+        self.scores = dict()
+        self.true_positives = dict()
+        # class -> number of the ground truths
+        self.n_ground_truths = dict()
+
+    def update(self, preds, target):
+        """
+        Matches the detections of some images with their ground truths
+
+        Args:
+            preds (list): a dict per image of the detected 'boxes' (n, 4) xyxy, their 'scores' (n,)
+            and 'labels' (n,), as the update of torchmetrics MAP takes
+            target (list): a dict per image of the ground truth 'boxes' (m, 4) xyxy and 'labels' (m,)
+        """
+
+        for pred, gt in zip(preds, target):
+            pred_labels, gt_labels = pred['labels'].cpu(), gt['labels'].cpu()
+            for class_id in torch.cat((pred_labels, gt_labels)).unique().tolist():
+                pred_mask, gt_mask = pred_labels == class_id, gt_labels == class_id
+                self._update_class(class_id,
+                                   pred['boxes'].cpu()[pred_mask].float(),
+                                   pred['scores'].cpu()[pred_mask].float(),
+                                   gt['boxes'].cpu()[gt_mask].float())
+
+    def _update_class(self, class_id, boxes, scores, gt_boxes):
+        scores, order = torch.sort(scores, descending=True, stable=True)
+        scores, boxes = scores[:self.max_detections], boxes[order[:self.max_detections]]
+
+        n_thresholds, n_gt = len(self.iou_thresholds), len(gt_boxes)
+        true_positives = torch.zeros((len(boxes), n_thresholds), dtype=torch.bool)
+        if len(boxes) > 0 and n_gt > 0:
+            ious = box_iou(boxes, gt_boxes)
+            gt_matched = torch.zeros((n_thresholds, n_gt), dtype=torch.bool)
+            thresholds = torch.arange(n_thresholds)
+            # each detection in the order of the scores matches the unmatched ground truth it
+            # overlaps most at every threshold at once, the last of the equal ones like coco does
+            for det_idx in range(len(boxes)):
+                candidates = ~gt_matched & (ious[det_idx][None] >= self.iou_thresholds[:, None])
+                candidate_ious = ious[det_idx][None].masked_fill(~candidates, -1)
+                best = n_gt - 1 - candidate_ious.flip(1).argmax(dim=1)
+                matched = candidates.any(dim=1)
+                true_positives[det_idx] = matched
+                gt_matched[thresholds[matched], best[matched]] = True
+
+        self.scores.setdefault(class_id, []).append(scores)
+        self.true_positives.setdefault(class_id, []).append(true_positives)
+        self.n_ground_truths[class_id] = self.n_ground_truths.get(class_id, 0) + n_gt
+
+    def merge(self, other):
+        """
+        Adds the detections and the ground truths of another accumulator of the same thresholds
+
+        Args:
+            other (MAPAccumulator): accumulator of another part of the dataset
+
+        Returns:
+            MAPAccumulator: self
+        """
+
+        for class_id in other.n_ground_truths:
+            self.scores.setdefault(class_id, []).extend(other.scores[class_id])
+            self.true_positives.setdefault(class_id, []).extend(other.true_positives[class_id])
+            self.n_ground_truths[class_id] = self.n_ground_truths.get(class_id, 0) + other.n_ground_truths[class_id]
+        return self
+
+    def compute(self):
+        """
+        Calculates the metrics over all of the updates
+
+        Returns:
+            dict: 'map', 'map_50' and 'map_75' averaged over the classes with ground truths (and
+            over the IoU thresholds for 'map'), 'mar_100' the recall averaged alike, -1 if there
+            is no ground truth
+        """
+
+        n_thresholds = len(self.iou_thresholds)
+        # (n_iou_thresholds, n_rec_thresholds) precisions and (n_iou_thresholds,) recalls of the classes
+        precisions, recalls = [], []
+        for class_id in sorted(self.n_ground_truths):
+            n_gt = self.n_ground_truths[class_id]
+            if n_gt == 0:
+                continue
+
+            scores = torch.cat(self.scores[class_id])
+            order = torch.sort(scores, descending=True, stable=True).indices
+            true_positives = torch.cat(self.true_positives[class_id])[order].T
+
+            tp_sum = torch.cumsum(true_positives, dim=1, dtype=torch.float)
+            fp_sum = torch.cumsum(~true_positives, dim=1, dtype=torch.float)
+            rc = tp_sum / n_gt
+            pr = tp_sum / (tp_sum + fp_sum + torch.finfo(torch.float64).eps)
+            # the precision at a recall is the max precision at the recalls not below it
+            pr = pr.flip(1).cummax(dim=1).values.flip(1)
+
+            precision = torch.zeros((n_thresholds, len(self.rec_thresholds)))
+            recalls.append(rc[:, -1] if rc.shape[1] > 0 else torch.zeros(n_thresholds))
+            for threshold_idx in range(n_thresholds):
+                inds = torch.searchsorted(rc[threshold_idx].contiguous(), self.rec_thresholds, right=False)
+                valid = inds < rc.shape[1]
+                precision[threshold_idx, valid] = pr[threshold_idx, inds[valid]]
+            precisions.append(precision)
+
+        if not precisions:
+            return dict(map=torch.tensor(-1.0), map_50=torch.tensor(-1.0), map_75=torch.tensor(-1.0), mar_100=torch.tensor(-1.0))
+
+        precisions = torch.stack(precisions)
+        recalls = torch.stack(recalls)
+        return dict(
+            map=precisions.mean(),
+            map_50=self._at_threshold(precisions, 0.5),
+            map_75=self._at_threshold(precisions, 0.75),
+            mar_100=recalls.mean(),
+        )
+
+    def _at_threshold(self, precisions, iou_threshold):
+        matches = torch.isclose(self.iou_thresholds, torch.tensor(iou_threshold)).nonzero().squeeze(1)
+        if len(matches) == 0:
+            return torch.tensor(-1.0)
+        return precisions[:, matches[0]].mean()
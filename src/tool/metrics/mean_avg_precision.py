@@ -1,112 +1,127 @@
 import torch
-from collections import Counter
 
-from iou import intersection_over_union
+from iou import batched_pairwise_iou
 
 def mean_average_precision(
     pred_boxes, true_boxes, iou_threshold=0.5, box_format="midpoint", num_classes=20
 ):
     """
-    Calculates mean average precision 
+    Calculates mean average precision
+
+    The detections and the ground truths are grouped per class and per image, the IoUs of
+    the detections with the ground truths of their images are computed in one batch and the
+    greedy matching is done with tensor ops, which gives the same result as matching the
+    detections one by one in the order of their scores.
 
     Parameters:
         pred_boxes (list): list of lists containing all bboxes with each bboxes
         specified as [train_idx, class_prediction, prob_score, x1, y1, x2, y2]
-        true_boxes (list): Similar as pred_boxes except all the correct ones 
-        iou_threshold (float): threshold where predicted bboxes is correct
+        true_boxes (list): Similar as pred_boxes except all the correct ones
+        iou_threshold (float or list): threshold where predicted bboxes is correct,
+        a list of thresholds is evaluated in a single pass
         box_format (str): "midpoint" or "corners" used to specify bboxes
         num_classes (int): number of classes
 
     Returns:
-        float: mAP value across all classes given a specific IoU threshold 
+        float: mAP value across all classes given a specific IoU threshold,
+        a list of them if iou_threshold is a list
     """
 
-    # list storing all AP for respective classes
-    average_precisions = []
+    iou_thresholds = iou_threshold if isinstance(iou_threshold, (list, tuple)) else [iou_threshold]
+
+    # the ids and the scores are kept in double to compare and sort them like the python
+    # numbers, the boxes are in float like torch.tensor makes them
+    pred_boxes = torch.as_tensor(pred_boxes, dtype=torch.float64).reshape(-1, 7)
+    true_boxes = torch.as_tensor(true_boxes, dtype=torch.float64).reshape(-1, 7)
+
+    # list storing all AP for respective classes, for each threshold
+    average_precisions = [[] for _ in iou_thresholds]
 
     # used for numerical stability later on
     epsilon = 1e-6
 
     for c in range(num_classes):
-        detections = []
-        ground_truths = []
-
-        # Go through all predictions and targets,
-        # and only add the ones that belong to the
-        # current class c
-        for detection in pred_boxes:
-            if detection[1] == c:
-                detections.append(detection)
-
-        for true_box in true_boxes:
-            if true_box[1] == c:
-                ground_truths.append(true_box)
-
-        # find the amount of bboxes for each training example
-        # Counter here finds how many ground truth bboxes we get
-        # for each training example, so let's say img 0 has 3,
-        # img 1 has 5 then we will obtain a dictionary with:
-        # amount_bboxes = {0:3, 1:5}
-        amount_bboxes = Counter([gt[0] for gt in ground_truths])
-
-        # We then go through each key, val in this dictionary
-        # and convert to the following (w.r.t same example):
-        # ammount_bboxes = {0:torch.tensor[0,0,0], 1:torch.tensor[0,0,0,0,0]}
-        for key, val in amount_bboxes.items():
-            amount_bboxes[key] = torch.zeros(val)
-
-        # sort by box probabilities which is index 2
-        detections.sort(key=lambda x: x[2], reverse=True)
-        TP = torch.zeros((len(detections)))
-        FP = torch.zeros((len(detections)))
+        detections = pred_boxes[pred_boxes[:, 1] == c]
+        ground_truths = true_boxes[true_boxes[:, 1] == c]
         total_true_bboxes = len(ground_truths)
-        
+
         # If none exists for this class then we can safely skip
         if total_true_bboxes == 0:
             continue
 
-        for detection_idx, detection in enumerate(detections):
-            # Only take out the ground_truths that have the same
-            # training idx as detection
-            ground_truth_img = [
-                bbox for bbox in ground_truths if bbox[0] == detection[0]
-            ]
-
-            num_gts = len(ground_truth_img)
-            best_iou = 0
-
-            for idx, gt in enumerate(ground_truth_img):
-                iou = intersection_over_union(
-                    torch.tensor(detection[3:]),
-                    torch.tensor(gt[3:]),
-                    box_format=box_format,
-                )
-
-                if iou > best_iou:
-                    best_iou = iou
-                    best_gt_idx = idx
-
-            if best_iou > iou_threshold:
-                # only detect ground truth detection once
-                if amount_bboxes[detection[0]][best_gt_idx] == 0:
-                    # true positive and add this bounding box to seen
-                    TP[detection_idx] = 1
-                    amount_bboxes[detection[0]][best_gt_idx] = 1
-                else:
-                    FP[detection_idx] = 1
-
-            # if IOU is lower then the detection is a false positive
-            else:
-                FP[detection_idx] = 1
-
-        TP_cumsum = torch.cumsum(TP, dim=0)
-        FP_cumsum = torch.cumsum(FP, dim=0)
-        recalls = TP_cumsum / (total_true_bboxes + epsilon)
-        precisions = TP_cumsum / (TP_cumsum + FP_cumsum + epsilon)
-        precisions = torch.cat((torch.tensor([1]), precisions))
-        recalls = torch.cat((torch.tensor([0]), recalls))
-        # torch.trapz for numerical integration
-        average_precisions.append(torch.trapz(precisions, recalls))
-
-    return sum(average_precisions) / len(average_precisions)
+        # sort by box probabilities, the stable sort keeps the order of the ties
+        order = torch.sort(detections[:, 2], descending=True, stable=True).indices
+        detections = detections[order]
+
+        best_ious, best_gt_keys = _match_detections(detections, ground_truths, box_format)
+
+        for threshold_idx, threshold in enumerate(iou_thresholds):
+            # a ground truth is detected by the first detection matching it best, the
+            # later ones are false positives
+            TP = torch.zeros((len(detections)))
+            positives = (best_ious > threshold).nonzero().squeeze(1)
+            keys, key_order = torch.sort(best_gt_keys[positives], stable=True)
+            first = torch.ones_like(keys, dtype=torch.bool)
+            first[1:] = keys[1:] != keys[:-1]
+            TP[positives[key_order[first]]] = 1
+            FP = 1 - TP
+
+            TP_cumsum = torch.cumsum(TP, dim=0)
+            FP_cumsum = torch.cumsum(FP, dim=0)
+            recalls = TP_cumsum / (total_true_bboxes + epsilon)
+            precisions = TP_cumsum / (TP_cumsum + FP_cumsum + epsilon)
+            precisions = torch.cat((torch.tensor([1]), precisions))
+            recalls = torch.cat((torch.tensor([0]), recalls))
+            # torch.trapz for numerical integration
+            average_precisions[threshold_idx].append(torch.trapz(precisions, recalls))
+
+    mean_average_precisions = [sum(aps) / len(aps) for aps in average_precisions]
+    if isinstance(iou_threshold, (list, tuple)):
+        return mean_average_precisions
+    return mean_average_precisions[0]
+
+
+def _match_detections(detections, ground_truths, box_format):
+    """
+    Finds the ground truth of the same image each detection overlaps most
+
+    Parameters:
+        detections (tensor): (D, 7) detections of a class sorted by their scores
+        ground_truths (tensor): (G, 7) ground truths of the class
+        box_format (str): "midpoint" or "corners" used to specify bboxes
+
+    Returns:
+        tensor: (D,) best IoU of each detection, 0 if its image has no ground truth
+        tensor: (D,) key of the best ground truth of each detection, unique over the images
+    """
 
+    # pad the ground truths of each image into a row, in their original order
+    images, gt_image_idx = torch.unique(ground_truths[:, 0], return_inverse=True)
+    counts = torch.bincount(gt_image_idx, minlength=len(images))
+    max_count = counts.max().item()
+    starts = torch.cumsum(counts, dim=0) - counts
+    gt_order = torch.sort(gt_image_idx, stable=True).indices
+    gt_rows = gt_image_idx[gt_order]
+    gt_columns = torch.arange(len(ground_truths)) - starts[gt_rows]
+
+    padded_boxes = torch.zeros((len(images), max_count, 4))
+    padded_boxes[gt_rows, gt_columns] = ground_truths[gt_order, 3:].float()
+    valid = torch.zeros((len(images), max_count), dtype=torch.bool)
+    valid[gt_rows, gt_columns] = True
+
+    # the row of the image of each detection
+    det_image_idx = torch.searchsorted(images, detections[:, 0]).clamp(max=len(images) - 1)
+    has_ground_truth = images[det_image_idx] == detections[:, 0]
+
+    ious = batched_pairwise_iou(
+        detections[:, None, 3:].float(),
+        padded_boxes[det_image_idx],
+        box_format=box_format,
+    )[:, 0]
+    ious = torch.where(valid[det_image_idx], ious, torch.zeros_like(ious))
+
+    # the first of the equal best ious wins like in the one by one matching
+    best_ious, best_gt_idx = ious.max(dim=1)
+    best_ious = torch.where(has_ground_truth, best_ious, torch.zeros_like(best_ious))
+
+    return best_ious, det_image_idx * max_count + best_gt_idx
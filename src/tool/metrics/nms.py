@@ -1,15 +1,21 @@
 import torch
-from iou import intersection_over_union
+from torchvision import ops
+
+from iou import chunked_pairwise_iou
 
 def nms(bboxes, iou_threshold, threshold, box_format="corners"):
     """
     Does Non Max Suppression given bboxes
 
+    The IoUs of all pairs of the boxes are computed at once, the boxes are then chosen
+    in the order of their scores and each choice suppresses the boxes of its class
+    overlapping it with a single tensor op.
+
     Parameters:
         bboxes (list): list of lists containing all bboxes with each bboxes
         specified as [class_pred, prob_score, x1, y1, x2, y2]
         iou_threshold (float): threshold where predicted bboxes is correct
-        threshold (float): threshold to remove predicted bboxes (independent of IoU) 
+        threshold (float): threshold to remove predicted bboxes (independent of IoU)
         box_format (str): "midpoint" or "corners" used to specify bboxes
 
     Returns:
@@ -20,23 +26,264 @@ def nms(bboxes, iou_threshold, threshold, box_format="corners"):
 
     bboxes = [box for box in bboxes if box[1] > threshold]
     bboxes = sorted(bboxes, key=lambda x: x[1], reverse=True)
+    if not bboxes:
+        return []
+
+    classes = torch.tensor([box[0] for box in bboxes], dtype=torch.float64)
+    boxes = torch.tensor([box[2:] for box in bboxes])
+    ious = chunked_pairwise_iou(boxes, boxes, box_format=box_format)
+    # a box is suppressed by a chosen box of the same class overlapping it enough
+    suppressing = (classes[:, None] == classes[None, :]) & (ious >= iou_threshold)
+
     bboxes_after_nms = []
+    suppressed = torch.zeros(len(bboxes), dtype=torch.bool)
+    for box_idx, box in enumerate(bboxes):
+        if suppressed[box_idx]:
+            continue
+        bboxes_after_nms.append(box)
+        suppressed |= suppressing[box_idx]
 
-    while bboxes:
-        chosen_box = bboxes.pop(0)
+    return bboxes_after_nms
 
-        bboxes = [
-            box
-            for box in bboxes
-            if box[0] != chosen_box[0]
-            or intersection_over_union(
-                torch.tensor(chosen_box[2:]),
-                torch.tensor(box[2:]),
-                box_format=box_format,
-            )
-            < iou_threshold
-        ]
 
-        bboxes_after_nms.append(chosen_box)
+# The tensor nms methods below share one interface:
+#
+#     keep, kept_scores = method(boxes, scores, labels, iou_threshold, score_threshold, sigma)
+#
+# boxes are (N, 4) corners, either (x1,y1,x2,y2) or (y1,x1,y2,x2) as the IoU doesn't depend on the
+# order, scores and labels are (N,). keep indexes the kept boxes sorted by kept_scores from the
+# highest to the lowest, kept_scores are the scores after the suppression, the soft and the matrix
+# nms decay the scores rather than drop the boxes. The boxes whose scores are not above
+# score_threshold are dropped.
 
-    return bboxes_after_nms
+def _greedy_nms(scores, overlaps, score_threshold, decays=None):
+    """
+    The greedy nms, which keeps the remaining box of the highest score and suppresses the boxes it
+    overlaps until no box is left, in parallel rounds. A remaining box ranked above all of the
+    remaining boxes it overlaps is kept by the greedy nms before any of them, with its current
+    score, so all of such boxes are kept in one round and suppress the boxes they overlap at once.
+    The number of the rounds is the length of the longest chain of the overlapping boxes of
+    decreasing scores rather than the number of the kept boxes.
+
+    Parameters:
+        scores (tensor): (N,) scores
+        overlaps (tensor): (N, N) symmetric, whether the boxes i and j suppress each other, False
+        on the diagonal
+        score_threshold (float): boxes of the scores not above it are dropped
+        decays (tensor): (N, N) factors the score of the box j is multiplied by when the box i is
+        kept, None to drop the overlapped boxes
+
+    Returns:
+        see hard_nms
+    """
+
+    scores = scores.clone()
+    remaining = scores > score_threshold
+    kept = torch.zeros_like(remaining)
+    positions = torch.arange(len(scores), device=scores.device)
+
+    while remaining.any():
+        # the ties of the scores are broken by the index, like the greedy nms does
+        order = torch.sort(scores.masked_fill(~remaining, -float('inf')), descending=True, stable=True).indices
+        ranks = torch.empty_like(order)
+        ranks[order] = positions
+        ranked_above = overlaps & remaining[:, None] & (ranks[:, None] < ranks[None, :])
+        picked = remaining & ~ranked_above.any(dim=0)
+
+        kept |= picked
+        remaining &= ~picked
+        suppressing = overlaps & picked[:, None] & remaining[None, :]
+        if decays is None:
+            remaining &= ~suppressing.any(dim=0)
+        else:
+            scores = scores * torch.where(suppressing, decays, torch.ones_like(decays)).prod(dim=0)
+            remaining &= scores > score_threshold
+
+    keep = kept.nonzero().squeeze(1)
+    keep = keep[torch.sort(scores[keep], descending=True, stable=True).indices]
+    return keep, scores[keep]
+
+
+def hard_nms(boxes, scores, labels, iou_threshold, score_threshold=0.0, sigma=0.5):
+    """
+    Greedy nms over all of the boxes regardless of their labels, the box of the highest score is
+    kept and the boxes overlapping it by more than iou_threshold are dropped, until no box is left.
+    It is class-agnostic, so get_nms rejects it for the class-wise suppression
+
+    Parameters:
+        boxes (tensor): (N, 4) corners
+        scores (tensor): (N,) scores
+        labels (tensor): (N,) labels, not used
+        iou_threshold (float): boxes overlapping a kept box by more than it are dropped
+        score_threshold (float): boxes of the scores not above it are dropped
+        sigma (float): not used
+
+    Returns:
+        tensor: (K,) indices of the kept boxes
+        tensor: (K,) scores of the kept boxes
+    """
+
+    overlaps = chunked_pairwise_iou(boxes, boxes, box_format="corners", threshold=iou_threshold)
+    overlaps.fill_diagonal_(False)
+    return _greedy_nms(scores, overlaps, score_threshold)
+
+
+def batched_nms(boxes, scores, labels, iou_threshold, score_threshold=0.0, sigma=0.5):
+    """
+    Class-aware hard nms, the boxes of different labels never suppress each other, so all of the
+    labels are suppressed at once
+
+    Parameters:
+        see hard_nms, the labels are used
+
+    Returns:
+        see hard_nms
+    """
+
+    overlaps = chunked_pairwise_iou(boxes, boxes, box_format="corners", threshold=iou_threshold)
+    overlaps &= labels[:, None] == labels[None, :]
+    overlaps.fill_diagonal_(False)
+    return _greedy_nms(scores, overlaps, score_threshold)
+
+
+def _soft_nms(boxes, scores, labels, score_threshold, decay, suppressed):
+    ious = chunked_pairwise_iou(boxes, boxes, box_format="corners")
+    overlaps = suppressed(ious) & (labels[:, None] == labels[None, :])
+    overlaps.fill_diagonal_(False)
+    return _greedy_nms(scores, overlaps, score_threshold, decay(ious))
+
+
+def soft_nms_linear(boxes, scores, labels, iou_threshold, score_threshold=0.0, sigma=0.5):
+    """
+    Soft-NMS with the linear decay (Bodla et al. 2017), the box of the highest score is kept and
+    the scores of the boxes of its label overlapping it by more than iou_threshold are multiplied
+    by 1 - IoU, until no box is left
+
+    Parameters:
+        see hard_nms, the labels are used, sigma is not
+
+    Returns:
+        see hard_nms
+    """
+
+    return _soft_nms(boxes, scores, labels, score_threshold,
+                     lambda ious: 1 - ious, lambda ious: ious > iou_threshold)
+
+
+def soft_nms_gaussian(boxes, scores, labels, iou_threshold, score_threshold=0.0, sigma=0.5):
+    """
+    Soft-NMS with the gaussian decay, the scores of the boxes of the label of a kept box are
+    multiplied by exp(-IoU^2 / sigma)
+
+    Parameters:
+        see hard_nms, the labels and sigma are used, iou_threshold is not
+
+    Returns:
+        see hard_nms
+    """
+
+    return _soft_nms(boxes, scores, labels, score_threshold,
+                     lambda ious: torch.exp(-ious ** 2 / sigma), lambda ious: ious > 0)
+
+
+def _matrix_nms(boxes, scores, labels, score_threshold, decay):
+    order = torch.sort(scores, descending=True, stable=True).indices
+    order = order[scores[order] > score_threshold]
+    if len(order) == 0:
+        return order, scores[order]
+
+    sorted_labels = labels[order]
+    # ious[i, j] is the IoU of the box j with the higher scored box i of its label
+    ious = chunked_pairwise_iou(boxes[order], boxes[order], box_format="corners").triu(diagonal=1)
+    ious = ious * (sorted_labels[:, None] == sorted_labels[None, :])
+    # how much the box i is suppressed itself, which compensates its suppression of the others
+    max_ious = ious.max(dim=0).values
+
+    decayed_scores = scores[order] * decay(ious, max_ious[:, None]).min(dim=0).values
+    kept = decayed_scores > score_threshold
+    order, decayed_scores = order[kept], decayed_scores[kept]
+
+    resort = torch.sort(decayed_scores, descending=True, stable=True).indices
+    return order[resort], decayed_scores[resort]
+
+
+def matrix_nms_linear(boxes, scores, labels, iou_threshold, score_threshold=0.0, sigma=0.5):
+    """
+    Matrix NMS with the linear decay (Wang et al. 2020, SOLOv2), the scores of all of the boxes
+    are decayed in parallel from the IoU matrix, each by its worst (1 - IoU) / (1 - IoU_max) over
+    the higher scored boxes of its label, where IoU_max is how much the suppressing box overlaps
+    the boxes above it
+
+    Parameters:
+        see hard_nms, the labels are used, iou_threshold and sigma are not
+
+    Returns:
+        see hard_nms
+    """
+
+    return _matrix_nms(boxes, scores, labels, score_threshold,
+                       lambda ious, max_ious: (1 - ious) / (1 - max_ious).clamp(min=1e-6))
+
+
+def matrix_nms_gaussian(boxes, scores, labels, iou_threshold, score_threshold=0.0, sigma=0.5):
+    """
+    Matrix NMS with the gaussian decay exp(-(IoU^2 - IoU_max^2) / sigma)
+
+    Parameters:
+        see hard_nms, the labels and sigma are used, iou_threshold is not
+
+    Returns:
+        see hard_nms
+    """
+
+    return _matrix_nms(boxes, scores, labels, score_threshold,
+                       lambda ious, max_ious: torch.exp(-(ious ** 2 - max_ious ** 2) / sigma))
+
+
+def torchvision_nms(boxes, scores, labels, iou_threshold, score_threshold=0.0, sigma=0.5):
+    """
+    Class-aware hard nms by the kernel of torchvision.ops.batched_nms, the reference of the others
+
+    Parameters:
+        see hard_nms, the labels are used
+
+    Returns:
+        see hard_nms
+    """
+
+    candidates = (scores > score_threshold).nonzero().squeeze(1)
+    keep = candidates[ops.batched_nms(boxes[candidates], scores[candidates], labels[candidates], iou_threshold)]
+    return keep, scores[keep]
+
+
+NMS_METHODS = {
+    'torchvision': torchvision_nms,
+    'hard': hard_nms,
+    'batched': batched_nms,
+    'soft_linear': soft_nms_linear,
+    'soft_gaussian': soft_nms_gaussian,
+    'matrix_linear': matrix_nms_linear,
+    'matrix_gaussian': matrix_nms_gaussian,
+}
+
+
+# the methods suppressing the boxes of all of the labels together
+CLASS_AGNOSTIC_NMS_METHODS = ['hard']
+
+
+def get_nms(method, class_aware=False):
+    """
+    Gets the tensor nms method of a name in NMS_METHODS
+
+    Parameters:
+        method (str): name of the method
+        class_aware (bool): whether the boxes of different labels must not suppress each other,
+        the class-agnostic methods are rejected then
+    """
+
+    if method not in NMS_METHODS:
+        raise ValueError("nms method should be one of {}, but got {}".format(list(NMS_METHODS), method))
+    if class_aware and method in CLASS_AGNOSTIC_NMS_METHODS:
+        raise ValueError("nms method {} suppresses the boxes of all of the labels together, use a class-aware "
+                         "one such as 'batched' instead".format(method))
+    return NMS_METHODS[method]
@@ -0,0 +1,73 @@
+# #### BEGIN LICENSE BLOCK #####
+# MIT License
+#    
+# Copyright (c) 2021 Bin.Li (ornot2008@yahoo.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# #### END LICENSE BLOCK #####
+# /
+
+import torch
+
+def save_tensor(tensor: torch.Tensor, path: str):
+    """Writes the raw bytes of a tensor to a file which can be memory-mapped by load_tensor.
+
+    Args:
+        tensor (torch.Tensor): tensor to write, bool tensors are stored as uint8
+        path (str): destination file
+    """
+    if tensor.dtype == torch.bool:
+        tensor = tensor.to(torch.uint8)
+    tensor = tensor.contiguous().view(-1)
+    n_bytes = tensor.numel() * tensor.element_size()
+
+    with open(path, 'wb') as f:
+        f.truncate(n_bytes)
+
+    if n_bytes > 0:
+        # write through a shared mapping of the file to avoid a round trip through numpy
+        buffer = torch.from_file(path, shared=True, size=n_bytes, dtype=torch.uint8)
+        buffer.copy_(tensor.view(torch.uint8))
+        del buffer
+
+
+def load_tensor(path: str, dtype: torch.dtype, shape) -> torch.Tensor:
+    """Memory-maps a file written by save_tensor as a read-only tensor.
+
+    The pages are only read from disk when they are accessed and they are shared by
+    all the processes mapping the same file (e.g. the dataloader workers).
+
+    Args:
+        path (str): file written by save_tensor
+        dtype (torch.dtype): dtype of the tensor
+        shape (list or tuple): shape of the tensor
+
+    Returns:
+        torch.Tensor: tensor backed by the file
+    """
+    numel = 1
+    for dim in shape:
+        numel *= dim
+
+    if numel == 0:
+        return torch.empty(shape, dtype=dtype)
+
+    # shared=False maps the file privately, writes to the tensor never reach the file
+    return torch.from_file(path, shared=False, size=numel, dtype=dtype).view(*shape)
@@ -0,0 +1,115 @@
+# #### BEGIN LICENSE BLOCK #####
+# MIT License
+#    
+# Copyright (c) 2021 Bin.Li (ornot2008@yahoo.com)
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+#
+# #### END LICENSE BLOCK #####
+# /
+
+import hashlib
+import io
+import os
+
+import torch
+
+# the configs of the suppression of the detections, which don't change the cached predictions
+POST_PROCESS_KEYS = ['SCORE_THRESHOLD', 'NMS_THRESHOLD', 'NMS_METHOD', 'NMS_SIGMA', 'MAX_DETECTIONS']
+
+def state_dict_hash(state_dict: dict) -> str:
+    """Hashes the content of a state dict, so the same weights give the same hash wherever they
+    were loaded from.
+    """
+    digest = hashlib.sha1()
+    for name in sorted(state_dict):
+        value = state_dict[name]
+        digest.update(name.encode())
+        if isinstance(value, torch.Tensor) and value.layout == torch.strided and not value.is_quantized:
+            digest.update(str((value.dtype, tuple(value.shape))).encode())
+            digest.update(value.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+        else:
+            # e.g. the packed params of the quantized head
+            buffer = io.BytesIO()
+            torch.save(value, buffer)
+            digest.update(buffer.getvalue())
+    return digest.hexdigest()
+
+
+def prediction_key(weights_hash: str, config) -> str:
+    """Hashes the weights of a model, i.e. their state_dict_hash, and the config it predicts with, 
+    leaving out the configs of the suppression, so the evaluations which differ in the thresholds 
+    of the suppression only share the key.
+    """
+    config = config.clone()
+    config.defrost()
+    for section in ['FASTER_RCNN', 'R_FCN']:
+        for key in POST_PROCESS_KEYS:
+            config[section][key] = None
+    config.TEST.PREDICTION_CACHE_DIR = None
+
+    digest = hashlib.sha1()
+    digest.update(weights_hash.encode())
+    digest.update(config.dump().encode())
+    return digest.hexdigest()[:16]
+
+
+class PredictionCache(object):
+    """On-disk cache of the raw predictions of a model, i.e. the proposed rois, the decoded bboxes 
+    of every class and the class probabilities before the suppression, with the ground truths of 
+    the images. An evaluation with other thresholds of the suppression reads the predictions back 
+    rather than running the network again.
+
+    The predictions of a model are in a directory named by prediction_key, one file per image.
+    """
+    def __init__(self, cache_dir: str, weights_hash: str, config) -> None:
+        """
+        Args:
+            cache_dir (str): root directory of the caches of all of the models
+            weights_hash (str): state_dict_hash of the weights of the model, computed once per 
+                                loaded checkpoint by the caller
+            config (CfgNode): config of the evaluation
+        """
+        self.cache_dir = os.path.join(cache_dir, prediction_key(weights_hash, config))
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, img_id: str) -> str:
+        return os.path.join(self.cache_dir, '{}.pt'.format(img_id))
+
+    def contains(self, img_ids) -> bool:
+        """Whether the predictions of all of the images are cached."""
+        return all(os.path.exists(self._path(img_id)) for img_id in img_ids)
+
+    def load(self, img_id: str, map_location=None) -> dict:
+        """Loads the cached predictions of an image, see save."""
+        return torch.load(self._path(img_id), map_location=map_location)
+
+    def save(self, img_id: str, entry: dict):
+        """Saves the predictions of an image, written to a temporary file which is then renamed, 
+        so an interrupted evaluation never leaves a truncated entry behind.
+
+        Args:
+            img_id (str): id of the image
+            entry (dict): 'rois', 'bboxes' and 'probs' of the model's predict_raw, 'gt_bboxes' 
+                          and 'gt_labels' of the image
+        """
+        path = self._path(img_id)
+        tmp_path = path + '.tmp{}'.format(os.getpid())
+        torch.save({key: value.detach().cpu() for key, value in entry.items()}, tmp_path)
+        os.replace(tmp_path, path)
@@ -33,6 +33,7 @@ sys.path.append(work_folder+'/src/algorithm')
 sys.path.append(work_folder+'/src/config')
 sys.path.append(work_folder+'/src/data')
 sys.path.append(work_folder+'/src/tool')
+sys.path.append(work_folder+'/src/tool/metrics')
 
 import torch
 from torch.utils.tensorboard.writer import SummaryWriter
@@ -41,6 +42,7 @@ from voc_dataset import VOCDataset
 from faster_rcnn.faster_rcnn_trainer import FasterRCNNTrainer
 from r_fcn.r_fcn_trainer import RFCNTrainer
 from config import combine_configs
+from distributed_tool import cleanup_distributed, get_local_rank, init_distributed, is_main_process
 
 def train_faster_rcnn(train_config, train_voc_dataset, eval_config, eval_voc_dataset, writer, device):
     faster_rcnn_trainer = FasterRCNNTrainer(train_config,
@@ -75,9 +77,15 @@ if __name__=="__main__":
     eval_config = combine_configs(eval_config_path)
     eval_voc_dataset = VOCDataset(eval_config,split='test')
 
-    writer = SummaryWriter(train_config.LOG.LOG_DIR+"/"+datetime.now().strftime('%Y-%m-%d_%H-%M-%S'))
-    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    # launched by torchrun with more than one process, every process trains on a part of the dataset
+    distributed = init_distributed(train_config.DISTRIBUTED.BACKEND)
+
+    # only the main process logs
+    writer = SummaryWriter(train_config.LOG.LOG_DIR+"/"+datetime.now().strftime('%Y-%m-%d_%H-%M-%S')) if is_main_process() else None
+    device = torch.device('cuda:{}'.format(get_local_rank() if distributed else 0) if torch.cuda.is_available() else 'cpu')
     train_faster_rcnn(train_config, train_voc_dataset, eval_config, eval_voc_dataset, writer, device)
-    writer.flush()
-    writer.close()
+    if writer is not None:
+        writer.flush()
+        writer.close()
+    cleanup_distributed()
 